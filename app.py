@@ -1,12 +1,12 @@
 # app.py
-import os, math, json, time
-from flask import Flask, request, jsonify, send_from_directory
+import os, re, math, json, time, zlib, queue, datetime, threading, unicodedata, concurrent.futures
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 import requests
 from google import genai
 from google.genai import types
 import numpy as np
 from pydantic import BaseModel, Field, ValidationError, conint, confloat, constr, ConfigDict
-from typing import Annotated, Optional
+from typing import Annotated, List, Optional
 
 GEMINI_MODEL = "gemini-2.5-flash"  # 生成用
 EMBEDDING_MODEL = "gemini-embedding-001"  # 検索用
@@ -15,6 +15,12 @@ app = Flask(__name__)
 # Geminiクライアントは遅延初期化 (環境変数 GEMINI_API_KEY を明示使用)
 client = None  # type: ignore
 
+# 1リクエスト全体の時間予算 (秒)。全ステージがこの締切を共有する。
+BUDGET_SECONDS = float(os.environ.get("BUDGET_SECONDS", 6.0))
+# ステージ並列実行用のプロセス共有プール (リクエスト毎に生成しない)
+_STAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("STAGE_WORKERS", 16)), thread_name_prefix="stage")
+
 
 # ------------------------------------------------------------
 # Pydantic スキーマ定義 (入力)
@@ -30,13 +36,34 @@ class SuggestRequest(BaseModel):
     budget: Optional[Annotated[str, constr(strip_whitespace=True, max_length=50)]] = None
 
 
-def _bad_request_from_validation(err: ValidationError):
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+
+
+class SuggestBatchRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    items: List[SuggestRequest] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+
+
+def _validation_issues(err: ValidationError):
     # エラー内容をフィールド + 短い理由に要約
     issues = []
     for e in err.errors():
         loc = ".".join(str(p) for p in e.get("loc", []) if p != '__root__')
         issues.append(f"{loc}: {e.get('msg')}")
-    return jsonify({"error": "invalid_request", "details": issues}), 400
+    return issues
+
+
+def _bad_request_from_validation(err: ValidationError):
+    return jsonify({"error": "invalid_request", "details": _validation_issues(err)}), 400
+
+def parse_suggest_request(raw) -> SuggestRequest:
+    """/api/suggest の入力を検証 (不正なら ValidationError)。"""
+    # bool 文字列の正規化 (pydanticは true/false 文字列を解釈するが、空文字は None に変換)
+    if isinstance(raw, dict) and "indoor" in raw and raw["indoor"] == "":
+        raw["indoor"] = None
+    return SuggestRequest.model_validate(raw)
+
 
 def _bad_request(msg: str):
     return jsonify({"error": "invalid_request", "details": [msg]}), 400
@@ -59,38 +86,344 @@ def _unhandled(e: Exception):  # PIIを含む可能性のある request.data は
     return jsonify({"error": "internal_error", "debug": str(e)}), 500
 # https://ai.google.dev/gemini-api/docs/quickstart
 
-# 1) 起動時にアクティビティを読み込み＆埋め込みを用意（初回は計算して保存）
+# 1) 起動時にアクティビティを読み込み＆埋め込みを用意
+#    埋め込みの計算はリクエスト経路では行わない (build_embeddings.py / バックグラウンド再構築)
 with open("activities_seed.json", "r", encoding="utf-8") as f:
     ACTIVITIES = json.load(f)
 
-# 既存の埋め込みキャッシュがなければ作成
-if os.path.exists("embeddings.npy"):
-    EMB = np.load("embeddings.npy").astype(np.float32, copy=False)
-    _emb_norms = np.linalg.norm(EMB, axis=1, keepdims=True) + 1e-9
-    EMB_UNIT = EMB / _emb_norms
-else:
-    # 初回起動時に Gemini API 利用不可 (キー未設定等) でもアプリを起動させたいので遅延生成
-    EMB = None  # type: ignore
-    EMB_UNIT = None  # type: ignore
+
+def _build_tag_index(activities):
+    """タグ → 行番号 (昇順 int64 配列) の転置インデックス。"""
+    rows = {}
+    for i, a in enumerate(activities):
+        for t in dict.fromkeys(a.get("tags", [])):
+            rows.setdefault(t, []).append(i)
+    return {t: np.asarray(ids, dtype=np.int64) for t, ids in rows.items()}
+
+
+# カタログ読み込み時に 1 回だけ構築 (ACTIVITIES は実行中に変わらない)
+TAG_INDEX = _build_tag_index(ACTIVITIES)
+# ルールタグのうち、埋め込み検索を「そのタグを持つ行だけ」に絞る (ハードフィルタ) もの。
+# それ以外のルールタグは類似度への加点 (ブースト) として使う。
+HARD_FILTER_TAGS = ("indoor",)
+TAG_BOOST_WEIGHT = float(os.environ.get("TAG_BOOST_WEIGHT", 0.05))
+ANN_FILTER_EXACT_MAX = int(os.environ.get("ANN_FILTER_EXACT_MAX", 20000))  # これ以下の絞り込み結果は厳密スコア
+
+
+def _rows_for_tags(tags, tag_index=None):
+    """いずれかのタグを持つ行 (昇順, 重複なし)。該当なしは None。"""
+    tag_index = TAG_INDEX if tag_index is None else tag_index
+    hits = [tag_index[t] for t in dict.fromkeys(tags or []) if t in tag_index]
+    if not hits:
+        return None
+    return hits[0] if len(hits) == 1 else np.unique(np.concatenate(hits))
+
+
+def _tag_bonus(tags, n_rows: int, weight: float = None, tag_index=None):
+    """ブーストタグ 1 個一致ごとに weight を加える類似度加点ベクトル (float32, 長さ n_rows)。"""
+    tag_index = TAG_INDEX if tag_index is None else tag_index
+    weight = TAG_BOOST_WEIGHT if weight is None else weight
+    present = [t for t in dict.fromkeys(tags or []) if t in tag_index]
+    if not present or weight == 0:
+        return None
+    bonus = np.zeros(n_rows, dtype=np.float32)
+    for t in present:
+        ids = tag_index[t]
+        bonus[ids[ids < n_rows]] += weight
+    return bonus
+
+
+EMB_PATH = "embeddings.npy"
+# embeddings.npy の各行に対応するアクティビティ内容ハッシュ (増分ビルド用)
+EMB_MANIFEST_PATH = "embeddings.manifest.json"
+EMB_MANIFEST_VERSION = 1
+EMB_BATCH_SIZE = int(os.environ.get("EMB_BATCH_SIZE", 100))  # embed_content 1回あたりの件数
+
+
+def _activity_text(a: dict) -> str:
+    """アクティビティの埋め込み対象テキスト。"""
+    return f"{a['name']} {', '.join(a['tags'])}"
+
+
+def _activity_hash(a: dict, model: str = EMBEDDING_MODEL) -> str:
+    """埋め込み対象テキスト + モデル名の内容ハッシュ。"""
+    import hashlib
+    return hashlib.sha256(f"{model}\n{_activity_text(a)}".encode("utf-8")).hexdigest()
+
+
+def _load_manifest(path: str = EMB_MANIFEST_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _catalog_matches(store, manifest, activities) -> bool:
+    """埋め込み行列 / ストアがカタログと行単位で対応しているか。
+    ストアにカタログダイジェストがあればそれで、無ければ manifest で判定する。
+    manifest も無い旧形式は行数一致のみで判定する。"""
+    if store is None or store.shape[0] != len(activities):
+        return False
+    digest = getattr(store, "catalog_digest", None)
+    if digest is not None:
+        return digest == _catalog_digest(activities)
+    if manifest is None:
+        return True
+    return (manifest.get("model") == EMBEDDING_MODEL
+            and manifest.get("hashes") == [_activity_hash(a) for a in activities])
+
+
+def _load_embedding_store():
+    """量子化ストア (memmap) を優先し、無ければ embeddings.npy から float32 ストアを作る。"""
+    if EMB_STORE_PATH and os.path.exists(EMB_STORE_PATH):
+        try:
+            return EmbeddingStore.open(EMB_STORE_PATH)
+        except Exception as e:
+            app.logger.warning("embedding store open failed: %s", e)
+    if os.path.exists(EMB_PATH):
+        emb = np.load(EMB_PATH)
+        return EmbeddingStore.from_float32(emb, projection=_fit_projection(EmbeddingStore.normalize(emb)))
+    return None
+
 
 def cosine_sim(a, b): return np.dot(a, b) / (np.linalg.norm(a)*np.linalg.norm(b)+1e-9)
 
+# ---------------- 上流 HTTP クライアント (ホスト毎の keep-alive 接続プール) ----------------
+# Open-Meteo / Overpass への呼び出しは毎回・リトライ毎に TCP+TLS を張り直さないよう、
+# ホスト毎の requests.Session (HTTPAdapter の接続プール) を共有する。
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 32))  # ホスト毎に保持する接続数
+HTTP_POOL_BLOCK = os.environ.get("HTTP_POOL_BLOCK", "0") == "1"  # 上限到達時に空きを待つか (既定: 追加接続)
+
+
+class UpstreamHTTP:
+    """上流 API 用の共有 HTTP クライアント。
+    ホスト (scheme://netloc) 毎に Session を 1 つ持ち、接続は keep-alive で再利用する。
+    stats() はホスト毎のリクエスト数・新規接続数・再利用率 (1 - 接続数/リクエスト数)。"""
+
+    def __init__(self, pool_maxsize: int = HTTP_POOL_MAXSIZE, pool_block: bool = HTTP_POOL_BLOCK):
+        self.pool_maxsize = max(1, int(pool_maxsize))
+        self.pool_block = pool_block
+        self._sessions = {}  # host -> (Session, HTTPAdapter)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _host(url: str) -> str:
+        from urllib.parse import urlsplit
+        u = urlsplit(url)
+        return f"{u.scheme}://{u.netloc}"
+
+    def session(self, url: str) -> requests.Session:
+        host = self._host(url)
+        with self._lock:
+            entry = self._sessions.get(host)
+            if entry is None:
+                from requests.adapters import HTTPAdapter
+                s = requests.Session()
+                # リトライは呼び出し側 (締切を知っている) が行う
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize,
+                                      max_retries=0, pool_block=self.pool_block)
+                s.mount(host, adapter)
+                entry = self._sessions[host] = (s, adapter)
+        return entry[0]
+
+    def get(self, url: str, **kw):
+        return self.session(url).get(url, **kw)
+
+    def post(self, url: str, **kw):
+        return self.session(url).post(url, **kw)
+
+    def stats(self) -> dict:
+        out = {}
+        with self._lock:
+            entries = list(self._sessions.items())
+        for host, (_, adapter) in entries:
+            pools = adapter.poolmanager.pools
+            conns = reqs = 0
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    conns += pool.num_connections
+                    reqs += pool.num_requests
+            out[host] = {
+                "requests": reqs,
+                "connections": conns,
+                "reuse_rate": round(1 - conns / reqs, 4) if reqs else 0.0,
+            }
+        return out
+
+
+HTTP = UpstreamHTTP()
+
+
+# ---------------- サーキットブレーカー (上流毎) ----------------
+# 連続 BREAKER_FAILURES 回の失敗 / タイムアウトで open になり、open の間は呼び出しを即座に
+# 諦めて縮退経路へ回す (リトライ待ちを払わない)。復旧確認はリクエストではなく
+# バックグラウンドの試行 (half_open) が BREAKER_COOLDOWN 秒毎に行い、成功したら closed に戻す。
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 30))
+
+
+class CircuitOpenError(RuntimeError):
+    """ブレーカーが open のため上流呼び出しを省略した。"""
+
+
+class CircuitBreaker:
+    """上流 1 つ分のブレーカー。state は closed / open / half_open (open 中に試行している間)。"""
+
+    def __init__(self, name: str, probe=None, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.probe = probe  # 引数なしで上流を 1 回叩く関数 (例外 = 失敗)
+        self.threshold = max(1, int(failures))
+        self.cooldown = float(cooldown)
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened = 0
+        self.short_circuited = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def allow(self) -> bool:
+        """呼んでよければ True。open / half_open なら数えて False。"""
+        if self.state == "closed":
+            return True
+        with self._lock:
+            self.short_circuited += 1
+        return False
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = "closed"
+
+    def failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state != "closed" or self.consecutive_failures < self.threshold:
+                return
+            self.state = "open"
+            self.opened += 1
+            self.opened_at = time.time()
+            app.logger.warning("circuit %s opened after %d failures", self.name, self.consecutive_failures)
+            if self.probe is not None and (self._prober is None or not self._prober.is_alive()):
+                self._prober = threading.Thread(target=self._probe_loop, name=f"breaker-{self.name}", daemon=True)
+                self._prober.start()
+
+    def probe_once(self) -> bool:
+        """half_open で 1 回だけ試す。成功なら closed、失敗なら open のまま。"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            self.state = "half_open"
+        try:
+            self.probe()
+        except Exception as e:
+            app.logger.debug("circuit %s probe failed: %s", self.name, e.__class__.__name__)
+            with self._lock:
+                self.state = "open"
+            return False
+        app.logger.warning("circuit %s closed", self.name)
+        self.success()
+        return True
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.cooldown)
+            if self.probe_once():
+                return
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures, "opened": self.opened,
+                "short_circuited": self.short_circuited, "opened_at": self.opened_at}
+
+
+def _probe_open_meteo():
+    resp = HTTP.get(weather_url(35.68, 139.76), timeout=5)
+    resp.raise_for_status()
+
+
+def _probe_overpass():
+    resp = HTTP.post(OVERPASS_URL, data={"data": "[out:json][timeout:5];node(35.68,139.76,35.681,139.761);out ids 1;"},
+                     timeout=5, headers=OVERPASS_HEADERS)
+    resp.raise_for_status()
+
+
+def _probe_gemini():
+    if client is None:
+        raise RuntimeError("no client")
+    client.embed_content(model=EMBEDDING_MODEL, content="ping")
+
+
+BREAKERS = {
+    "open_meteo": CircuitBreaker("open_meteo", _probe_open_meteo),
+    "overpass": CircuitBreaker("overpass", _probe_overpass),
+    "gemini": CircuitBreaker("gemini", _probe_gemini),
+}
+
+
+def breaker_states() -> dict:
+    """METRIC ログ用の {上流: state}。"""
+    return {name: b.state for name, b in BREAKERS.items()}
+
+
+WEATHER_VARS = "temperature_2m,apparent_temperature,precipitation,weather_code,wind_speed_10m"
+
+
+def weather_url(lat, lon) -> str:
+    """Open-Meteo 予報 URL。lat / lon はカンマ区切りで複数地点も可。
+    hourly は 2 日分を取り、キャッシュ期間中の「現在」を時間別予報から導出する (weather_at)。"""
+    return ("https://api.open-meteo.com/v1/forecast"
+            f"?latitude={lat}&longitude={lon}"
+            f"&current={WEATHER_VARS}"
+            f"&hourly={WEATHER_VARS},precipitation_probability&forecast_days=2&timezone=auto")
+
+
 def fetch_weather(lat, lon):
-    url = ("https://api.open-meteo.com/v1/forecast"
-           f"?latitude={lat}&longitude={lon}"
-           "&current=temperature_2m,apparent_temperature,precipitation,weather_code,wind_speed_10m"
-           "&hourly=precipitation_probability&timezone=auto")
-    return requests.get(url, timeout=6).json()  # Open-Meteo: APIキー不要
+    return HTTP.get(weather_url(lat, lon), timeout=6).json()  # Open-Meteo: APIキー不要
     # https://open-meteo.com/en/docs
 
-def shortlist_by_rules(weather, user):
-    """天気 + ユーザー気分から候補タグ集合を生成。
-    Agent仕様 (agents.md) のルールに揃える:
-      - 降水 >0 または 降水確率>=50% または indoor希望 または 風速>=10 で屋内系
-      - 体感温度 >=30 で 暑さ回避タグ (aquarium, mall)
-      - 体感温度 <=8 で 寒さタグ (sauna, cafe) *spa は従来互換で残す
-      - 気分: 冒険→ bouldering/trampoline/karaoke, まったり→ cafe/bookstore
-    """
+def _hourly_epochs(weather: dict):
+    """hourly.time (timezone=auto の現地時刻 ISO 文字列 / unixtime) を UTC エポック秒の配列に。"""
+    from datetime import datetime, timezone
+    times = (weather.get("hourly") or {}).get("time") or []
+    offset = float(weather.get("utc_offset_seconds") or 0)
+    out = []
+    for t in times:
+        if isinstance(t, (int, float)):
+            out.append(float(t))
+        else:
+            out.append(datetime.fromisoformat(t).replace(tzinfo=timezone.utc).timestamp() - offset)
+    return np.asarray(out, dtype=np.float64)
+
+
+def weather_at(weather: dict, now: float = None):
+    """キャッシュ済み予報から時刻 now の天気を導出。
+    current を now を含む時間帯の hourly 値で置き換え、hourly は now の時間帯から始まるよう切り詰める
+    (shortlist_by_rules は hourly[0] を「今」の降水確率として読む)。予報範囲外 / hourly が無ければ None。"""
+    try:
+        epochs = _hourly_epochs(weather)
+    except (TypeError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    if epochs.size == 0 or now < epochs[0] or now >= epochs[-1] + 3600:
+        return None
+    idx = int(np.searchsorted(epochs, now, side="right")) - 1
+    hourly = weather.get("hourly") or {}
+    current = dict(weather.get("current") or {})
+    for k in WEATHER_VARS.split(","):
+        v = hourly.get(k)
+        if isinstance(v, list) and idx < len(v) and v[idx] is not None:
+            current[k] = v[idx]
+    current["time"] = hourly["time"][idx]
+    out = dict(weather)
+    out["current"] = current
+    out["hourly"] = {k: (v[idx:] if isinstance(v, list) else v) for k, v in hourly.items()}
+    return out
+
+
+def weather_drivers(weather):
+    """ルールが参照する天気の値 (降水, 体感温度, 風速, 降水確率) を float で取り出す。欠損は 0。"""
     if not isinstance(weather, dict):
         raise TypeError("weather must be dict")
     c = weather.get("current", {}) or {}
@@ -112,6 +445,18 @@ def shortlist_by_rules(weather, user):
         precip_prob = _f(pp_raw[0])
     else:
         precip_prob = _f(pp_raw)
+    return precip, app_temp, wind, precip_prob
+
+
+def shortlist_by_rules(weather, user):
+    """天気 + ユーザー気分から候補タグ集合を生成。
+    Agent仕様 (agents.md) のルールに揃える:
+      - 降水 >0 または 降水確率>=50% または indoor希望 または 風速>=10 で屋内系
+      - 体感温度 >=30 で 暑さ回避タグ (aquarium, mall)
+      - 体感温度 <=8 で 寒さタグ (sauna, cafe) *spa は従来互換で残す
+      - 気分: 冒険→ bouldering/trampoline/karaoke, まったり→ cafe/bookstore
+    """
+    precip, app_temp, wind, precip_prob = weather_drivers(weather)
     mood = (user.get("mood") if isinstance(user, dict) else "") or ""
     want_indoor = bool(user.get("indoor")) if isinstance(user, dict) else False
 
@@ -128,36 +473,863 @@ def shortlist_by_rules(weather, user):
         tags += ["cafe", "bookstore"]
     return list(dict.fromkeys(tags))  # 順序保持 & 重複除去
 
-def _ensure_embeddings():
-    """埋め込み行列がまだ無ければ作成。失敗時は False を返す。"""
-    global EMB, EMB_UNIT, client
-    if EMB is not None and EMB_UNIT is not None:
-        return True
+def _embed_texts(texts):
+    """複数テキストを 1 回の embed_content 呼び出しで埋め込む。"""
     if client is None:
-        return False
+        raise RuntimeError("Gemini client is not configured (GEMINI_API_KEY)")
+    return _gemini_call(lambda: client.embed_content(model=EMBEDDING_MODEL, content=list(texts)))['embedding']
+
+
+def _gemini_call(fn):
+    """Gemini 呼び出しを BREAKERS["gemini"] 越しに実行 (open なら CircuitOpenError)。"""
+    breaker = BREAKERS["gemini"]
+    if not breaker.allow():
+        raise CircuitOpenError("gemini")
+    try:
+        res = fn()
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success()
+    return res
+
+
+def _atomic_write(path: str, write_fn):
+    """一時ファイルに書いてから rename (読み手が書き途中の状態を見ない)。"""
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        write_fn(f)
+    os.replace(tmp, path)
+
+
+def build_catalog_embeddings(activities=None, embed_batch=None, npy_path: str = EMB_PATH,
+                             manifest_path: str = EMB_MANIFEST_PATH, full: bool = False,
+                             batch_size: int = EMB_BATCH_SIZE, store_path: str = None, store_kind: str = None,
+                             store_dims: int = None, store_projection: str = None):
+    """カタログ埋め込みを増分ビルドし npy + manifest (+ 量子化ストア) を書き出す。
+    - manifest のハッシュが一致する行は再利用し、追加/変更分のみ batch_size 件ずつ埋め込む。
+    - manifest の無い旧形式 npy は、行数が一致すれば現カタログ順に対応するとみなし再利用。
+    - full=True で全件再計算。
+    - store_path を指定すると EmbeddingStore 形式 (store_kind) も書き出す。
+      store_dims / store_projection (既定 EMB_DIMS / EMB_PROJECTION) で次元削減したストアになる。
+    返却: (埋め込み行列 float32, {"total", "reused", "embedded", "batches"})
+    """
+    activities = ACTIVITIES if activities is None else activities
+    embed_batch = embed_batch or _embed_texts
+    hashes = [_activity_hash(a) for a in activities]
+    reuse = {}
+    if not full and os.path.exists(npy_path):
+        old = np.load(npy_path).astype(np.float32, copy=False)
+        manifest = _load_manifest(manifest_path)
+        if manifest is not None:
+            old_hashes = manifest.get("hashes") or []
+            if manifest.get("model") == EMBEDDING_MODEL and len(old_hashes) == old.shape[0]:
+                for h, row in zip(old_hashes, old):
+                    reuse.setdefault(h, row)
+        elif old.shape[0] == len(activities):
+            for h, row in zip(hashes, old):
+                reuse.setdefault(h, row)
+    missing = [i for i, h in enumerate(hashes) if h not in reuse]
+    fresh = {}
+    batches = 0
+    for s in range(0, len(missing), max(1, batch_size)):
+        chunk = missing[s:s + max(1, batch_size)]
+        vecs = embed_batch([_activity_text(activities[i]) for i in chunk])
+        if len(vecs) != len(chunk):
+            raise RuntimeError(f"embed batch size mismatch: {len(vecs)} != {len(chunk)}")
+        for i, v in zip(chunk, vecs):
+            fresh[i] = np.asarray(v, dtype=np.float32)
+        batches += 1
+    rows = [fresh[i] if i in fresh else reuse[h] for i, h in enumerate(hashes)]
+    emb = np.vstack(rows).astype(np.float32, copy=False) if rows else np.zeros((0, 0), dtype=np.float32)
+    _atomic_write(npy_path, lambda f: np.save(f, emb))
+    manifest = {
+        "version": EMB_MANIFEST_VERSION,
+        "model": EMBEDDING_MODEL,
+        "dim": int(emb.shape[1]) if emb.ndim == 2 else 0,
+        "built_at": time.time(),
+        "hashes": hashes,
+        "names": [a.get("name", "") for a in activities],
+    }
+    _atomic_write(manifest_path, lambda f: f.write(json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8")))
+    if store_path and emb.size:
+        unit = EmbeddingStore.normalize(np.array(emb, dtype=np.float32))
+        EmbeddingStore.write(store_path, unit, store_kind or EMB_STORE_KIND, catalog_digest=_catalog_digest(activities),
+                             normalized=True, projection=_fit_projection(unit, store_dims, store_projection))
+    stats = {"total": len(activities), "reused": len(activities) - len(missing),
+             "embedded": len(missing), "batches": batches}
+    return emb, stats
+
+
+def _catalog_digest(activities) -> bytes:
+    """カタログ全体の内容ダイジェスト (EmbeddingStore ヘッダに記録し整合性判定に使う)。"""
+    import hashlib
+    return hashlib.sha256("\n".join(_activity_hash(a) for a in activities).encode("ascii")).digest()
+
+
+# ---------------- 埋め込みストア (事前正規化 + 量子化 + memmap) ----------------
+EMB_STORE_PATH = os.environ.get("EMB_STORE_PATH", "embeddings.ppemb")
+EMB_STORE_KIND = os.environ.get("EMB_STORE_KIND", "f16")  # f32 / f16 / i8
+EMB_SCORE_CHUNK = int(os.environ.get("EMB_SCORE_CHUNK", 8192))  # スコア計算の行チャンク (一時メモリ上限)
+# 次元削減 (0 で元の次元のまま)。ストアのビルド時に適用し、クエリは検索時に同じ変換で射影する。
+# 採用する次元は eval_recall.py dims の recall@k を見て決める。
+EMB_DIMS = int(os.environ.get("EMB_DIMS", 0))
+EMB_PROJECTION = os.environ.get("EMB_PROJECTION", "truncate")  # truncate / pca
+
+
+class EmbeddingProjection:
+    """埋め込みの次元削減。カタログとクエリに同じ変換をかけ、結果を再正規化する。
+    - truncate: 先頭 dim 次元だけを使う (gemini-embedding-001 は Matryoshka 学習済みで先頭ほど情報が多い)
+    - pca: カタログ行の SVD で得た主成分 dim 本へ射影。内積 (コサイン順位) を保つため平均は引かない。
+      主成分数は学習行数で頭打ちになり、行数 <= dim ならカタログとの内積は射影後も変わらない。
+    """
+
+    KINDS = {"truncate": 1, "pca": 2}
+
+    def __init__(self, kind: str, dim: int, src_dim: int, components=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown projection: {kind}")
+        self.kind = kind
+        self.dim = int(dim)
+        self.src_dim = int(src_dim)
+        self.components = None if components is None else np.asarray(components, dtype=np.float32)  # (dim, src_dim)
+
+    @classmethod
+    def fit(cls, unit, dim: int, kind: str = EMB_PROJECTION, max_rows: int = 20000, seed: int = 0):
+        """単位ベクトル行列 (rows, src_dim) から射影を作る。dim が元の次元以上なら None (削減しない)。
+        pca は max_rows 行のサンプルで SVD する。"""
+        unit = np.asarray(unit, dtype=np.float32)
+        src_dim = unit.shape[1]
+        if dim <= 0 or dim >= src_dim:
+            return None
+        if kind == "truncate":
+            return cls("truncate", dim, src_dim)
+        if kind not in cls.KINDS:
+            raise ValueError(f"unknown projection: {kind}")
+        sample = unit
+        if unit.shape[0] > max_rows:
+            rng = np.random.default_rng(seed)
+            sample = unit[np.sort(rng.choice(unit.shape[0], size=max_rows, replace=False))]
+        _, _, vt = np.linalg.svd(sample, full_matrices=False)
+        components = vt[:dim]
+        return cls("pca", components.shape[0], src_dim, components)
+
+    def apply(self, X):
+        """(src_dim,) / (m, src_dim) を射影して再正規化。"""
+        X = np.asarray(X, dtype=np.float32)
+        if self.kind == "truncate":
+            Y = np.array(X[..., :self.dim], dtype=np.float32)
+        else:
+            Y = X @ self.components.T
+        return Y / (np.linalg.norm(Y, axis=-1, keepdims=True) + 1e-9)
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.components is None else int(self.components.nbytes)
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "dim": self.dim, "src_dim": self.src_dim}
+
+
+def _fit_projection(unit, dims: int = None, kind: str = None):
+    """EMB_DIMS / EMB_PROJECTION (引数で上書き可) に従う射影。削減しない設定なら None。"""
+    dims = EMB_DIMS if dims is None else dims
+    if not dims or unit is None or unit.ndim != 2 or not unit.size:
+        return None
+    return EmbeddingProjection.fit(unit, dims, kind or EMB_PROJECTION)
+
+
+class EmbeddingStore:
+    """事前正規化済み埋め込み行列。
+    ファイル形式 (リトルエンディアン):
+      [0:128)   ヘッダ: magic "PPEMBSTR", version, kind, rows, dim, scales_offset, data_offset, catalog_digest
+                v2 は続けて projection, src_dim, projection_offset
+      [scales)  int8 時のみ float32[rows] の行スケール (x ≈ q * scale)
+      [data)    rows x dim の f32 / f16 / i8 (64 バイト境界)
+      [proj)    v2 の pca のみ float32[dim, src_dim] の主成分 (64 バイト境界)
+    次元削減しないストアは従来どおり v1 で書く。
+    open() は np.memmap で読むため、gunicorn ワーカー間で OS のページキャッシュを共有する。
+    """
+
+    MAGIC = b"PPEMBSTR"
+    VERSION = 2
+    HEADER = "<8sIIQQQQ32s"
+    HEADER_V2 = HEADER + "IIQ"
+    HEADER_SIZE = 128
+    KINDS = {"f32": (1, np.float32), "f16": (2, np.float16), "i8": (3, np.int8)}
+
+    def __init__(self, data, scales=None, kind: str = "f32", path: str = None, catalog_digest: bytes = None,
+                 projection: EmbeddingProjection = None):
+        self.data = data
+        self.scales = scales
+        self.kind = kind
+        self.path = path
+        self.catalog_digest = catalog_digest
+        self.projection = projection
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    @property
+    def src_dim(self) -> int:
+        """クエリ埋め込み側の次元 (射影前)。"""
+        return self.projection.src_dim if self.projection is not None else self.data.shape[1]
+
+    def project(self, Q):
+        """クエリ単位ベクトル (dim,) / (m, dim) をストアの空間へ。射影なし / 射影済みならそのまま。"""
+        Q = np.asarray(Q, dtype=np.float32)
+        if self.projection is None or Q.shape[-1] == self.data.shape[1]:
+            return Q
+        return self.projection.apply(Q)
+
+    def stats(self) -> dict:
+        return {"rows": len(self), "dim": int(self.data.shape[1]), "kind": self.kind,
+                "mb": round(self.nbytes / 1e6, 3),
+                "projection": self.projection.stats() if self.projection is not None else None}
+
+    # ---- 構築 ----
+    @staticmethod
+    def normalize(emb):
+        """行を単位ベクトル化 (float32, 可能ならその場で)。"""
+        emb = np.asarray(emb, dtype=np.float32)
+        emb /= (np.linalg.norm(emb, axis=1, keepdims=True) + 1e-9)
+        return emb
+
+    @classmethod
+    def from_float32(cls, emb, catalog_digest: bytes = None, projection: EmbeddingProjection = None):
+        """float32 行列からメモリ上のストアを作る (正規化済みコピーは 1 つだけ)。
+        projection を渡すと射影後の行列を持つ。"""
+        unit = cls.normalize(np.array(emb, dtype=np.float32, copy=True))
+        if projection is not None:
+            unit = projection.apply(unit)
+        return cls(unit, kind="f32", catalog_digest=catalog_digest, projection=projection)
+
+    @classmethod
+    def quantize(cls, unit, kind: str):
+        """単位ベクトル行列を kind に変換。返却: (data, scales or None)"""
+        if kind == "f32":
+            return np.ascontiguousarray(unit, dtype=np.float32), None
+        if kind == "f16":
+            return unit.astype(np.float16), None
+        if kind == "i8":
+            scales = (np.abs(unit).max(axis=1) / 127.0).astype(np.float32)
+            scales[scales == 0] = 1.0
+            q = np.clip(np.rint(unit / scales[:, None]), -127, 127).astype(np.int8)
+            return q, scales
+        raise ValueError(f"unknown store kind: {kind}")
+
+    @classmethod
+    def write(cls, path: str, emb, kind: str = EMB_STORE_KIND, catalog_digest: bytes = None, normalized: bool = False,
+              projection: EmbeddingProjection = None):
+        """emb を正規化 (+ projection で次元削減) + 量子化して path に書き出す (一時ファイル → rename)。"""
+        import struct
+        unit = np.asarray(emb, dtype=np.float32) if normalized else cls.normalize(np.array(emb, dtype=np.float32))
+        if projection is not None:
+            unit = projection.apply(unit)
+        data, scales = cls.quantize(unit, kind)
+        rows, dim = data.shape
+        scales_offset = cls.HEADER_SIZE if scales is not None else 0
+        data_offset = cls.HEADER_SIZE + (scales.nbytes if scales is not None else 0)
+        data_offset = (data_offset + 63) // 64 * 64
+        fields = (cls.MAGIC, 1 if projection is None else cls.VERSION, cls.KINDS[kind][0], rows, dim,
+                  scales_offset, data_offset, catalog_digest or b"\0" * 32)
+        proj_offset = 0
+        if projection is None:
+            header = struct.pack(cls.HEADER, *fields)
+        else:
+            if projection.components is not None:
+                proj_offset = (data_offset + data.nbytes + 63) // 64 * 64
+            header = struct.pack(cls.HEADER_V2, *fields,
+                                 EmbeddingProjection.KINDS[projection.kind], projection.src_dim, proj_offset)
+
+        def _write(f):
+            f.write(header.ljust(cls.HEADER_SIZE, b"\0"))
+            if scales is not None:
+                f.write(scales.tobytes())
+            f.write(b"\0" * (data_offset - f.tell()))
+            f.write(np.ascontiguousarray(data).tobytes())
+            if proj_offset:
+                f.write(b"\0" * (proj_offset - f.tell()))
+                f.write(np.ascontiguousarray(projection.components).tobytes())
+
+        _atomic_write(path, _write)
+        return path
+
+    @classmethod
+    def open(cls, path: str):
+        """ストアファイルを memmap で開く。"""
+        import struct
+        with open(path, "rb") as f:
+            head = f.read(cls.HEADER_SIZE)
+        if len(head) < struct.calcsize(cls.HEADER):
+            raise ValueError(f"{path}: truncated header")
+        magic, version, kind_code, rows, dim, scales_offset, data_offset, digest = struct.unpack_from(cls.HEADER, head)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path}: not an embedding store")
+        if version not in (1, cls.VERSION):
+            raise ValueError(f"{path}: unsupported store version {version}")
+        kind, dtype = next((k, dt) for k, (code, dt) in cls.KINDS.items() if code == kind_code)
+        data = np.memmap(path, dtype=dtype, mode="r", offset=data_offset, shape=(rows, dim))
+        scales = None
+        if kind == "i8":
+            scales = np.memmap(path, dtype=np.float32, mode="r", offset=scales_offset, shape=(rows,))
+        projection = None
+        if version >= 2:
+            proj_code, src_dim, proj_offset = struct.unpack_from(cls.HEADER_V2, head)[8:]
+            proj_kind = next((k for k, code in EmbeddingProjection.KINDS.items() if code == proj_code), None)
+            if proj_kind is None:
+                raise ValueError(f"{path}: unknown projection code {proj_code}")
+            components = None
+            if proj_offset:
+                components = np.memmap(path, dtype=np.float32, mode="r", offset=proj_offset, shape=(dim, src_dim))
+            projection = EmbeddingProjection(proj_kind, dim, src_dim, components)
+        return cls(data, scales, kind, path, None if digest == b"\0" * 32 else digest, projection)
+
+    # ---- 検索 ----
+    def unit_rows(self, idx=None):
+        """単位ベクトル (float32) に復元した行。idx 省略で全行。"""
+        data = self.data if idx is None else self.data[idx]
+        out = np.asarray(data, dtype=np.float32)
+        if self.scales is not None:
+            out = out * (self.scales if idx is None else self.scales[idx])[:, None]
+        return out
+
+    def scores_many(self, Q):
+        """複数クエリ (m, dim) とのコサイン類似度を行列積 1 回で求める。返却: (rows, m) float32"""
+        Q = np.asarray(Q, dtype=np.float32)
+        if self.kind == "f32":
+            return self.data @ Q.T
+        n = self.data.shape[0]
+        out = np.empty((n, Q.shape[0]), dtype=np.float32)
+        for s in range(0, n, EMB_SCORE_CHUNK):
+            e = min(n, s + EMB_SCORE_CHUNK)
+            out[s:e] = self.data[s:e].astype(np.float32) @ Q.T
+            if self.scales is not None:
+                out[s:e] *= self.scales[s:e, None]
+        return out
+
+    def scores(self, q_unit, rows=None):
+        """クエリ単位ベクトルとのコサイン類似度 (float32)。量子化行列はチャンク毎に復元。
+        rows (昇順インデックス) を渡すとその行だけをスコアする。"""
+        q_unit = np.asarray(q_unit, dtype=np.float32)
+        if rows is not None:
+            return self.unit_rows(rows) @ q_unit
+        if self.kind == "f32":
+            return self.data @ q_unit
+        n = self.data.shape[0]
+        out = np.empty(n, dtype=np.float32)
+        for s in range(0, n, EMB_SCORE_CHUNK):
+            e = min(n, s + EMB_SCORE_CHUNK)
+            out[s:e] = self.data[s:e].astype(np.float32) @ q_unit
+            if self.scales is not None:
+                out[s:e] *= self.scales[s:e]
+        return out
+
+
+# 初回起動時に Gemini API 利用不可 (キー未設定等) でもアプリを起動させたいので、無ければ遅延生成
+EMB_STORE = _load_embedding_store()
+EMB_STALE = not _catalog_matches(EMB_STORE, _load_manifest(), ACTIVITIES)
+
+
+# ---------------- 検索インデックス (厳密 / IVF 近似) ----------------
+# top_k_by_embedding は ANN_INDEX.search だけを呼ぶ。小規模カタログは厳密検索、
+# 大規模カタログはビルド済みの IVF インデックス (embeddings.ivf.npz) で近似検索する。
+ANN_INDEX_PATH = os.environ.get("ANN_INDEX_PATH", "embeddings.ivf.npz")
+ANN_MIN_ROWS = int(os.environ.get("ANN_MIN_ROWS", 5000))  # これ未満は常に厳密検索
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))  # 走査セル数: 大きいほど recall↑ / レイテンシ↑
+
+
+def _top_k_indices(sims, k: int):
+    """類似度の上位 k インデックス (降順)。argpartition で完全ソートを避ける。"""
+    k = min(k, sims.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.arange(k) if k == sims.shape[0] else np.argpartition(sims, -k)[-k:]
+    return idx[np.argsort(sims[idx])[::-1]]
+
+
+class ExactIndex:
+    """全行スコア + argpartition。"""
+
+    kind = "exact"
+
+    def __init__(self, store: EmbeddingStore):
+        self.store = store
+
+    def search(self, q_unit, k: int, rows=None, bonus=None):
+        """返却: (行インデックス 降順, 類似度)
+        rows: 対象行 (昇順) に限定してスコア。bonus: 全行長の加点ベクトル。"""
+        if rows is None:
+            sims = self.store.scores(q_unit)
+            if bonus is not None:
+                sims = sims + bonus
+            idx = _top_k_indices(sims, k)
+            return idx, sims[idx]
+        sims = self.store.scores(q_unit, rows)
+        if bonus is not None:
+            sims = sims + bonus[rows]
+        top = _top_k_indices(sims, k)
+        return rows[top], sims[top]
+
+    def search_many(self, Q, k: int, rows_list=None, bonus_list=None):
+        """複数クエリを行列積 1 回でスコアし、クエリ毎に rows / bonus を適用。返却: [(idx, sims), ...]"""
+        S = self.store.scores_many(Q)
+        out = []
+        for j in range(S.shape[1]):
+            rows = rows_list[j] if rows_list else None
+            bonus = bonus_list[j] if bonus_list else None
+            sims = S[:, j] if rows is None else S[rows, j]
+            if bonus is not None:
+                sims = sims + (bonus if rows is None else bonus[rows])
+            top = _top_k_indices(sims, k)
+            out.append(((top if rows is None else rows[top]), sims[top]))
+        return out
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "rows": len(self.store)}
+
+
+class IVFIndex:
+    """転置ファイル (IVF) 近似検索。
+    NumPy のみの球面 k-means でカタログを nlist セルに分け、クエリに近い nprobe セルの行だけを
+    ストアから厳密スコアする。nprobe が recall / レイテンシのつまみ。
+    """
+
+    kind = "ivf"
+    VERSION = 1
+
+    def __init__(self, store: EmbeddingStore, centroids, offsets, ids, nprobe: int = ANN_NPROBE):
+        self.store = store
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)  # セル c の行は ids[offsets[c]:offsets[c+1]]
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def _assign(x, centroids, chunk: int = 8192):
+        out = np.empty(x.shape[0], dtype=np.int64)
+        for s in range(0, x.shape[0], chunk):
+            out[s:s + chunk] = np.argmax(x[s:s + chunk] @ centroids.T, axis=1)
+        return out
+
+    @classmethod
+    def train_centroids(cls, x, nlist: int, iters: int = 12, seed: int = 0):
+        """球面 k-means (単位ベクトル前提)。空セルはランダム行で再初期化。"""
+        rng = np.random.default_rng(seed)
+        centroids = x[rng.choice(x.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = cls._assign(x, centroids)
+            counts = np.bincount(assign, minlength=nlist)
+            order = np.argsort(assign, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(x[order], starts[~empty], axis=0)
+            if empty.any():
+                sums[empty] = x[rng.choice(x.shape[0], size=int(empty.sum()), replace=False)]
+            centroids = EmbeddingStore.normalize(sums)
+        return centroids
+
+    @classmethod
+    def build(cls, store: EmbeddingStore, nlist: int = 0, iters: int = 12, seed: int = 0,
+              train_size: int = 0, nprobe: int = ANN_NPROBE):
+        """ストア全行からインデックスを作る。nlist=0 で 4*sqrt(N)。学習は train_size 行 (既定 max(30*nlist, 10000)、N が上限) のサンプル。"""
+        n = len(store)
+        nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+        train_size = min(n, train_size or max(nlist * 30, 10000))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, size=train_size, replace=False))
+        centroids = cls.train_centroids(store.unit_rows(sample), nlist, iters, seed)
+        assign = np.empty(n, dtype=np.int64)
+        for s in range(0, n, EMB_SCORE_CHUNK):
+            e = min(n, s + EMB_SCORE_CHUNK)
+            assign[s:e] = cls._assign(store.unit_rows(slice(s, e)), centroids)
+        ids = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        return cls(store, centroids, offsets, ids, nprobe)
+
+    def save(self, path: str):
+        digest = np.frombuffer(self.store.catalog_digest or b"\0" * 32, dtype=np.uint8)
+        _atomic_write(path, lambda f: np.savez(f, version=self.VERSION, rows=len(self.store), digest=digest,
+                                               centroids=self.centroids, offsets=self.offsets, ids=self.ids))
+        return path
+
+    @classmethod
+    def load(cls, path: str, store: EmbeddingStore, nprobe: int = ANN_NPROBE):
+        """保存済みインデックスを開く。ストアと対応しなければ ValueError。"""
+        with np.load(path) as z:
+            if int(z["version"]) != cls.VERSION:
+                raise ValueError(f"{path}: unsupported index version {int(z['version'])}")
+            if int(z["rows"]) != len(store):
+                raise ValueError(f"{path}: built for {int(z['rows'])} rows, store has {len(store)}")
+            if z["centroids"].shape[1] != store.shape[1]:
+                raise ValueError(f"{path}: built for dim {z['centroids'].shape[1]}, store has {store.shape[1]}")
+            if store.catalog_digest is not None and z["digest"].tobytes() != store.catalog_digest:
+                raise ValueError(f"{path}: catalog digest mismatch")
+            return cls(store, z["centroids"], z["offsets"], z["ids"], nprobe)
+
+    def search(self, q_unit, k: int, nprobe: int = None, rows=None, bonus=None):
+        """返却: (行インデックス 降順, 類似度)
+        rows: 対象行 (昇順) に限定。十分小さければ IVF を使わず対象行だけを厳密スコア。"""
+        exact = ExactIndex(self.store)
+        if rows is not None and rows.shape[0] <= ANN_FILTER_EXACT_MAX:
+            return exact.search(q_unit, k, rows, bonus)
+        nprobe = min(self.nlist, nprobe or self.nprobe)
+        cells = _top_k_indices(self.centroids @ np.asarray(q_unit, dtype=np.float32), nprobe)
+        cand = np.sort(np.concatenate([self.ids[self.offsets[c]:self.offsets[c + 1]] for c in cells]))
+        if rows is not None:
+            cand = np.intersect1d(cand, rows, assume_unique=True)
+        if cand.shape[0] < k:  # 走査セルが小さすぎる場合は厳密検索に落とす
+            return exact.search(q_unit, k, rows, bonus)
+        return exact.search(q_unit, k, cand, bonus)
+
+    def search_many(self, Q, k: int, rows_list=None, bonus_list=None):
+        """IVF はクエリ毎に走査セルが異なるため 1 件ずつ検索。"""
+        return [self.search(q, k, rows=rows_list[j] if rows_list else None,
+                            bonus=bonus_list[j] if bonus_list else None) for j, q in enumerate(Q)]
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "rows": len(self.store), "nlist": self.nlist, "nprobe": self.nprobe}
+
+
+def _make_index(store, allow_build: bool = False):
+    """store に対する検索インデックス。ANN_MIN_ROWS 未満 / IVF 未ビルドなら厳密検索。"""
+    if store is None:
+        return None
+    if len(store) < ANN_MIN_ROWS:
+        return ExactIndex(store)
+    if ANN_INDEX_PATH and os.path.exists(ANN_INDEX_PATH):
+        try:
+            return IVFIndex.load(ANN_INDEX_PATH, store)
+        except Exception as e:
+            app.logger.warning("ann index load failed: %s", e)
+    if allow_build:
+        index = IVFIndex.build(store)
+        if ANN_INDEX_PATH:
+            index.save(ANN_INDEX_PATH)
+        return index
+    return ExactIndex(store)
+
+
+ANN_INDEX = _make_index(EMB_STORE)
+
+
+# バックグラウンド再構築の状態 (多重起動 / 失敗時の連打を防ぐ)
+_EMB_BUILD_LOCK = threading.Lock()
+_EMB_BUILD_THREAD = None
+_EMB_BUILD_LAST_FAIL = 0.0
+EMB_BUILD_RETRY_SEC = 60.0
+
+
+def _background_embedding_build():
+    global EMB_STORE, EMB_STALE, ANN_INDEX, _EMB_BUILD_LAST_FAIL
     try:
-        texts = [f"{a['name']} {', '.join(a['tags'])}" for a in ACTIVITIES]
-        embeddings = []
-        for text in texts:
-            res = client.embed_content(model=EMBEDDING_MODEL, content=text)
-            embeddings.append(res['embedding'])
-        EMB = np.array(embeddings, dtype=np.float32)
-        np.save("embeddings.npy", EMB)
-        _n = np.linalg.norm(EMB, axis=1, keepdims=True) + 1e-9
-        EMB_UNIT = EMB / _n
+        emb, stats = build_catalog_embeddings(store_path=EMB_STORE_PATH)
+        if EMB_STORE_PATH:
+            del emb
+            store = EmbeddingStore.open(EMB_STORE_PATH)
+        else:
+            store = EmbeddingStore.from_float32(emb, catalog_digest=_catalog_digest(ACTIVITIES),
+                                                projection=_fit_projection(EmbeddingStore.normalize(emb)))
+        index = _make_index(store, allow_build=True)
+        EMB_STORE, ANN_INDEX, EMB_STALE = store, index, False
+        app.logger.info("embedding build done: %s", stats)
+    except Exception as e:  # ログのみ、次回リクエストで再試行
+        _EMB_BUILD_LAST_FAIL = time.time()
+        app.logger.warning("embed matrix build failed: %s", e.__class__.__name__)
+
+
+def _start_background_embedding_build() -> bool:
+    """埋め込み再構築をバックグラウンドスレッドで開始。起動したら True。"""
+    global _EMB_BUILD_THREAD
+    with _EMB_BUILD_LOCK:
+        if _EMB_BUILD_THREAD is not None and _EMB_BUILD_THREAD.is_alive():
+            return False
+        if time.time() - _EMB_BUILD_LAST_FAIL < EMB_BUILD_RETRY_SEC:
+            return False
+        _EMB_BUILD_THREAD = threading.Thread(target=_background_embedding_build, name="emb-build", daemon=True)
+        _EMB_BUILD_THREAD.start()
         return True
-    except Exception as e:  # ログのみ、フォールバックへ
-        app.logger.warning("embed matrix init failed: %s", e.__class__.__name__)
-        EMB = None
-        EMB_UNIT = None
-        return False
 
-def top_k_by_embedding(query_text: str, k: int = 12):
-    """正確な上位K (コサイン類似) を ~O(n) で取得する最適化版。
+
+def _ensure_embeddings():
+    """埋め込み行列がカタログと整合していれば True。
+    無い / 古い場合はリクエストをブロックせずバックグラウンド再構築を起動して False。"""
+    if EMB_STORE is not None and not EMB_STALE and EMB_STORE.shape[0] == len(ACTIVITIES):
+        return True
+    if client is not None:
+        _start_background_embedding_build()
+    return False
+
+# ---------------- キャッシュ基盤 ----------------
+class LRUTTLCache:
+    """スレッドセーフな有界 LRU + TTL キャッシュ。
+    - maxsize 超過時は最も古く使われたエントリを追い出す。
+    - ttl 秒を過ぎたエントリは get 時に失効扱い。
+    - hits / misses / evictions / expirations を stats() で返す。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        from collections import OrderedDict
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            if now - item[0] >= self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def peek(self, key, default=None):
+        """統計や LRU 順を変えずに値を覗く (失効済みでも削除しない)。"""
+        with self._lock:
+            item = self._data.get(key)
+            return default if item is None else item[1]
+
+    def put(self, key, value, stored_at: float = None):
+        with self._lock:
+            self._data[key] = (time.time() if stored_at is None else stored_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# ---------------- クエリ埋め込みキャッシュ (LRU + TTL, SQLite 永続化) ----------------
+# クエリ文字列は 気分 / ルールタグ / 予算 の組合せで少数の値に偏るため、同一文字列の
+# 埋め込み往復を省く。SQLite に書き出すので再起動後・gunicorn ワーカー間でもヒットを共有。
+QUERY_EMB_CACHE_PATH = os.environ.get("QUERY_EMB_CACHE_PATH", "query_emb_cache.sqlite3")  # 空文字でメモリのみ
+QUERY_EMB_CACHE_SIZE = int(os.environ.get("QUERY_EMB_CACHE_SIZE", 2048))
+QUERY_EMB_CACHE_TTL = float(os.environ.get("QUERY_EMB_CACHE_TTL", 7 * 24 * 3600))
+QUERY_EMB_CACHE_DISK_ROWS = int(os.environ.get("QUERY_EMB_CACHE_DISK_ROWS", 50000))
+
+
+def _normalize_query_text(text: str) -> str:
+    """キャッシュキー用の正規化 (NFKC + 連続空白の圧縮)。"""
+    import unicodedata
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+class QueryEmbeddingCache:
+    """正規化クエリ文字列 → 単位ベクトル (float32)。
+    メモリ LRU を一次、SQLite (WAL) を二次ストアとする。ディスク側の失敗はログのみで握りつぶす。
+    """
+
+    def __init__(self, path: str, maxsize: int, ttl: float, model: str = EMBEDDING_MODEL):
+        self.path = path
+        self.model = model
+        self.ttl = float(ttl)
+        self.mem = LRUTTLCache(maxsize, ttl)
+        self.disk_hits = 0
+        self.disk_errors = 0
+        self._local = threading.local()
+        self._puts = 0
+
+    def _conn(self):
+        if not self.path:
+            return None
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_emb ("
+                " model TEXT NOT NULL, key TEXT NOT NULL, created REAL NOT NULL,"
+                " dim INTEGER NOT NULL, vec BLOB NOT NULL, PRIMARY KEY (model, key))"
+            )
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def get(self, text: str):
+        key = _normalize_query_text(text)
+        vec = self.mem.get(key)
+        if vec is not None:
+            return vec
+        try:
+            conn = self._conn()
+            if conn is None:
+                return None
+            row = conn.execute(
+                "SELECT created, dim, vec FROM query_emb WHERE model=? AND key=?", (self.model, key)
+            ).fetchone()
+        except Exception as e:
+            self.disk_errors += 1
+            app.logger.debug("query emb cache read failed: %s", e.__class__.__name__)
+            return None
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        vec = np.frombuffer(row[2], dtype=np.float32)
+        if vec.shape[0] != row[1]:
+            return None
+        self.disk_hits += 1
+        self.mem.put(key, vec, stored_at=row[0])
+        return vec
+
+    def put(self, text: str, vec):
+        key = _normalize_query_text(text)
+        vec = np.ascontiguousarray(vec, dtype=np.float32)
+        now = time.time()
+        self.mem.put(key, vec, stored_at=now)
+        try:
+            conn = self._conn()
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO query_emb (model, key, created, dim, vec) VALUES (?, ?, ?, ?, ?)",
+                (self.model, key, now, int(vec.shape[0]), vec.tobytes()),
+            )
+            self._puts += 1
+            if self._puts % 256 == 0:
+                self._prune(conn, now)
+            conn.commit()
+        except Exception as e:
+            self.disk_errors += 1
+            app.logger.debug("query emb cache write failed: %s", e.__class__.__name__)
+
+    def _prune(self, conn, now: float):
+        """TTL 切れと行数上限超過分をディスクから削除。"""
+        conn.execute("DELETE FROM query_emb WHERE created < ?", (now - self.ttl,))
+        conn.execute(
+            "DELETE FROM query_emb WHERE rowid IN ("
+            " SELECT rowid FROM query_emb ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (QUERY_EMB_CACHE_DISK_ROWS,),
+        )
+
+    def stats(self) -> dict:
+        s = self.mem.stats()
+        # メモリミスのうちディスクで救えたものはヒットとして数え直す
+        s["disk_hits"] = self.disk_hits
+        s["misses"] = s["misses"] - self.disk_hits
+        total = s["hits"] + self.disk_hits + s["misses"]
+        s["hit_rate"] = round((s["hits"] + self.disk_hits) / total, 4) if total else 0.0
+        s["disk_errors"] = self.disk_errors
+        s["persistent"] = bool(self.path)
+        return s
+
+
+QUERY_EMB_CACHE = QueryEmbeddingCache(QUERY_EMB_CACHE_PATH, QUERY_EMB_CACHE_SIZE, QUERY_EMB_CACHE_TTL)
+
+
+def _embed_query(query_text: str):
+    """クエリ埋め込み (単位ベクトル)。キャッシュにあれば API を呼ばない。"""
+    q_unit = QUERY_EMB_CACHE.get(query_text)
+    if q_unit is not None:
+        return q_unit
+    q_raw = _gemini_call(lambda: client.embed_content(model=EMBEDDING_MODEL, content=query_text))['embedding']
+    q = np.asarray(q_raw, dtype=np.float32)
+    q_unit = q / (np.linalg.norm(q) + 1e-9)
+    QUERY_EMB_CACHE.put(query_text, q_unit)
+    return q_unit
+
+def _embed_queries(query_texts):
+    """複数クエリの単位ベクトル (m, dim)。キャッシュミス分だけを重複排除し、
+    EMB_BATCH_SIZE 件ずつ 1 回の embed_content でまとめて埋め込む。"""
+    vecs = [QUERY_EMB_CACHE.get(t) for t in query_texts]
+    missing = list(dict.fromkeys(t for t, v in zip(query_texts, vecs) if v is None))
+    fresh = {}
+    for s in range(0, len(missing), EMB_BATCH_SIZE):
+        chunk = missing[s:s + EMB_BATCH_SIZE]
+        for t, raw in zip(chunk, _embed_texts(chunk)):
+            q = np.asarray(raw, dtype=np.float32)
+            fresh[t] = q / (np.linalg.norm(q) + 1e-9)
+            QUERY_EMB_CACHE.put(t, fresh[t])
+    return np.vstack([v if v is not None else fresh[t] for t, v in zip(query_texts, vecs)])
+
+
+def top_k_by_embedding_batch(query_texts, k: int = 12, tag_filters=None, tag_boosts=None):
+    """top_k_by_embedding の複数クエリ版。埋め込みは 1 バッチ呼び出し、スコアは行列積 1 回。
+    返却: クエリ毎の候補リスト (失敗時は全て [])。"""
+    if k <= 0 or client is None or not query_texts:
+        return [[] for _ in query_texts]
+    if not _ensure_embeddings():
+        return [[] for _ in query_texts]
+    try:
+        return top_k_by_vectors(_embed_queries(query_texts), k, tag_filters, tag_boosts)
+    except Exception as e:
+        app.logger.warning("embed batch query failed: %s %s", e.__class__.__name__, str(e))
+        return [[] for _ in query_texts]
+
+
+def top_k_by_vectors(Q, k: int, tag_filters=None, tag_boosts=None):
+    """正規化済みクエリ行列 (m, dim) で ANN_INDEX を検索 (スコアは行列積 1 回)。
+    ストアが次元削減済みならクエリも同じ射影をかける (キャッシュには元の次元のまま持つ)。"""
+    index = ANN_INDEX
+    n = len(index.store)
+    Q = index.store.project(Q)
+    rows_list = [_rows_for_tags(f) if f else None for f in (tag_filters or [None] * len(Q))]
+    bonus_list = [_tag_bonus(b, n) if b else None for b in (tag_boosts or [None] * len(Q))]
+    results = index.search_many(Q, k, rows_list, bonus_list)
+    return [[ACTIVITIES[i] for i in idx] for idx, _ in results]
+
+
+def top_k_by_vector(q_unit, k: int, tag_filter=None, tag_boost=None):
+    """正規化済みクエリベクトルで ANN_INDEX を検索 (埋め込み取得は呼び出し側)。"""
+    index = ANN_INDEX
+    rows = _rows_for_tags(tag_filter) if tag_filter else None
+    bonus = _tag_bonus(tag_boost, len(index.store)) if tag_boost else None
+    idx_sorted, _ = index.search(index.store.project(q_unit), k, rows=rows, bonus=bonus)
+    return [ACTIVITIES[i] for i in idx_sorted]
+
+
+def top_k_by_embedding(query_text: str, k: int = 12, tag_filter=None, tag_boost=None):
+    """上位K (コサイン類似) を ANN_INDEX で取得。
     手順:
-      1. 事前正規化済み EMB_UNIT と 正規化クエリの内積 = 類似度
-      2. np.argpartition で上位Kインデックスを取得 (完全ソート回避)
-      3. そのK件のみを降順ソート
+      1. 正規化クエリ (QUERY_EMB_CACHE 経由) を得る
+      2. tag_filter があれば TAG_INDEX からいずれかのタグを持つ行だけに絞る (該当なしなら絞らない)
+         tag_boost のタグ 1 個一致ごとに TAG_BOOST_WEIGHT を類似度へ加点
+      3. 小規模カタログ: 事前正規化済み EMB_STORE (f32/f16/i8) との内積 + argpartition (厳密)
+         大規模カタログ: IVF で近い nprobe セルの行だけをスコア (近似)
+      4. 上位K件のみを降順ソート
     2000件程度では典型的に <2ms (M2) を目標。
     """
     if k <= 0 or client is None:
@@ -165,34 +1337,124 @@ def top_k_by_embedding(query_text: str, k: int = 12):
     if not _ensure_embeddings():
         return []
     try:
-        k = min(k, EMB_UNIT.shape[0])
-        q_raw = client.embed_content(model=EMBEDDING_MODEL, content=query_text)['embedding']
-        q = np.asarray(q_raw, dtype=np.float32)
-        q_unit = q / (np.linalg.norm(q) + 1e-9)
-        sims = EMB_UNIT @ q_unit
-        top_idx_unsorted = np.arange(k) if k == EMB_UNIT.shape[0] else np.argpartition(sims, -k)[-k:]
-        order = np.argsort(sims[top_idx_unsorted])[::-1]
-        idx_sorted = top_idx_unsorted[order]
-        return [ACTIVITIES[i] for i in idx_sorted]
+        return top_k_by_vector(_embed_query(query_text), k, tag_filter, tag_boost)
     except Exception as e:
         app.logger.warning("embed query failed: %s %s", e.__class__.__name__, str(e))
-        app.logger.debug("EMB_UNIT shape: %s, k: %s, query: %s", EMB_UNIT.shape if EMB_UNIT is not None else None, k, query_text[:50])
+        app.logger.debug("EMB_STORE shape: %s, k: %s, query: %s", EMB_STORE.shape if EMB_STORE is not None else None, k, query_text[:50])
         return []
 
-def _generate_fallback_suggestions(weather, user_data, rule_tags, candidates):
-    """Gemini APIが利用できない場合のフォールバック提案生成"""
-    current = weather.get("current", {})
-    mood = user_data.get("mood", "").strip()
-    indoor = user_data.get("indoor")
-    budget = user_data.get("budget", "").strip()
-    radius_km = user_data.get("radius_km")
-    
-    # 天気情報の解析
-    temp = current.get("apparent_temperature", 20)
-    precip = current.get("precipitation", 0)
-    
-    # 基本的な提案を3つ生成
-    suggestions = []
+# ---------------- ローカル埋め込み (ネットワーク不要の候補検索) ----------------
+# 単語 (タグ) と文字 n-gram の符号付き特徴ハッシュを単位ベクトルにしたもの。カタログ行列との内積 1 回で
+# 候補を出せるので、Gemini の埋め込みが取れない (クライアント無し / 失敗 / ブレーカー open / ストア再構築中)
+# ときも候補が空にならない。LOCAL_EMBED=first なら API を待たずに常にこちらで候補を出す。
+LOCAL_EMBED = os.environ.get("LOCAL_EMBED", "fallback")  # fallback / first / off
+LOCAL_EMBED_DIM = int(os.environ.get("LOCAL_EMBED_DIM", 1024))
+_LOCAL_SPLIT = re.compile(r"[\s,、。/・:：()（）\[\]「」~〜-]+")
+
+
+class LocalEmbedder:
+    """文字 n-gram (1〜3) + 単語トークン の特徴ハッシュ埋め込み (crc32 なのでプロセス間で安定)。
+    単語トークンは WORD_WEIGHT 倍で数え、タグ名の完全一致を部分一致より強くする。"""
+
+    NGRAMS = (1, 2, 3)
+    WORD_WEIGHT = 2.0
+
+    def __init__(self, dim: int = LOCAL_EMBED_DIM):
+        self.dim = int(dim)
+
+    def features(self, text: str):
+        for tok in _LOCAL_SPLIT.split(_norm_text(text)):
+            if not tok:
+                continue
+            yield "w:" + tok, self.WORD_WEIGHT
+            for n in self.NGRAMS:
+                for i in range(len(tok) - n + 1):
+                    yield tok[i:i + n], 1.0
+
+    def embed(self, text: str):
+        v = np.zeros(self.dim, dtype=np.float32)
+        for f, w in self.features(text):
+            h = zlib.crc32(f.encode("utf-8"))
+            v[h % self.dim] += w if h & 0x80000000 else -w
+        n = np.linalg.norm(v)
+        return v / n if n > 0 else v
+
+    def embed_many(self, texts):
+        return np.vstack([self.embed(t) for t in texts]) if texts else np.zeros((0, self.dim), dtype=np.float32)
+
+
+def _local_activity_text(a: dict) -> str:
+    """ローカル埋め込みの対象テキスト (名前 + タグを空白区切り。カタログ埋め込みの _activity_text とは別物)。"""
+    return " ".join([a.get("name", "")] + list(a.get("tags", [])))
+
+
+def _local_query(data: dict, rule_tags) -> str:
+    """ローカル検索用のクエリ (気分 + ルールタグ。_build_query の定型部分はハッシュ空間ではノイズになる)。"""
+    return " ".join([data.get("mood") or ""] + list(rule_tags or []))
+
+
+class LocalIndex:
+    """ACTIVITIES をローカル埋め込みした行列 (初回に構築) と top-k 検索。"""
+
+    def __init__(self, embedder: LocalEmbedder):
+        self.embedder = embedder
+        self._acts = None
+        self._matrix = None
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def matrix(self):
+        acts = ACTIVITIES
+        if self._acts is not acts:
+            with self._lock:
+                if self._acts is not acts:
+                    # 列優先: クエリの非ゼロ次元 (数十) の列だけを連続領域で読む
+                    texts = [_local_activity_text(a) for a in acts]
+                    self._matrix = np.asfortranarray(self.embedder.embed_many(texts))
+                    self._acts = acts
+        return self._matrix
+
+    def top_k(self, text: str, k: int, tag_filter=None, tag_boost=None):
+        M = self.matrix()
+        n = len(M)
+        if k <= 0 or n == 0:
+            return []
+        q = self.embedder.embed(text)
+        nz = np.flatnonzero(q)  # ハッシュ特徴は疎なので非ゼロ次元だけで内積
+        scores = M[:, nz] @ q[nz]
+        bonus = _tag_bonus(tag_boost, n) if tag_boost else None
+        if bonus is not None:
+            scores = scores + bonus
+        rows = _rows_for_tags(tag_filter) if tag_filter else None
+        rows = np.arange(n) if rows is None else rows[rows < n]
+        s = scores[rows]
+        k = min(k, len(rows))
+        top = np.argpartition(-s, k - 1)[:k]
+        self.queries += 1
+        return [self._acts[int(rows[i])] for i in top[np.argsort(-s[top], kind="stable")]]
+
+    def stats(self) -> dict:
+        return {"mode": LOCAL_EMBED, "dim": self.embedder.dim,
+                "rows": 0 if self._matrix is None else len(self._matrix), "queries": self.queries}
+
+
+LOCAL_INDEX = LocalIndex(LocalEmbedder())
+
+
+def _generate_fallback_suggestions(weather, user_data, rule_tags, candidates):
+    """Gemini APIが利用できない場合のフォールバック提案生成"""
+    current = weather.get("current", {})
+    mood = (user_data.get("mood") or "").strip()
+    indoor = user_data.get("indoor")
+    budget = (user_data.get("budget") or "").strip()
+    radius_km = user_data.get("radius_km")
+    
+    # 天気情報の解析
+    temp = current.get("apparent_temperature", 20)
+    precip = current.get("precipitation", 0)
+    
+    # 基本的な提案を3つ生成
+    suggestions = []
     
     # 提案1: 天気と気分に基づく基本提案
     if "まったり" in mood or "のんびり" in mood or "リラックス" in mood:
@@ -336,170 +1598,573 @@ TAG_TO_OSM_FEATURES = {
     "park": [("leisure", "park")],
 }
 
-def fetch_nearby_pois(lat: float, lon: float, radius_m: int, rule_tags, remaining_budget: float):
-    """Overpass API から近隣POI名 (最大8件) を取得。
-    - radius_m は 200〜5000 にクリップ。
-    - rule_tags から最大3カテゴリを抽出し複合クエリ。
-    - 残り時間が不足 / 失敗時は空配列。
-    - 10分キャッシュ。
-    """
-    import time
-    if remaining_budget <= 0:
-        return []
-    radius_m = int(min(max(radius_m, 200), 5000))
-    selected = []
-    for t in rule_tags:
-        if t in TAG_TO_OSM_FEATURES and t not in selected:
-            selected.append(t)
-        if len(selected) >= 3:
+OVERPASS_HEADERS = {"User-Agent": "PlayPlan/0.1 (+github)"}
+
+
+def _haversine_km(lat: float, lon: float, lats, lons):
+    """(lat, lon) から各点 (NumPy 配列) までの大円距離 km をまとめて計算。"""
+    lat1 = np.radians(lat)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    dlat = lat2 - lat1
+    dlon = np.radians(np.asarray(lons, dtype=np.float64) - lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _overpass_fetch(query: str, timeout: float, deadline_at: float):
+    """Overpass へ POST (最大3回リトライ)。成功時は elements、締切超過 / 失敗 / ブレーカー open は None。"""
+    breaker = BREAKERS["overpass"]
+    last_err = None
+    for attempt in range(3):
+        remain = deadline_at - time.time()
+        if remain <= 0 or not breaker.allow():
             break
-    if not selected:
-        return []
-    key = (round(lat,3), round(lon,3), radius_m//1000, tuple(sorted(selected)))
-    cache = globals().setdefault("_POI_CACHE", {})
-    now = time.time()
-    cached = cache.get(key)
-    if cached and now - cached[0] < 600:
-        return cached[1]
-    parts = []
-    for tag in selected:
-        for k,v in TAG_TO_OSM_FEATURES[tag]:
-            parts.append(f"node[\"{k}\"=\"{v}\"](around:{radius_m},{lat},{lon});")
-    if not parts:
-        return []
-    query = "[out:json][timeout:8];(" + "".join(parts) + ");out qt 20;"
-    if remaining_budget < 1.0:
-        return []
-    timeout = 2.0 if remaining_budget >= 2.5 else max(0.5, remaining_budget*0.6)
-    try:
-        import requests as _rq
-        for attempt in range(3):
-            try:
-                resp = _rq.post(OVERPASS_URL, data={"data": query}, timeout=timeout, headers={"User-Agent": "PlayPlan/0.1 (+github)"})
-                if resp.status_code != 200:
-                    raise RuntimeError(f"status {resp.status_code}")
-                js = resp.json()
-                names = []
-                for el in js.get("elements", []):
-                    tg = el.get("tags") or {}
-                    name = tg.get("name:ja") or tg.get("name")
-                    if name and name not in names:
-                        names.append(name)
-                    if len(names) >= 8:
-                        break
-                cache[key] = (time.time(), names)
-                return names
-            except Exception:
-                time.sleep(0.25 * (attempt + 1))
-        return []
-    except Exception as e:
-        app.logger.debug("poi fetch failed: %s", e.__class__.__name__)
-        return []
+        try:
+            resp = HTTP.post(OVERPASS_URL, data={"data": query}, timeout=min(timeout, max(0.5, remain)),
+                             headers=OVERPASS_HEADERS)
+            if resp.status_code != 200:
+                raise RuntimeError(f"status {resp.status_code}")
+            elements = resp.json().get("elements", [])
+            breaker.success()
+            return elements
+        except Exception as e:
+            last_err = e
+            breaker.failure()
+            time.sleep(min(0.25 * (attempt + 1), max(0.0, deadline_at - time.time())))
+    app.logger.debug("Overpass failed: %s", last_err)
+    return None
+
+
+# ---------------- POI タイルキャッシュ (geohash) ----------------
+# Overpass の結果を geohash タイル × OSM 特徴 (k, v) 単位で保持し、任意の
+# (lat, lon, radius, features) 問い合わせを被覆タイルのメモリ内フィルタで答える。
+# 150m 離れた利用者同士でも同じタイルを共有し、欠けたタイルだけを Overpass から取る。
+POI_TILE_PRECISION = int(os.environ.get("POI_TILE_PRECISION", 6))  # 6桁 ≈ 1.2km x 0.6km
+POI_TILE_MAX = int(os.environ.get("POI_TILE_MAX", 64))  # 1 問い合わせの被覆タイル上限 (超えたら桁を下げる)
+POI_TILE_TTL = float(os.environ.get("POI_TILE_TTL", 3600))
+POI_TILE_CACHE_SIZE = int(os.environ.get("POI_TILE_CACHE_SIZE", 20000))  # (タイル, 特徴) エントリ数
+
+_GEOHASH32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lon: float, precision: int) -> str:
+    lat_lo, lat_hi, lon_lo, lon_hi = -90.0, 90.0, -180.0, 180.0
+    out, bits, ch, even = [], 0, 0, True
+    while len(out) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            ch = (ch << 1) | (lon >= mid)
+            lon_lo, lon_hi = (mid, lon_hi) if lon >= mid else (lon_lo, mid)
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            ch = (ch << 1) | (lat >= mid)
+            lat_lo, lat_hi = (mid, lat_hi) if lat >= mid else (lat_lo, mid)
+        even = not even
+        bits += 1
+        if bits == 5:
+            out.append(_GEOHASH32[ch])
+            bits, ch = 0, 0
+    return "".join(out)
+
+
+def geohash_bbox(gh: str):
+    """geohash セルの (south, west, north, east)。"""
+    lat_lo, lat_hi, lon_lo, lon_hi = -90.0, 90.0, -180.0, 180.0
+    even = True
+    for c in gh:
+        v = _GEOHASH32.index(c)
+        for shift in range(4, -1, -1):
+            bit = (v >> shift) & 1
+            if even:
+                mid = (lon_lo + lon_hi) / 2
+                lon_lo, lon_hi = (mid, lon_hi) if bit else (lon_lo, mid)
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                lat_lo, lat_hi = (mid, lat_hi) if bit else (lat_lo, mid)
+            even = not even
+    return lat_lo, lon_lo, lat_hi, lon_hi
+
 
-def augment_candidates_with_places(candidates, lat: float, lon: float, radius_m: int, time_budget: float):
-    """candidates (list[dict]) に places 情報を付与。
-    - 重いので 1 回の Overpass クエリ (max 3カテゴリ) にまとめ近傍POI を取得し分類。
-    - 返却: 変更済 candidates
-    - 失敗時は何もしない
+def _tiles_covering(lat: float, lon: float, radius_m: float, precision: int):
+    """半径 radius_m の円の外接矩形を覆う geohash タイル (重複なし)。"""
+    dlat = radius_m / 111320.0
+    dlon = radius_m / (111320.0 * max(0.01, math.cos(math.radians(lat))))
+    s0, w0, n0, e0 = geohash_bbox(geohash_encode(max(-89.999, lat - dlat), max(-179.999, lon - dlon), precision))
+    h, w = n0 - s0, e0 - w0
+    tiles = []
+    y = s0 + h / 2
+    while y - h / 2 <= min(89.999, lat + dlat):
+        x = w0 + w / 2
+        while x - w / 2 <= min(179.999, lon + dlon):
+            tiles.append(geohash_encode(y, x, precision))
+            x += w
+        y += h
+    return list(dict.fromkeys(tiles))
+
+
+class PoiTileCache:
+    """geohash タイル × OSM 特徴 単位の POI キャッシュ。
+    各エントリは (elements, lats, lons) で、lats/lons は距離フィルタ用の NumPy 配列。
     """
-    start = time.time()
-    if not candidates or time_budget <= 0:
-        return candidates
-    # 抽出したいタグ集合
-    wanted = []
-    for c in candidates:
-        for t in c.get("tags", []):
-            if t in TAG_TO_OSM_FEATURES and t not in wanted:
-                wanted.append(t)
-            if len(wanted) >= 3:
+
+    def __init__(self, maxsize: int = POI_TILE_CACHE_SIZE, ttl: float = POI_TILE_TTL):
+        self.cache = LRUTTLCache(maxsize, ttl)
+        self.fetches = 0
+        self.tiles_fetched = 0
+
+    def plan(self, lat: float, lon: float, radius_m: float):
+        """被覆タイル。タイル数が POI_TILE_MAX を超える間は精度を 1 桁ずつ下げる。"""
+        precision = POI_TILE_PRECISION
+        tiles = _tiles_covering(lat, lon, radius_m, precision)
+        while len(tiles) > POI_TILE_MAX and precision > 1:
+            precision -= 1
+            tiles = _tiles_covering(lat, lon, radius_m, precision)
+        return tiles
+
+    @staticmethod
+    def build_query(missing):
+        """欠けている (tile, (k, v)) を 1 つの Overpass クエリ (bbox 句の和) にまとめる。"""
+        parts = []
+        for tile, (k, v) in missing:
+            s, w, n, e = geohash_bbox(tile)
+            parts.append(f"node[\"{k}\"=\"{v}\"]({s:.6f},{w:.6f},{n:.6f},{e:.6f});")
+        return "[out:json][timeout:8];(" + "".join(parts) + ");out qt;"
+
+    def _store(self, missing, elements):
+        """取得結果をタイル × 特徴へ振り分けて格納 (0 件のタイルも空として記録)。"""
+        buckets = {key: [] for key in missing}
+        precisions = {len(tile) for tile, _ in missing}
+        for el in elements or []:
+            lat_p, lon_p = _element_latlon(el)
+            if lat_p is None or lon_p is None:
+                continue
+            tags = el.get("tags") or {}
+            for p in precisions:
+                tile = geohash_encode(lat_p, lon_p, p)
+                for kv in tags.items():
+                    if (tile, kv) in buckets:
+                        buckets[(tile, kv)].append(el)
+        for key, els in buckets.items():
+            coords = [_element_latlon(el) for el in els]
+            lats = np.array([c[0] for c in coords], dtype=np.float64)
+            lons = np.array([c[1] for c in coords], dtype=np.float64)
+            self.cache.put(key, (els, lats, lons))
+
+    def lookup(self, lat: float, lon: float, radius_m: float, features):
+        """被覆タイル × 特徴 を手持ち (have: key → entry) と欠け (missing: key 列) に分ける。"""
+        features = list(dict.fromkeys(features))
+        have, missing = {}, []
+        for tile in self.plan(lat, lon, radius_m):
+            for kv in features:
+                entry = self.cache.get((tile, kv))
+                if entry is None:
+                    missing.append((tile, kv))
+                else:
+                    have[(tile, kv)] = entry
+        return have, missing
+
+    def fill(self, missing, elements, have):
+        """取得した elements を格納し、have に欠けていた分を足す。"""
+        self.tiles_fetched += len(missing)
+        self._store(missing, elements)
+        for key in missing:
+            entry = self.cache.get(key)
+            if entry is not None:
+                have[key] = entry
+
+    @staticmethod
+    def answer(lat: float, lon: float, radius_m: float, have):
+        """手持ちタイルから半径内の要素 (type, id で重複排除) と距離 km 配列。"""
+        out, dists, seen = [], [], set()
+        radius_km = radius_m / 1000.0
+        for els, lats, lons in have.values():
+            if not els:
+                continue
+            d = _haversine_km(lat, lon, lats, lons)
+            for i in np.flatnonzero(d <= radius_km):
+                el = els[i]
+                ident = (el.get("type", "node"), el.get("id"))
+                if ident in seen:
+                    continue
+                seen.add(ident)
+                out.append(el)
+                dists.append(d[i])
+        return out, np.asarray(dists, dtype=np.float64)
+
+    def query(self, lat: float, lon: float, radius_m: float, features, timeout: float = 2.0, deadline_at: float = None):
+        """半径内の POI 要素と距離 km を返す: (elements, dist_km 配列, complete)。
+        欠けたタイルは 1 回の Overpass 呼び出しで補う。取得失敗時は手持ちのタイルだけで答え complete=False。"""
+        have, missing = self.lookup(lat, lon, radius_m, features)
+        complete = True
+        if missing:
+            elements = None
+            if deadline_at is None or deadline_at - time.time() > 0:
+                self.fetches += 1
+                elements = _overpass_fetch(self.build_query(missing), timeout,
+                                           deadline_at if deadline_at is not None else time.time() + timeout * 3)
+            if elements is None:
+                complete = False
+            else:
+                self.fill(missing, elements, have)
+        out, dists = self.answer(lat, lon, radius_m, have)
+        return out, dists, complete
+
+    def stats(self) -> dict:
+        s = self.cache.stats()
+        s["overpass_fetches"] = self.fetches
+        s["tiles_fetched"] = self.tiles_fetched
+        return s
+
+
+POI_TILES = PoiTileCache()
+
+
+def _features_for_tags(tags):
+    """アプリのタグ列 → OSM 特徴 (k, v) 列。"""
+    return [kv for t in tags for kv in TAG_TO_OSM_FEATURES.get(t, [])]
+
+
+# ---------------- オフライン POI ストア (OSM 抽出) ----------------
+# ingest_osm.py が .osm.pbf / Overpass JSON ダンプから作る列指向ストア。
+# 対象範囲と特徴を網羅する問い合わせは Overpass を呼ばずにここで答える。
+POI_STORE_PATH = os.environ.get("POI_STORE_PATH", "pois.npz")
+POI_STORE_CELL_DEG = float(os.environ.get("POI_STORE_CELL_DEG", 0.01))  # 格子セル ≈ 1.1km
+# 0 にすると Overpass を一切呼ばない (ストア / キャッシュ済みタイルのみで答える)
+POI_OVERPASS = os.environ.get("POI_OVERPASS", "1") != "0"
+# POI ステージが使える残り時間の割合 (残りは生成に取っておく。Overpass 障害時のリトライで締切を食い潰さない)
+POI_BUDGET_SHARE = float(os.environ.get("POI_BUDGET_SHARE", 0.6))
+
+_OSM_TYPES = ("node", "way", "relation")
+
+
+def _element_latlon(el):
+    """node は lat/lon、way / relation は center。0.0 (赤道 / 本初子午線) も有効な座標として扱う。"""
+    center = el.get("center") or {}
+    lat_p = el.get("lat") if el.get("lat") is not None else center.get("lat")
+    lon_p = el.get("lon") if el.get("lon") is not None else center.get("lon")
+    return lat_p, lon_p
+
+
+class PoiStore:
+    """POI の列指向ストア + 緯度経度格子の空間インデックス。
+    ファイル形式 (np.savez, v1):
+      features          "k=v" 文字列配列 (ビット位置 = 添字, 最大 64)
+      lat, lon          float64[rows]
+      osm_type, osm_id  uint8[rows] (_OSM_TYPES の添字), int64[rows]
+      mask              uint64[rows] 一致する特徴のビット集合
+      name_blob, name_off  UTF-8 連結名 と int64[rows+1] オフセット
+      cell_keys, cell_start  行は格子キー順に並び、cell_keys[i] の行が [cell_start[i], cell_start[i+1])
+      bbox, cell_deg    収録範囲 (south, west, north, east) と格子幅
+    """
+
+    VERSION = 1
+
+    def __init__(self, features, lat, lon, osm_type, osm_id, mask, name_blob, name_off,
+                 cell_keys, cell_start, bbox, cell_deg: float, path: str = None):
+        self.features = [tuple(f.split("=", 1)) for f in features]
+        self.bits = {kv: np.uint64(1) << np.uint64(i) for i, kv in enumerate(self.features)}
+        self.lat, self.lon = lat, lon
+        self.osm_type, self.osm_id, self.mask = osm_type, osm_id, mask
+        self.name_blob, self.name_off = name_blob, name_off
+        self.cell_keys, self.cell_start = cell_keys, cell_start
+        self.bbox = tuple(float(x) for x in bbox)
+        self.cell_deg = float(cell_deg)
+        self.path = path
+        self.queries = 0
+
+    def __len__(self):
+        return self.lat.shape[0]
+
+    @staticmethod
+    def _cell_keys(lat, lon, cell_deg: float):
+        iy = np.floor((np.asarray(lat) + 90.0) / cell_deg).astype(np.int64)
+        ix = np.floor((np.asarray(lon) + 180.0) / cell_deg).astype(np.int64)
+        return (iy << 32) | ix
+
+    @classmethod
+    def from_elements(cls, elements, features=None, cell_deg: float = POI_STORE_CELL_DEG, bbox=None):
+        """Overpass 形式の要素列 (node / way+center) からストアを作る。
+        名前が無い要素・features のどれにも一致しない要素は捨てる。同じ (type, id) は 1 行にまとめる。"""
+        if features is None:
+            features = list(dict.fromkeys(kv for kvs in TAG_TO_OSM_FEATURES.values() for kv in kvs))
+        if len(features) > 64:
+            raise ValueError("at most 64 features per store")
+        bit = {kv: 1 << i for i, kv in enumerate(features)}
+        rows, seen = [], set()
+        for el in elements:
+            tags = el.get("tags") or {}
+            name = tags.get("name:ja") or tags.get("name")
+            lat_p, lon_p = _element_latlon(el)
+            if not name or lat_p is None or lon_p is None:
+                continue
+            m = 0
+            for kv in tags.items():
+                m |= bit.get(kv, 0)
+            ident = (el.get("type", "node"), el.get("id"))
+            if not m or ident in seen or ident[0] not in _OSM_TYPES:
+                continue
+            seen.add(ident)
+            rows.append((float(lat_p), float(lon_p), _OSM_TYPES.index(ident[0]), int(ident[1] or 0), m, name))
+        lat = np.array([r[0] for r in rows], dtype=np.float64)
+        lon = np.array([r[1] for r in rows], dtype=np.float64)
+        keys = cls._cell_keys(lat, lon, cell_deg)
+        order = np.argsort(keys, kind="stable")
+        rows = [rows[i] for i in order]
+        keys = keys[order]
+        names = [r[5].encode("utf-8") for r in rows]
+        name_off = np.zeros(len(rows) + 1, dtype=np.int64)
+        name_off[1:] = np.cumsum([len(b) for b in names])
+        cell_keys, first = np.unique(keys, return_index=True)
+        cell_start = np.append(first, len(rows)).astype(np.int64)
+        if bbox is None:
+            bbox = ((lat.min(), lon.min(), lat.max(), lon.max()) if rows else (0.0, 0.0, 0.0, 0.0))
+        return cls([f"{k}={v}" for k, v in features], lat[order], lon[order],
+                   np.array([r[2] for r in rows], dtype=np.uint8), np.array([r[3] for r in rows], dtype=np.int64),
+                   np.array([r[4] for r in rows], dtype=np.uint64),
+                   np.frombuffer(b"".join(names), dtype=np.uint8), name_off,
+                   cell_keys.astype(np.int64), cell_start, bbox, cell_deg)
+
+    def save(self, path: str):
+        _atomic_write(path, lambda f: np.savez(
+            f, version=self.VERSION, features=np.array([f"{k}={v}" for k, v in self.features]),
+            lat=self.lat, lon=self.lon, osm_type=self.osm_type, osm_id=self.osm_id, mask=self.mask,
+            name_blob=self.name_blob, name_off=self.name_off, cell_keys=self.cell_keys,
+            cell_start=self.cell_start, bbox=np.array(self.bbox), cell_deg=self.cell_deg))
+        self.path = path
+        return path
+
+    @classmethod
+    def load(cls, path: str):
+        """保存済みストアを開く。形式が異なれば ValueError。"""
+        with np.load(path) as z:
+            if int(z["version"]) != cls.VERSION:
+                raise ValueError(f"{path}: unsupported POI store version {int(z['version'])}")
+            return cls(list(z["features"]), z["lat"], z["lon"], z["osm_type"], z["osm_id"], z["mask"],
+                       z["name_blob"], z["name_off"], z["cell_keys"], z["cell_start"], z["bbox"],
+                       float(z["cell_deg"]), path=path)
+
+    def covers(self, lat: float, lon: float, radius_m: float, features) -> bool:
+        """円の外接矩形が収録範囲内で、要求特徴をすべて収録していれば True。"""
+        dlat = radius_m / 111320.0
+        dlon = radius_m / (111320.0 * max(0.01, math.cos(math.radians(lat))))
+        s, w, n, e = self.bbox
+        return (s <= lat - dlat and lat + dlat <= n and w <= lon - dlon and lon + dlon <= e
+                and all(kv in self.bits for kv in features))
+
+    def query(self, lat: float, lon: float, radius_m: float, features):
+        """PoiTileCache.query と同じ形 (elements, dist_km 配列, complete) で答える。"""
+        self.queries += 1
+        want = np.uint64(0)
+        for kv in features:
+            want |= self.bits.get(kv, np.uint64(0))
+        dlat = radius_m / 111320.0
+        dlon = radius_m / (111320.0 * max(0.01, math.cos(math.radians(lat))))
+        lo = self._cell_keys([lat - dlat], [lon - dlon], self.cell_deg)[0]
+        hi = self._cell_keys([lat + dlat], [lon + dlon], self.cell_deg)[0]
+        ix0, ix1 = lo & 0xFFFFFFFF, hi & 0xFFFFFFFF
+        spans = []
+        # 行はキー順 = 緯度帯ごとに経度順なので、帯 1 本が 1 つの連続区間になる
+        for iy in range(lo >> 32, (hi >> 32) + 1):
+            a = np.searchsorted(self.cell_keys, (iy << 32) | ix0, side="left")
+            b = np.searchsorted(self.cell_keys, (iy << 32) | ix1, side="right")
+            if a < b:
+                spans.append(np.arange(self.cell_start[a], self.cell_start[b]))
+        if not spans or not want:
+            return [], np.empty(0), True
+        rows = np.concatenate(spans)
+        rows = rows[(self.mask[rows] & want) != 0]
+        d = _haversine_km(lat, lon, self.lat[rows], self.lon[rows])
+        keep = d <= radius_m / 1000.0
+        return [self.element(int(r)) for r in rows[keep]], d[keep], True
+
+    def element(self, r: int) -> dict:
+        """行 r を Overpass 形式の要素 dict に戻す (tags は一致特徴 + name)。"""
+        m = int(self.mask[r])
+        tags = {k: v for i, (k, v) in enumerate(self.features) if m >> i & 1}
+        tags["name"] = bytes(self.name_blob[self.name_off[r]:self.name_off[r + 1]]).decode("utf-8")
+        return {"type": _OSM_TYPES[int(self.osm_type[r])], "id": int(self.osm_id[r]),
+                "lat": float(self.lat[r]), "lon": float(self.lon[r]), "tags": tags}
+
+    def stats(self) -> dict:
+        return {"rows": len(self), "features": len(self.features), "bbox": list(self.bbox),
+                "queries": self.queries, "path": self.path}
+
+
+def _load_poi_store():
+    if POI_STORE_PATH and os.path.exists(POI_STORE_PATH):
+        try:
+            return PoiStore.load(POI_STORE_PATH)
+        except Exception as e:
+            app.logger.warning("POI store open failed: %s", e)
+    return None
+
+
+POI_STORE = _load_poi_store()
+
+
+def _mapped_tags(tags, limit: int = 3):
+    """TAG_TO_OSM_FEATURES に対応するタグを出現順に最大 limit 件 (重複なし)。"""
+    out = []
+    for t in tags:
+        if t in TAG_TO_OSM_FEATURES and t not in out:
+            out.append(t)
+            if len(out) >= limit:
                 break
-        if len(wanted) >= 3:
+    return out
+
+
+def poi_tags_for(rule_tags, candidates):
+    """1 リクエストで必要な POI カテゴリ: (near_pois 用 = ルールタグ, places 用 = 候補タグ)。"""
+    near = _mapped_tags(rule_tags or [])
+    place = _mapped_tags(t for c in candidates or [] for t in c.get("tags", []))
+    return tuple(near), tuple(place)
+
+
+def fetch_pois(lat: float, lon: float, radius_m: int, near_tags, place_tags, remaining_budget: float):
+    """near_pois と candidates[].places の両方に要る POI を POI_TILES から 1 回で取得。
+    - radius_m は 200〜5000 にクリップ (places 側は attach_places が 4000 に絞る)。
+    - 特徴は near_tags ∪ place_tags。欠けたタイルのみ Overpass 1 回 (リトライは _overpass_fetch の 3 回)。
+    - POI_STORE (オフライン OSM 抽出) が範囲と特徴を網羅していれば Overpass を呼ばずにそこで答える。
+    - 取得に 1 秒未満しか残っていなければキャッシュ済みタイルだけで答える。
+    返却: (elements, dist_km 配列, complete)。
+    """
+    tags = list(dict.fromkeys(list(near_tags) + list(place_tags)))
+    if not tags:
+        return [], np.empty(0), True
+    radius_m, features, timeout, deadline_at = _poi_fetch_plan(radius_m, tags, remaining_budget)
+    from_store = _poi_store_answer(lat, lon, radius_m, features)
+    if from_store is not None:
+        return from_store
+    return POI_TILES.query(lat, lon, radius_m, features, timeout, deadline_at)
+
+
+def poi_budget(deadline) -> float:
+    """POI 取得に渡す予算: 締切までの残り × POI_BUDGET_SHARE。"""
+    return max(0.0, deadline.remaining()) * POI_BUDGET_SHARE
+
+
+def _poi_fetch_plan(radius_m: int, tags, remaining_budget: float):
+    """(クリップ済み半径, OSM 特徴, Overpass タイムアウト, 取得締切)。
+    Overpass 無効時 / 取得に 1 秒未満しか残っていなければ締切を今にしてキャッシュ済みタイルだけで答えさせる。"""
+    radius_m = int(min(max(radius_m, 200), 5000))
+    timeout = 2.0 if remaining_budget >= 2.5 else max(0.5, remaining_budget*0.6)
+    deadline_at = time.time() + (remaining_budget if remaining_budget >= 1.0 and POI_OVERPASS else 0.0)
+    return radius_m, _features_for_tags(tags), timeout, deadline_at
+
+
+def _poi_store_answer(lat: float, lon: float, radius_m: int, features):
+    """POI_STORE で答えるなら (elements, dists, complete)、Overpass 側に回すなら None。"""
+    if POI_STORE is None:
+        return None
+    covered = POI_STORE.covers(lat, lon, radius_m, features)
+    if not covered and POI_OVERPASS:
+        return None
+    elements, dists, _ = POI_STORE.query(lat, lon, radius_m, features)
+    return elements, dists, covered
+
+
+def _element_name(el):
+    tg = el.get("tags") or {}
+    return tg.get("name:ja") or tg.get("name")
+
+
+def _matches_tag(el, tag) -> bool:
+    tg = el.get("tags") or {}
+    return any(tg.get(k) == v for k, v in TAG_TO_OSM_FEATURES.get(tag, []))
+
+
+def nearest_poi_names(elements, dists, tags, radius_m: int, limit: int = 8):
+    """tags のいずれかに一致する半径内 POI 名 (近い順, 重複なし, 最大 limit 件)。"""
+    radius_km = min(max(radius_m, 200), 5000) / 1000.0
+    names = []
+    for i in np.argsort(dists, kind="stable"):
+        if dists[i] > radius_km:
             break
-    if not wanted:
-        return candidates
-    radius_m = int(min(max(radius_m, 200), 4000))
-    parts = []
-    for tag in wanted:
-        for k,v in TAG_TO_OSM_FEATURES[tag]:
-            parts.append(f"node[\"{k}\"=\"{v}\"](around:{radius_m},{lat},{lon});")
-    query = "[out:json][timeout:8];(" + "".join(parts) + ");out center qt 40;"
-    key = (round(lat,3), round(lon,3), radius_m//100, tuple(sorted(wanted)))
-    cache = globals().setdefault("_POI_DETAIL_CACHE", {})
-    now = time.time()
-    cached = cache.get(key)
-    if cached and now - cached[0] < 600:
-        elements = cached[1]
+        el = elements[i]
+        name = _element_name(el)
+        if name and name not in names and any(_matches_tag(el, t) for t in tags):
+            names.append(name)
+            if len(names) >= limit:
+                break
+    return names
+
+
+PLACES_PER_CANDIDATE = 3
+
+
+def _nearest_rows(rows, dists, names, k: int):
+    """rows (要素添字) のうち近い順に、名前の異なる最大 k 件。
+    argpartition で上位 k だけを取り出し、同名 (チェーン店等) で k に満たないときだけ全体を整列する。"""
+    d = dists[rows]
+    if rows.shape[0] > k:
+        top = np.argpartition(d, k - 1)[:k]
+        top = top[np.argsort(d[top], kind="stable")]
+        if len({names[r] for r in rows[top]}) < k:
+            top = np.argsort(d, kind="stable")
     else:
-        try:
-            import requests as _rq
-            remain = time_budget - (time.time() - start)
-            if remain <= 0:
-                return candidates
-            # retries
-            last_err = None
-            for attempt in range(3):
-                try:
-                    resp = _rq.post(OVERPASS_URL, data={"data": query}, timeout=min(2.0, max(0.5, remain)), headers={"User-Agent": "PlayPlan/0.1 (+github)"})
-                    if resp.status_code != 200:
-                        raise RuntimeError(f"status {resp.status_code}")
-                    js = resp.json()
-                    elements = js.get("elements", [])
-                    cache[key] = (time.time(), elements)
-                    break
-                except Exception as e:
-                    last_err = e
-                    time.sleep(0.25 * (attempt + 1))
-            else:
-                app.logger.debug("augment Overpass failed: %s", last_err)
-                return candidates
-        except Exception as e:
-            app.logger.debug("augment request error: %s", e.__class__.__name__)
-            return candidates
-    # ユーティリティ: 距離
-    def _dist_km(lat1, lon1, lat2, lon2):
-        R = 6371.0
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-        return 2 * R * math.asin(math.sqrt(a))
-    # 先に POI をタグ毎に分類
-    bucket = {t: [] for t in wanted}
-    for el in elements:
-        tags = el.get("tags") or {}
-        name = tags.get("name:ja") or tags.get("name")
-        if not name:
-            continue
-        lat_p = el.get("lat") or (el.get("center") or {}).get("lat")
-        lon_p = el.get("lon") or (el.get("center") or {}).get("lon")
-        if lat_p is None or lon_p is None:
+        top = np.argsort(d, kind="stable")
+    out, seen = [], set()
+    for r in rows[top]:
+        if names[r] not in seen:
+            seen.add(names[r])
+            out.append(int(r))
+            if len(out) >= k:
+                break
+    return out
+
+
+def attach_places(candidates, elements, dists, tags, radius_m: int):
+    """candidates (list[dict]) に places 情報を付与 (その場で変更し返す)。
+    - tags (最大3カテゴリ) ごとに半径内 (200〜4000 にクリップ) の POI を分類し、
+      カテゴリ毎に近い順の上位 PLACES_PER_CANDIDATE 件を選ぶ (1 要素は最初に一致したカテゴリのみ)。
+    - 各 candidate には自身のタグ順に、名前の重複を除いて最大 PLACES_PER_CANDIDATE 件。
+    """
+    radius_km = min(max(radius_m, 200), 4000) / 1000.0
+    dists = np.asarray(dists, dtype=np.float64)
+    names = [None] * len(elements)
+    # 半径内の要素毎に最初に一致したカテゴリ (-1 = 対象外)
+    category = np.full(len(elements), -1, dtype=np.int64)
+    matched_kv = [None] * len(elements)
+    for i in np.flatnonzero(dists <= radius_km):
+        el = elements[i]
+        names[i] = _element_name(el)
+        if not names[i] or _element_latlon(el)[0] is None:
             continue
-        for t in wanted:
-            for k,v in TAG_TO_OSM_FEATURES[t]:
-                if tags.get(k) == v:
-                    bucket[t].append({
-                        "name": name,
-                        "lat": lat_p,
-                        "lon": lon_p,
-                        "distance_km": round(_dist_km(lat, lon, lat_p, lon_p), 3),
-                        "tags": {k: v},
-                        "osm_url": f"https://www.openstreetmap.org/{el.get('type','node')}/{el.get('id')}"
-                    })
-                    break
-            # マッチ1カテゴリのみ登録
-            if bucket[t] and bucket[t][-1]["name"] == name:
+        el_tags = el.get("tags") or {}
+        for ti, t in enumerate(tags):
+            kv = next(((k, v) for k, v in TAG_TO_OSM_FEATURES[t] if el_tags.get(k) == v), None)
+            if kv is not None:
+                category[i], matched_kv[i] = ti, kv
                 break
-    # 各 candidate に places を紐付け (最大3件)
+
+    def _place(i):
+        el = elements[i]
+        lat_p, lon_p = _element_latlon(el)
+        k, v = matched_kv[i]
+        return {
+            "name": names[i],
+            "lat": lat_p,
+            "lon": lon_p,
+            "distance_km": round(float(dists[i]), 3),
+            "tags": {k: v},
+            "osm_url": f"https://www.openstreetmap.org/{el.get('type','node')}/{el.get('id')}"
+        }
+
+    bucket = {}
+    for ti, t in enumerate(tags):
+        rows = np.flatnonzero(category == ti)
+        bucket[t] = [_place(i) for i in _nearest_rows(rows, dists, names, PLACES_PER_CANDIDATE)] if rows.size else []
+    # 各 candidate に places を紐付け
     for c in candidates:
-        c_tags = c.get("tags", [])
-        places = []
-        for t in c_tags:
-            if t in bucket and bucket[t]:
-                for p in bucket[t]:
-                    if len(places) >= 3:
-                        break
-                    if p["name"] not in {pl["name"] for pl in places}:
-                        places.append(p)
-            if len(places) >= 3:
+        places, seen = [], set()
+        for t in c.get("tags", []):
+            for p in bucket.get(t, ()):
+                if len(places) >= PLACES_PER_CANDIDATE:
+                    break
+                if p["name"] not in seen:
+                    seen.add(p["name"])
+                    places.append(p)
+            if len(places) >= PLACES_PER_CANDIDATE:
                 break
         c["places"] = places
         # id が無ければ簡易スラグ
@@ -507,6 +2172,1026 @@ def augment_candidates_with_places(candidates, lat: float, lon: float, radius_m:
             c["id"] = c.get("name", "").strip().replace(" ", "_")[:40]
     return candidates
 
+# ------------------------------------------------------------
+# リクエスト締切 & ステージグラフ
+# 互いに独立な上流呼び出し (天気 / POI / 埋め込み) を同時に開始し、
+# 依存が揃ったステージから順に共有プールで実行する。全ステージは 1 つの締切を共有。
+# ------------------------------------------------------------
+class Deadline:
+    """1リクエストで共有する締切 (BUDGET_SECONDS 起点)。"""
+
+    def __init__(self, budget: float = None, start: float = None):
+        self.start = time.time() if start is None else start
+        self.at = self.start + (BUDGET_SECONDS if budget is None else budget)
+
+    def remaining(self) -> float:
+        return self.at - time.time()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def elapsed(self) -> float:
+        return time.time() - self.start
+
+
+_NO_DEFAULT = object()
+
+
+class StageGraph:
+    """依存関係付きステージを _STAGE_EXECUTOR 上で実行する小さな DAG。
+    - add(name, fn, deps): deps の結果を引数に fn を実行。依存が無ければ即開始。
+    - 依存ステージ待ちでワーカースレッドを塞がないよう、完了コールバックで起動する。
+    - result(name): 締切まで待つ。締切超過は TimeoutError、失敗は例外 (default 指定時はそれを返す)。
+    """
+
+    def __init__(self, deadline: Deadline):
+        self.deadline = deadline
+        self._futures = {}
+
+    def add(self, name: str, fn, deps=()):
+        fut = concurrent.futures.Future()
+        dep_futs = [self._futures[d] for d in deps]
+        self._futures[name] = fut
+
+        def _run():
+            if not fut.set_running_or_notify_cancel():
+                return
+            try:
+                fut.set_result(fn(*[d.result() for d in dep_futs]))
+            except BaseException as e:  # 依存の失敗もそのまま伝播
+                fut.set_exception(e)
+
+        if not dep_futs:
+            _STAGE_EXECUTOR.submit(_run)
+            return fut
+        pending = [len(dep_futs)]
+        lock = threading.Lock()
+
+        def _on_dep_done(_):
+            with lock:
+                pending[0] -= 1
+                ready = pending[0] == 0
+            if ready:
+                _STAGE_EXECUTOR.submit(_run)
+
+        for d in dep_futs:
+            d.add_done_callback(_on_dep_done)
+        return fut
+
+    def has(self, name: str) -> bool:
+        return name in self._futures
+
+    def result(self, name: str, default=_NO_DEFAULT):
+        try:
+            return self._futures[name].result(timeout=max(0.0, self.deadline.remaining()))
+        except concurrent.futures.TimeoutError:
+            if default is _NO_DEFAULT:
+                raise
+            return default
+        except Exception:
+            if default is _NO_DEFAULT:
+                raise
+            return default
+
+
+def _ensure_client() -> bool:
+    """Gemini クライアントを遅延初期化。利用不可 (キー未設定 / 初期化失敗) なら False。"""
+    global client
+    if client is not None:
+        return True
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        return False
+    try:
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        client = genai
+        return True
+    except Exception as e:
+        app.logger.warning("gemini init failed: %s", e.__class__.__name__)
+        return False
+
+
+# ---------------- 天気キャッシュ (single-flight + stale-while-revalidate) ----------------
+# (round(lat,2), round(lon,2)) セル単位。同じセルの同時取得は 1 本にまとめ、
+# TTL 切れ後も WEATHER_CACHE_STALE 秒までは古い値を返しつつ裏で更新する。
+WEATHER_CACHE_TTL = float(os.environ.get("WEATHER_CACHE_TTL", 600))  # 10分
+WEATHER_CACHE_STALE = float(os.environ.get("WEATHER_CACHE_STALE", 1800))  # TTL 後に古い値を返してよい秒数
+WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", 4096))
+# 取得から何秒までは再取得せず、キャッシュ済み hourly 予報から「現在」を導出するか (weather_at)
+WEATHER_HOURLY_HORIZON = float(os.environ.get("WEATHER_HOURLY_HORIZON", 3 * 3600))
+
+
+def _weather_cell(lat: float, lon: float):
+    return (round(lat, 2), round(lon, 2))
+
+
+def _fetch_weather_with_retry(lat: float, lon: float, deadline: Deadline):
+    """fetch_weather + 簡易リトライ (3回, 待ちは締切まで)。(weather, ok) を返す。
+    BREAKERS["open_meteo"] が open なら呼ばずに失敗扱い。"""
+    breaker = BREAKERS["open_meteo"]
+    try:
+        last_err = None
+        for attempt in range(3):
+            if not breaker.allow():
+                return {"current": {}, "_error": "weather_failed:circuit_open"}, False
+            try:
+                weather = fetch_weather(lat, lon)
+                breaker.success()
+                break
+            except requests.RequestException as e:
+                last_err = e
+                breaker.failure()
+                time.sleep(min(0.3 * (attempt + 1), max(0.0, deadline.remaining())))
+        else:
+            return {"current": {}, "_error": f"weather_failed:{last_err}"}, False
+    except Exception as e:
+        breaker.failure()
+        return {"current": {}, "_error": f"weather_failed:{e.__class__.__name__}"}, False
+    if not isinstance(weather, dict) or "current" not in weather:
+        return {"current": {}, "_error": "weather_invalid"}, False
+    return weather, True
+
+
+class WeatherCache:
+    """セル単位の天気キャッシュ。
+    - 新鮮 (ttl 内): そのまま返す。
+    - horizon 内: 保持している hourly 予報から現在時刻の天気を導出して返す (再取得しない)。
+    - 古い (〜max(ttl, horizon)+stale): 古い値 (導出できればその時刻の値) を返し、裏で 1 本だけ更新を走らせる。
+    - 無い / 古すぎる: セル毎に 1 本だけ取得し、同時に来た呼び出しはその結果を待つ。
+    取得失敗はキャッシュしない (古い値があれば残す)。
+    """
+
+    def __init__(self, maxsize: int = WEATHER_CACHE_SIZE, ttl: float = WEATHER_CACHE_TTL,
+                 stale: float = WEATHER_CACHE_STALE, horizon: float = WEATHER_HOURLY_HORIZON):
+        self.ttl = float(ttl)
+        self.horizon = float(horizon)
+        self.cache = LRUTTLCache(maxsize, max(self.ttl, self.horizon) + float(stale))  # 値は (fetched_at, weather)
+        self._inflight = {}  # key -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.hourly_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _lead(self, key):
+        """key の取得を 1 本だけ始める。返却: (future, 自分が取得役か)。"""
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return fut, False
+            fut = concurrent.futures.Future()
+            self._inflight[key] = fut
+        return fut, True
+
+    def _run(self, key, fut, lat: float, lon: float, deadline: Deadline):
+        try:
+            weather, ok = _fetch_weather_with_retry(lat, lon, deadline)
+            if ok:
+                self.put(key, weather)
+            else:
+                self._count("failures")
+            fut.set_result((weather, not ok))
+        except BaseException as e:  # 待っている呼び出しを取り残さない
+            fut.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    @staticmethod
+    def now_view(weather: dict) -> dict:
+        """予報を「今」の時間帯から見た形にする (weather_at)。導出できなければそのまま。
+        新鮮なヒット・取得直後・相乗りの結果もこれを通し、hourly[0] の意味をキャッシュ年齢に依らず揃える。"""
+        return weather_at(weather) or weather
+
+    def lookup(self, key):
+        """キャッシュ判定 (カウンタ更新込み)。返却: (weather, "fresh" | "stale" | None)。"""
+        entry = self.cache.get(key)
+        if entry is None:
+            self._count("misses")
+            return None, None
+        fetched_at, weather = entry
+        age = time.time() - fetched_at
+        derived = weather_at(weather)
+        if age < self.ttl:
+            self._count("hits")
+            return derived or weather, "fresh"
+        if age < self.horizon and derived is not None:
+            self._count("hourly_hits")
+            return derived, "fresh"
+        self._count("stale_hits")
+        return derived or weather, "stale"
+
+    def refresh(self, key, lat: float, lon: float):
+        """裏で 1 本だけ更新を走らせる (既に取得中なら何もしない)。リクエストの締切には縛られない。"""
+        fut, leader = self._lead(key)
+        if leader:
+            self._count("refreshes")
+            _STAGE_EXECUTOR.submit(self._run, key, fut, lat, lon, Deadline())
+
+    def get(self, lat: float, lon: float, deadline: Deadline):
+        """(weather, degraded) を返す。締切までに取得できなければ concurrent.futures.TimeoutError。"""
+        key = _weather_cell(lat, lon)
+        weather, state = self.lookup(key)
+        if state == "fresh":
+            return weather, False
+        if state == "stale":
+            self.refresh(key, lat, lon)
+            return weather, False
+        if deadline.expired():
+            raise concurrent.futures.TimeoutError("timeout fetching weather")
+        fut, leader = self._lead(key)
+        if leader:
+            self._run(key, fut, lat, lon, deadline)
+        else:
+            self._count("coalesced")
+        weather, degraded = fut.result(timeout=max(0.0, deadline.remaining()))
+        return self.now_view(weather), degraded
+
+    def put(self, key, weather: dict, fetched_at: float = None):
+        self.cache.put(key, (time.time() if fetched_at is None else fetched_at, weather))
+
+    def fresh_until(self, entry) -> float:
+        """エントリ (fetched_at, weather) を再取得せずに答えられる期限 (エポック秒)。"""
+        fetched_at, weather = entry
+        if (weather.get("hourly") or {}).get("time"):
+            return fetched_at + max(self.ttl, self.horizon)
+        return fetched_at + self.ttl
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        s = self.cache.stats()
+        with self._lock:
+            total = self.hits + self.hourly_hits + self.stale_hits + self.misses
+            s.update({
+                "hits": self.hits,
+                "hourly_hits": self.hourly_hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.hourly_hits + self.stale_hits) / total, 4) if total else 0.0,
+                "coalesced": self.coalesced,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "inflight": len(self._inflight),
+            })
+        return s
+
+
+WEATHER_CACHE = WeatherCache()
+
+
+# ---------------- 人気セルの天気先読み ----------------
+# 利用の多いセルを減衰付きカウントで追跡し、キャッシュが切れる前に Open-Meteo の
+# 複数地点リクエスト (latitude=a,b,...) でまとめて更新する。WEATHER_PREWARM=1 のときだけ、
+# 最初の天気ステージ実行時にバックグラウンドスレッドを起動する (import 時には起動しない)。
+WEATHER_PREWARM = os.environ.get("WEATHER_PREWARM", "0") == "1"
+WEATHER_PREWARM_CELLS = int(os.environ.get("WEATHER_PREWARM_CELLS", 300))  # 先読み対象の上位セル数
+WEATHER_PREWARM_INTERVAL = float(os.environ.get("WEATHER_PREWARM_INTERVAL", 60))
+WEATHER_PREWARM_LEAD = float(os.environ.get("WEATHER_PREWARM_LEAD", 180))  # 期限の何秒前から更新するか
+WEATHER_PREWARM_BATCH = int(os.environ.get("WEATHER_PREWARM_BATCH", 50))  # 1 リクエストあたりの地点数
+WEATHER_HOT_HALF_LIFE = float(os.environ.get("WEATHER_HOT_HALF_LIFE", 3600))
+
+
+class HotCellTracker:
+    """セル毎の利用回数を半減期 half_life 秒で減衰させて数える (上限付き)。"""
+
+    def __init__(self, maxsize: int = WEATHER_PREWARM_CELLS * 4, half_life: float = WEATHER_HOT_HALF_LIFE):
+        self.maxsize = max(1, int(maxsize))
+        self.half_life = float(half_life)
+        self._scores = {}  # cell -> (score, updated_at)
+        self._lock = threading.Lock()
+
+    def _decayed(self, score: float, updated_at: float, now: float) -> float:
+        return score * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def touch(self, lat: float, lon: float, now: float = None):
+        now = time.time() if now is None else now
+        cell = _weather_cell(lat, lon)
+        with self._lock:
+            score, ts = self._scores.get(cell, (0.0, now))
+            self._scores[cell] = (self._decayed(score, ts, now) + 1.0, now)
+            if len(self._scores) > self.maxsize:
+                # 下位半分を捨てる (毎回の整列を避ける)
+                ranked = sorted(self._scores.items(), key=lambda kv: self._decayed(*kv[1], now), reverse=True)
+                self._scores = dict(ranked[:self.maxsize // 2 or 1])
+
+    def top(self, n: int, now: float = None):
+        """減衰後スコア上位 n セル (降順)。"""
+        now = time.time() if now is None else now
+        with self._lock:
+            items = list(self._scores.items())
+        items.sort(key=lambda kv: self._decayed(*kv[1], now), reverse=True)
+        return [cell for cell, _ in items[:n]]
+
+    def __len__(self):
+        return len(self._scores)
+
+
+def fetch_weather_many(coords):
+    """複数地点の予報を 1 リクエストで取得 (fetch_weather と同じ変数)。返却: coords と同順の list。"""
+    lats = ",".join(str(lat) for lat, _ in coords)
+    lons = ",".join(str(lon) for _, lon in coords)
+    data = HTTP.get(weather_url(lats, lons), timeout=10).json()
+    # 1 地点のときは配列でなく単一オブジェクトが返る
+    return data if isinstance(data, list) else [data]
+
+
+class WeatherPrewarmer:
+    """人気セルのうち期限が近い / 未取得のものを複数地点リクエストでまとめて更新する。"""
+
+    def __init__(self, cache: WeatherCache, tracker: HotCellTracker, cells: int = WEATHER_PREWARM_CELLS,
+                 lead: float = WEATHER_PREWARM_LEAD, batch: int = WEATHER_PREWARM_BATCH,
+                 interval: float = WEATHER_PREWARM_INTERVAL):
+        self.cache = cache
+        self.tracker = tracker
+        self.cells = cells
+        self.lead = lead
+        self.batch = max(1, batch)
+        self.interval = interval
+        self.runs = 0
+        self.requests = 0
+        self.refreshed = 0
+        self.failures = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def due(self, now: float = None):
+        """更新が必要な人気セル: 未取得、または再取得不要な期間の残りが lead 秒未満。"""
+        now = time.time() if now is None else now
+        out = []
+        for cell in self.tracker.top(self.cells, now):
+            entry = self.cache.cache.peek(cell)
+            if entry is None or self.cache.fresh_until(entry) - now < self.lead:
+                out.append(cell)
+        return out
+
+    def run_once(self, now: float = None) -> int:
+        """1 巡分の先読み。更新したセル数を返す。"""
+        self.runs += 1
+        cells = self.due(now)
+        done = 0
+        for i in range(0, len(cells), self.batch):
+            chunk = cells[i:i + self.batch]
+            self.requests += 1
+            try:
+                results = fetch_weather_many(chunk)
+            except Exception as e:
+                self.failures += 1
+                app.logger.debug("weather prewarm failed: %s", e.__class__.__name__)
+                continue
+            for cell, weather in zip(chunk, results):
+                if isinstance(weather, dict) and "current" in weather:
+                    self.cache.put(cell, weather)
+                    done += 1
+        self.refreshed += done
+        return done
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                app.logger.warning("weather prewarm loop error: %s", e)
+            time.sleep(self.interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="weather-prewarm", daemon=True)
+                self._thread.start()
+
+    def stats(self) -> dict:
+        return {"enabled": self._thread is not None, "tracked_cells": len(self.tracker), "runs": self.runs,
+                "requests": self.requests, "refreshed": self.refreshed, "failures": self.failures}
+
+
+WEATHER_HOT_CELLS = HotCellTracker()
+WEATHER_PREWARMER = WeatherPrewarmer(WEATHER_CACHE, WEATHER_HOT_CELLS)
+
+
+def _weather_stage(lat: float, lon: float, deadline: Deadline):
+    """天気取得ステージ (WEATHER_CACHE 経由)。(weather, degraded) を返す。"""
+    WEATHER_HOT_CELLS.touch(lat, lon)
+    if WEATHER_PREWARM:
+        WEATHER_PREWARMER.start()
+    return WEATHER_CACHE.get(lat, lon, deadline)
+
+
+def _build_query(data: dict, rule_tags) -> str:
+    """埋め込み検索用のクエリ文字列。"""
+    return f"気分:{data.get('mood','')} タグ:{','.join(rule_tags)} 予算:{data.get('budget','未指定')}"
+
+
+def _split_rule_tags(rule_tags):
+    """ルールタグを (絞り込みタグ, 加点タグ) に分ける。HARD_FILTER_TAGS が絞り込み側。"""
+    tag_filter = [t for t in rule_tags if t in HARD_FILTER_TAGS]
+    tag_boost = [t for t in rule_tags if t not in HARD_FILTER_TAGS]
+    return tag_filter or None, tag_boost or None
+
+
+def _query_vec_stage(query: str):
+    """クエリ埋め込みステージ (単位ベクトル)。失敗 / クライアント無しは None (候補なし・意味キャッシュなし)。"""
+    if client is None:
+        return None
+    try:
+        return _embed_query(query)
+    except Exception as e:
+        app.logger.warning("embed query failed: %s %s", e.__class__.__name__, str(e))
+        return None
+
+
+def _candidate_stage(q_unit, rule_tags=(), local_query: str = None):
+    """埋め込み検索で候補アクティビティを取得するステージ (クエリ埋め込みは _query_vec_stage)。
+    ルールタグのうち HARD_FILTER_TAGS は絞り込み、それ以外は加点に使う。
+    カタログとの不整合は _ensure_embeddings がバックグラウンド再構築に回す。
+    Gemini のベクトルが無い / 使えないとき (と LOCAL_EMBED=first)、ストア / インデックスの読み出しに
+    失敗したときは local_query で LOCAL_INDEX を引く。"""
+    tag_filter, tag_boost = _split_rule_tags(rule_tags)
+    if q_unit is not None and LOCAL_EMBED != "first" and _ensure_embeddings():
+        try:
+            return top_k_by_vector(q_unit, 8, tag_filter, tag_boost) or []
+        except Exception as e:
+            app.logger.warning("vector search failed, using local index: %s %s", e.__class__.__name__, str(e))
+    if LOCAL_EMBED == "off" or local_query is None:
+        return []
+    return LOCAL_INDEX.top_k(local_query, 8, tag_filter, tag_boost)
+
+
+def _poi_stage(lat: float, lon: float, radius_km, rule_tags, candidates, deadline: Deadline):
+    """近隣POI と 候補への施設付与 を 1 回の POI 取得で済ませるステージ (埋め込み後, LLM前)。
+    返却: (near_pois, places 付き candidates, failed)。"""
+    near_tags, place_tags = poi_tags_for(rule_tags, candidates)
+    radius_m = int(radius_km * 1000)
+    try:
+        fetched = fetch_pois(lat, lon, radius_m, near_tags, place_tags, poi_budget(deadline))
+    except Exception as e:
+        app.logger.debug("poi fetch failed: %s", e.__class__.__name__)
+        fetched = None
+    return _apply_pois(fetched, near_tags, place_tags, candidates, radius_m)
+
+
+def _apply_pois(fetched, near_tags, place_tags, candidates, radius_m: int):
+    """fetch_pois の結果から (near_pois, places 付き candidates, failed) を作る。
+    締切超過で打ち切られても呼び出し側の候補を書き換えないようコピーに付与する。"""
+    candidates = [dict(c) for c in candidates or []]
+    if fetched is None:
+        return [], candidates, True
+    elements, dists, complete = fetched
+    near_pois = nearest_poi_names(elements, dists, near_tags, radius_m)
+    if place_tags and (elements or complete):
+        attach_places(candidates, elements, dists, place_tags, radius_m)
+    return near_pois, candidates, not complete
+
+# ---------------- プロンプト組み立て (トークン予算付き) ----------------
+# 生成レイテンシは入力トークン数にほぼ比例するので、モデルが使う情報だけを 1 行ずつ詰める。
+# 候補は順位順に予算まで入れ、入らない分は施設 → 候補そのものの順に落とす。
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 800))
+PROMPT_MIN_CANDIDATES = 3  # 予算超過でもこれだけは (施設なしで) 残す
+PROMPT_WEATHER_FIELDS = (  # (current のキー, ラベル, 単位)
+    ("temperature_2m", "気温", "℃"),
+    ("apparent_temperature", "体感", "℃"),
+    ("precipitation", "降水", "mm"),
+    ("wind_speed_10m", "風速", "km/h"),
+    ("weather_code", "天気コード", ""),
+)
+
+# 毎回同じ指示 (役割・6 項目の形式・施設名の創作禁止) はシステム指示としてモデル側に持たせ、
+# リクエスト毎には条件・天気・候補だけを送る (ModelHandle が Gemini のコンテキストキャッシュに載せる)。
+SYSTEM_INSTRUCTION = """あなたは当日のレジャーコンシェルジュです。与えられた条件で、実行可能性が高く多様性のある3案を日本語で提案してください。各案は:
+1. タイトル（〜なプラン）
+2. ひとことで魅力
+3. 所要時間目安
+4. 予算感（入力の予算があれば整合 / 無ければレンジ）
+5. 天候(雨/暑さ/風) への配慮
+6. 混雑/満席時の代替ミニプラン
+を簡潔 (1項目あたり最大40文字程度) に列挙。Markdownの番号付きリストで。冗長な前置き不要。
+
+注意: 施設名は[候補]の「近く:」に挙げたものだけ使い、それ以外の固有名詞は作らないこと。存在しない店名や具体的な店舗の創作禁止。
+「近く:」が一つも無い場合は、具体的な店名・施設名は出さないこと。"""
+
+
+def estimate_tokens(text: str) -> int:
+    """入力トークン数の見積もり (ASCII は約 4 文字で 1, それ以外 (日本語) は 1 文字 1 として多めに数える)。"""
+    n_ascii = len(text.encode("ascii", "ignore"))
+    return -(-n_ascii // 4) + (len(text) - n_ascii)
+
+
+def _prompt_weather(weather: dict) -> str:
+    cur = weather.get("current", {}) or {}
+    parts = [f"{label} {cur[k]}{unit}" for k, label, unit in PROMPT_WEATHER_FIELDS if cur.get(k) is not None]
+    return " / ".join(parts) or "不明"
+
+
+def _prompt_conditions(data: dict) -> str:
+    indoor = {True: "はい", False: "いいえ"}.get(data.get("indoor"), "指定なし")
+    radius = f"{data['radius_km']}km" if data.get("radius_km") else "未指定"
+    return (f"気分: {data.get('mood') or '指定なし'} / 移動半径: {radius} / "
+            f"屋内希望: {indoor} / 予算: {data.get('budget') or '未指定'}")
+
+
+def _prompt_candidate(c: dict, with_places: bool = True) -> str:
+    """候補 1 行: 名前 [タグ] 近く: 施設(距離)。座標・OSM タグ・URL はモデルが使わないので送らない。"""
+    line = f"- {c.get('name', '')}"
+    if c.get("tags"):
+        line += f" [{','.join(c['tags'])}]"
+    places = [p for p in c.get("places") or [] if p.get("name")] if with_places else []
+    if places:
+        line += " 近く: " + ", ".join(f"{p['name']}({p.get('distance_km', '?')}km)" for p in places)
+    return line
+
+
+def _build_prompt(data: dict, weather: dict, candidates, budget: int = None) -> str:
+    """生成用プロンプト (ユーザー条件 + 天気要約 + 候補 1 行ずつ) を budget トークン以内で組む。
+    固定の指示は SYSTEM_INSTRUCTION 側。施設名の許可リストは各候補の「近く:」そのもの (別リストで重複させない)。
+    見積もりトークン数を data["_prompt_tokens"] に残す (METRIC 用)。
+    """
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    cands = [c for c in candidates or [] if isinstance(c, dict)]
+    head = "\n".join(["[ユーザー条件]", _prompt_conditions(data),
+                      "[現在の天気]", _prompt_weather(weather), "[候補]"])
+    used = estimate_tokens(head)
+    lines = []
+    for i, c in enumerate(cands):
+        line = _prompt_candidate(c)
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            if i >= PROMPT_MIN_CANDIDATES:
+                break
+            line = _prompt_candidate(c, with_places=False)
+            cost = estimate_tokens(line) + 1
+        lines.append(line)
+        used += cost
+    prompt = "\n".join([head] + (lines or ["（候補なし）"]))
+    data["_prompt_tokens"] = estimate_tokens(prompt)
+    return prompt
+
+
+def _log_generation(prompt: str, resp, started: float, path: str = "gemini.generate"):
+    """生成 1 回の構造化ログ (METRIC): 入力トークン (実測 / 見積もり)・出力トークン・所要時間。
+    実測は応答の usage_metadata (無ければ None)。プロンプト削減によるレイテンシ差の計測用。"""
+    try:
+        usage = getattr(resp, "usage_metadata", None)
+        log_obj = {
+            "ts": time.time(),
+            "path": path,
+            "latency_ms": int((time.time() - started) * 1000),
+            "prompt_tokens": getattr(usage, "prompt_token_count", None),
+            "prompt_tokens_est": estimate_tokens(prompt),
+            "cached_tokens": getattr(usage, "cached_content_token_count", None),
+            "output_tokens": getattr(usage, "candidates_token_count", None),
+        }
+        app.logger.info("METRIC %s", json.dumps(log_obj, ensure_ascii=False, separators=(",", ":")))
+    except Exception:
+        pass
+
+
+# ---------------- 生成プール (プロセス共有モデル + 固定ワーカー + 受付制御) ----------------
+# Gemini への同時生成数を GEN_WORKERS に抑え、溢れた分は GEN_QUEUE_MAX まで待たせる。
+# 待ち行列と直近の生成時間から締切までに終わらないと見込める要求は、待たせずに受付拒否
+# (呼び出し側は即フォールバック) する。スパイクで全員がまとめてタイムアウトするのを防ぐ。
+GEN_WORKERS = int(os.environ.get("GEN_WORKERS", 8))
+GEN_QUEUE_MAX = int(os.environ.get("GEN_QUEUE_MAX", 16))
+
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "1") != "0"
+GEMINI_CONTEXT_CACHE_TTL = float(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", 3600))
+# 明示キャッシュの最小入力トークン数 (これ未満の指示はキャッシュを作れないので API を呼ばない)
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CACHE_MIN_TOKENS", 1024))
+
+
+class ModelHandle:
+    """プロセス共有の生成モデル (SYSTEM_INSTRUCTION 付き)。
+    - GEMINI_CONTEXT_CACHE 有効かつ指示が最小トークン数以上なら CachedContent を作り、
+      GenerativeModel.from_cached_content で固定部分を毎回送らない。期限の少し前に作り直す。
+    - 作成できない (小さすぎる / 権限 / 障害) ときは system_instruction 付きモデルで続け、
+      TTL 後に再挑戦する。client が差し替わったら作り直す。
+    """
+
+    REFRESH_MARGIN = 60.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._model = None
+        self._valid_until = 0.0
+        self.mode = None
+        self.cache_name = None
+        self.created = 0
+        self.errors = 0
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._model is None or self._client is not client or now >= self._valid_until:
+                self._model = self._build(now)
+                self._client = client
+            return self._model
+
+    def _cacheable(self) -> bool:
+        return GEMINI_CONTEXT_CACHE and estimate_tokens(SYSTEM_INSTRUCTION) >= GEMINI_CACHE_MIN_TOKENS
+
+    def _build(self, now: float):
+        ttl = GEMINI_CONTEXT_CACHE_TTL
+        if self._cacheable():
+            try:
+                cache = client.caching.CachedContent.create(
+                    model=f"models/{GEMINI_MODEL}", display_name="play-plan-system",
+                    system_instruction=SYSTEM_INSTRUCTION, ttl=datetime.timedelta(seconds=ttl))
+                model = client.GenerativeModel.from_cached_content(cached_content=cache)
+                self.mode, self.cache_name = "cached_content", getattr(cache, "name", None)
+                self.created += 1
+                self._valid_until = now + max(0.0, ttl - self.REFRESH_MARGIN)
+                return model
+            except Exception as e:
+                self.errors += 1
+                app.logger.warning("context cache unavailable, using system_instruction: %s", e.__class__.__name__)
+        self.mode, self.cache_name = "system_instruction", None
+        self._valid_until = now + ttl if self._cacheable() else float("inf")
+        return client.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_INSTRUCTION)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "cache_name": self.cache_name,
+                "caches_created": self.created,
+                "cache_errors": self.errors,
+                "system_tokens_est": estimate_tokens(SYSTEM_INSTRUCTION),
+            }
+
+
+MODEL_HANDLE = ModelHandle()
+
+
+def generation_model():
+    """プロセス共有の GenerativeModel (MODEL_HANDLE 経由。client が差し替わったときだけ作り直す)。"""
+    return MODEL_HANDLE.get()
+
+
+class GenerationPool:
+    """固定サイズの生成ワーカー + 受付制御。
+    - try_admit(timeout): 空きワーカーが無く、待ち行列が max_queue を超える、または
+      (pending / ワーカー数 + 1) × 生成時間の移動平均 が timeout を超えるなら拒否。受け付けたら done() まで pending に数える。
+    - submit(fn, timeout): 受付できれば Future、できなければ None。締切で諦めた Future は cancel で列から外す。
+    """
+
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gemini")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.latency = None  # 生成時間の移動平均 (秒)
+
+    def expected_wait(self) -> float:
+        """今受け付けた要求が終わるまでの見込み秒数 (生成時間の実績が無ければ 0)。"""
+        with self._lock:
+            return self._expected_locked()
+
+    def _expected_locked(self) -> float:
+        if self.latency is None:
+            return 0.0
+        return (self.pending // self.workers + 1) * self.latency
+
+    def try_admit(self, timeout: float) -> bool:
+        with self._lock:
+            queued = self.pending + 1 - self.workers  # 受け付けたら列で待つ数 (自分を含む)
+            # 空きワーカーがあれば必ず受ける (拒否しても速くならず、生成時間の実績も更新されない)
+            if queued > 0 and (queued > self.max_queue or self._expected_locked() > timeout):
+                self.rejected += 1
+                return False
+            self.pending += 1
+            self.admitted += 1
+            return True
+
+    def done(self, latency: float = None):
+        with self._lock:
+            self.pending -= 1
+            if latency is not None:
+                self.latency = latency if self.latency is None else (
+                    self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * self.latency)
+
+    def submit(self, fn, timeout: float):
+        if not self.try_admit(timeout):
+            return None
+        started = [None]
+
+        def _run():
+            started[0] = time.time()
+            return fn()
+
+        def _finish(fut):
+            # 実行できたものだけ生成時間として数える (列で cancel されたものは数えない)
+            self.done(time.time() - started[0] if started[0] is not None and not fut.cancelled() else None)
+
+        fut = self._executor.submit(_run)
+        fut.add_done_callback(_finish)
+        return fut
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "pending": self.pending,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "latency_ms": int(self.latency * 1000) if self.latency is not None else None,
+            }
+
+
+GEN_POOL = GenerationPool(GEN_WORKERS, GEN_QUEUE_MAX)
+
+
+def _generate_suggestions(prompt: str, timeout: float):
+    """Gemini で生成 (GEN_POOL 上)。受付拒否 / timeout 秒以内に得られなければ None (→ フォールバック)。"""
+    return _await_generation(_submit_generation(prompt, timeout), prompt, timeout)
+
+
+def _submit_generation(prompt: str, timeout: float):
+    """生成を GEN_POOL へ投入 (呼び出し側のスレッドは待たない)。返却: (Future, 開始時刻)。
+    クライアント無し / ブレーカー open / 受付拒否は None。"""
+    if client is None or timeout <= 0:
+        return None
+    if not BREAKERS["gemini"].allow():
+        return None
+    started = time.time()
+    fut = GEN_POOL.submit(lambda: generation_model().generate_content(prompt), timeout)
+    if fut is None:
+        app.logger.warning("generation rejected: pool busy (pending=%s)", GEN_POOL.pending)
+        return None
+    return fut, started
+
+
+def _await_generation(job, prompt: str, timeout: float):
+    """_submit_generation の結果を timeout 秒まで待ってテキストにする。得られなければ None。"""
+    if job is None:
+        return None
+    fut, started = job
+    breaker = BREAKERS["gemini"]
+    try:
+        resp = fut.result(timeout=max(0.0, timeout))
+        breaker.success()
+        _log_generation(prompt, resp, started)
+        return (getattr(resp, "text", None) or "").strip() or None
+    except Exception as e:
+        # 列で待つ間に締切が来た (cancel 成功) なら Gemini は呼んでいないのでブレーカーに数えない
+        if fut.cancel():
+            app.logger.warning("generation timed out in queue (pending=%s)", GEN_POOL.pending)
+            return None
+        breaker.failure()
+        app.logger.warning("generation failed: %s", e.__class__.__name__)
+        return None
+
+def _stream_suggestions(prompt: str, deadline: Deadline):
+    """Gemini のストリーミング生成。届いたテキスト断片を順に yield する。
+    戻り値 (StopIteration.value): 最後まで生成できたら True。締切超過 / 失敗 / ブレーカー open は False。
+    生成は GEN_POOL のワーカーで回し (受付拒否なら即 False)、こちらは締切までキューを待つ
+    (呼び出し側が途中で閉じても打ち切る)。
+    """
+    if client is None or deadline.expired():
+        return False
+    breaker = BREAKERS["gemini"]
+    if not breaker.allow():
+        return False
+    chunks = queue.Queue()
+    cancel = threading.Event()
+    _END = object()
+
+    def _produce():
+        started, part = time.time(), None
+        try:
+            for part in generation_model().generate_content(prompt, stream=True):
+                if cancel.is_set():
+                    break
+                text = getattr(part, "text", None)
+                if text:
+                    chunks.put(text)
+            chunks.put(_END)
+            _log_generation(prompt, part, started, path="gemini.stream")  # usage は最後の断片に付く
+        except Exception as e:
+            chunks.put(e)
+
+    fut = GEN_POOL.submit(_produce, deadline.remaining())
+    if fut is None:
+        app.logger.warning("generation rejected: pool busy (pending=%s)", GEN_POOL.pending)
+        return False
+    try:
+        while True:
+            try:
+                item = chunks.get(timeout=max(0.0, deadline.remaining()))
+            except queue.Empty:
+                if fut.cancel():  # 列で待ったまま締切: Gemini は呼んでいない
+                    app.logger.warning("generation stream timed out in queue")
+                    return False
+                breaker.failure()
+                app.logger.warning("generation stream timed out")
+                return False
+            if item is _END:
+                breaker.success()
+                return True
+            if isinstance(item, Exception):
+                breaker.failure()
+                app.logger.warning("generation failed: %s", item.__class__.__name__)
+                return False
+            yield item
+    finally:
+        cancel.set()
+        fut.cancel()
+
+
+def _sse(event: str, payload) -> str:
+    """Server-Sent Events の 1 イベント (data は 1 行の JSON)。"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+# ---------------- 応答キャッシュ (状況フィンガープリント単位) ----------------
+# 同じセル・同じ天気帯・同じルールタグ・同じ (正規化した) 条件なら生成結果を使い回す。
+# 生成に成功し縮退していない応答だけを保存する (フォールバックは作り直しても安い)。
+SUGGEST_CACHE_TTL = float(os.environ.get("SUGGEST_CACHE_TTL", 900))  # 0 で無効
+SUGGEST_CACHE_SIZE = int(os.environ.get("SUGGEST_CACHE_SIZE", 2048))
+SUGGEST_CACHE_TEMP_STEP = float(os.environ.get("SUGGEST_CACHE_TEMP_STEP", 3.0))  # 体感温度の帯幅 (℃)
+SUGGEST_CACHE = LRUTTLCache(SUGGEST_CACHE_SIZE, SUGGEST_CACHE_TTL)
+
+
+def _norm_text(s) -> str:
+    """全角半角・大小文字・空白の揺れを畳む (NFKC + lower + 空白 1 個)。"""
+    return " ".join(unicodedata.normalize("NFKC", s or "").lower().split())
+
+
+def weather_bucket(data: dict, weather: dict) -> tuple:
+    """天気セル + 天気の帯 (雨 / 強風 / 体感温度帯)。応答キャッシュと意味キャッシュの共通の区切り。"""
+    precip, app_temp, wind, precip_prob = weather_drivers(weather)
+    return (
+        _weather_cell(data["lat"], data["lon"]),
+        precip > 0 or precip_prob >= 50,
+        wind >= 10,
+        math.floor(app_temp / SUGGEST_CACHE_TEMP_STEP),
+    )
+
+
+def situation_key(data: dict, weather: dict, rule_tags, degraded: bool = False):
+    """応答キャッシュのキー: weather_bucket + 屋内指定 + 半径 + ルールタグ + 正規化した入力。
+    先頭 _BUCKET_LEN 要素 (気分の表記に依らない部分) が意味キャッシュのバケット。
+    天気が縮退 (取得失敗) なら None: 空の current は 0℃ 帯に落ちるため、キャッシュを引きも書きもしない。"""
+    if degraded:
+        return None
+    radius = data.get("radius_km")
+    return weather_bucket(data, weather) + (
+        data.get("indoor"),
+        round(radius * 2) / 2 if radius else None,  # 0.5km 刻み (半径の有無で near_pois / places が変わる)
+        tuple(rule_tags),
+        _norm_text(data.get("mood")),
+        _norm_text(data.get("budget")),
+    )
+
+
+def cached_suggest_response(key, weather: dict, elapsed: float):
+    """キャッシュ済み応答 (天気は今回の値に差し替え, cache_hit=true)。無ければ None。"""
+    if SUGGEST_CACHE_TTL <= 0 or key is None:
+        return None
+    body = SUGGEST_CACHE.get(key)
+    if body is None:
+        return None
+    return dict(body, weather=weather.get("current", {}), elapsed_sec=elapsed, cache_hit=True)
+
+
+def remember_suggest_response(key, body: dict, q_unit=None):
+    """生成に成功した応答を応答キャッシュへ (q_unit があれば意味キャッシュにも)。"""
+    if key is None or body["fallback"] or body["degraded"]:
+        return
+    body = {k: v for k, v in body.items() if k != "index"}
+    if SUGGEST_CACHE_TTL > 0:
+        SUGGEST_CACHE.put(key, body)
+    if q_unit is not None and SEMANTIC_CACHE_THRESHOLD <= 1.0:
+        SEMANTIC_CACHE.put(key[:_BUCKET_LEN], q_unit, body)
+
+
+# ---------------- 意味キャッシュ (言い換えた気分でも生成結果を使い回す) ----------------
+# 同じ weather_bucket 内で、過去のクエリ埋め込み (_build_query の単位ベクトル) とのコサイン類似度が
+# 閾値以上なら、その応答を返す。「のんびり」と「まったり」のように完全一致キーでは拾えない揺れ用。
+# 閾値は /healthz の best_similarity 分布と near_misses を見て調整する (1 超で無効)。
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_PER_BUCKET = int(os.environ.get("SEMANTIC_CACHE_PER_BUCKET", 64))
+SEMANTIC_CACHE_BUCKETS = int(os.environ.get("SEMANTIC_CACHE_BUCKETS", 1024))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", 900))
+_BUCKET_LEN = 6  # situation_key の先頭 weather_bucket + 屋内指定 + 半径 の長さ
+
+
+class SemanticCache:
+    """バケット毎の小さなベクトル索引 (単位ベクトル行列との内積 1 回で最近傍を引く)。
+    - バケット数は LRU で max_buckets、各バケットは新しい順に per_bucket 行まで (古い行から捨てる)。
+    - ttl 秒を過ぎた行は検索対象外。
+    - stats(): hits / misses / hit_rate に加え、閾値の妥当性を見るための
+      near_misses (閾値の NEAR_BAND 手前で外れた数), ヒット時の平均類似度, 最良類似度のヒストグラム。
+    """
+
+    NEAR_BAND = 0.03
+    HIST_EDGES = (0.8, 0.85, 0.9, 0.93, 0.95, 0.97, 0.99)
+
+    def __init__(self, threshold: float, per_bucket: int, max_buckets: int, ttl: float):
+        from collections import OrderedDict
+        self.threshold = float(threshold)
+        self.per_bucket = max(1, int(per_bucket))
+        self.max_buckets = max(1, int(max_buckets))
+        self.ttl = float(ttl)
+        self._buckets = OrderedDict()  # bucket -> (stored_at (m,), vecs (m, dim), values [m])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0
+        self._hit_sim_sum = 0.0
+        self._hist = [0] * (len(self.HIST_EDGES) + 1)
+
+    def lookup(self, bucket, q_unit):
+        """閾値以上で最も近い値と類似度 (value, sim)。無ければ (None, 最良類似度 or None)。"""
+        q = np.asarray(q_unit, dtype=np.float32)
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            best, value = None, None
+            if entry is not None and entry[1].shape[1] == q.shape[0]:
+                at, vecs, values = entry
+                sims = vecs @ q
+                sims[time.time() - at >= self.ttl] = -1.0
+                i = int(np.argmax(sims))
+                if sims[i] > -1.0:
+                    best, value = float(sims[i]), values[i]
+                self._buckets.move_to_end(bucket)
+            if best is not None:
+                self._hist[int(np.searchsorted(self.HIST_EDGES, best, side="right"))] += 1
+            if best is not None and best >= self.threshold:
+                self.hits += 1
+                self._hit_sim_sum += best
+                return value, best
+            self.misses += 1
+            if best is not None and best >= self.threshold - self.NEAR_BAND:
+                self.near_misses += 1
+            return None, best
+
+    def put(self, bucket, q_unit, value):
+        q = np.asarray(q_unit, dtype=np.float32)[None, :]
+        now = np.array([time.time()])
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if entry is None or entry[1].shape[1] != q.shape[1]:
+                entry = (now, q, [value])
+            else:
+                at, vecs, values = entry
+                keep = slice(-(self.per_bucket - 1), None) if self.per_bucket > 1 else slice(0, 0)
+                entry = (np.concatenate([at[keep], now]), np.vstack([vecs[keep], q]), values[keep] + [value])
+            self._buckets[bucket] = entry
+            self._buckets.move_to_end(bucket)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "buckets": len(self._buckets),
+                "entries": sum(len(e[2]) for e in self._buckets.values()),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None,
+                "near_misses": self.near_misses,
+                "mean_hit_similarity": round(self._hit_sim_sum / self.hits, 4) if self.hits else None,
+                "best_similarity": {"edges": list(self.HIST_EDGES), "counts": list(self._hist)},
+            }
+
+
+SEMANTIC_CACHE = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_PER_BUCKET,
+                               SEMANTIC_CACHE_BUCKETS, SEMANTIC_CACHE_TTL)
+
+
+def semantic_suggest_response(key, q_unit, weather: dict, elapsed: float):
+    """意味キャッシュからの応答 (cache_hit=true + cache_similarity)。q_unit 無し / 閾値未満は None。"""
+    if key is None or q_unit is None or SEMANTIC_CACHE_THRESHOLD > 1.0:
+        return None
+    body, sim = SEMANTIC_CACHE.lookup(key[:_BUCKET_LEN], q_unit)
+    if body is None:
+        return None
+    if SUGGEST_CACHE_TTL > 0:
+        SUGGEST_CACHE.put(key, body)  # 同じ状況の次回は埋め込みも待たずに返せる
+    return dict(body, weather=weather.get("current", {}), elapsed_sec=elapsed, cache_hit=True,
+                cache_similarity=round(sim, 4))
+
+
 # ------------------------------------------------------------
 # フロントエンド配信: public/ 配下 (index.html + 静的資産)
 # ルート / と任意の非APIパスを SPA 的に index.html へフォールバック
@@ -528,237 +3213,265 @@ def frontend(path: str):
     # 既定で index.html
     return send_from_directory('public', 'index.html')
 
+def _suggest_graph(data: dict, deadline: Deadline) -> StageGraph:
+    """/api/suggest 系のステージグラフ (weather → rules) を組み立てて開始する。
+    応答キャッシュを外したら _add_retrieval_stages で 埋め込み検索 → POI を足す。
+    """
+    graph = StageGraph(deadline)
+    graph.add("weather", lambda: _weather_stage(data["lat"], data["lon"], deadline))
+    graph.add("rules", lambda w: shortlist_by_rules(w[0], data) or [], deps=("weather",))
+    return graph
+
+
+def _add_retrieval_stages(graph: StageGraph, data: dict, client_failed: bool) -> bool:
+    """rules の後段 (クエリ埋め込み → 埋め込み検索 → POI (近隣POI + 施設付与)) を足す。戻り値: use_poi
+    クエリ埋め込みが出た時点で意味キャッシュを引けるよう、埋め込みは独立したステージにする
+    (query_vec が無いグラフでは意味キャッシュを引かない)。
+    POI は候補タグも含めた特徴の和集合で 1 回だけ取得し、near_pois と places の両方に使う。
+    """
+    lat, lon, deadline = data["lat"], data["lon"], graph.deadline
+    use_poi = bool(data.get("radius_km")) and not os.environ.get("DISABLE_POI")
+    if not client_failed and LOCAL_EMBED != "first":
+        graph.add("query_vec", lambda tags: _query_vec_stage(_build_query(data, tags)), deps=("rules",))
+        graph.add("candidates", lambda vec, tags: _candidate_stage(vec, tags, _local_query(data, tags)),
+                  deps=("query_vec", "rules"))
+    else:
+        # クライアント無し / LOCAL_EMBED=first: ローカル埋め込みだけで候補を出す (API を待たない)
+        graph.add("candidates", lambda tags: _candidate_stage(None, tags, _local_query(data, tags)),
+                  deps=("rules",))
+    if use_poi:
+        graph.add("pois", lambda tags, cands: _poi_stage(lat, lon, data["radius_km"], tags, cands, deadline),
+                  deps=("rules", "candidates"))
+    return use_poi
+
+
+def _graph_pois(graph: StageGraph, use_poi: bool, candidates: list, degraded: bool):
+    """POI ステージの結果を待つ。戻り値: (near_pois, candidates, degraded)。締切超過 / 失敗は縮退扱い。"""
+    if not use_poi:
+        return [], candidates, degraded
+    poi_res = graph.result("pois", default=None)
+    if poi_res is None:
+        return [], candidates, True
+    near_pois, candidates, poi_failed = poi_res
+    return near_pois, candidates, degraded or poi_failed
+
+
 @app.post("/api/suggest")
 def suggest():
     """POST /api/suggest
     受信: {lat, lon, mood, radius_km, indoor, budget}
-    1) Open-Meteo 現在天気 (10分メモリキャッシュ)
-    2) shortlist_by_rules で候補タグ
-    3) Gemini (gemini-2.5-flash, thinking無効) で3案生成
-    4) JSON返却
-    タイムアウト全体目標: 6秒
+    1) Open-Meteo 現在天気 (WEATHER_CACHE: セル単位 10分, single-flight + stale-while-revalidate)
+    2) shortlist_by_rules で候補タグ (同じ状況の生成済み応答があれば SUGGEST_CACHE から即返却)
+    3) クエリ埋め込み (近い過去の応答があれば SEMANTIC_CACHE から返却)
+       → 埋め込み検索 → 近隣POI + 施設付与 (POI 取得は 1 回, StageGraph)
+    4) Gemini (gemini-2.5-flash, thinking無効) で3案生成
+    5) JSON返却
+    タイムアウト全体目標: BUDGET_SECONDS (全ステージで締切を共有)
     エラー時: {"error": str} + 適切な4xx/5xx
     """
-    import time, concurrent.futures, threading
-
     # 詳細ログ追加（デバッグ用）
     app.logger.info("=== /api/suggest REQUEST START ===")
     
-    start = time.time()
-    global client
-    client_failed = False
-    if client is None:
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if api_key:
-            try:
-                import google.generativeai as genai
-                genai.configure(api_key=api_key)
-                globals()['client'] = client = genai
-            except Exception as e:
-                app.logger.warning("gemini init failed: %s", e.__class__.__name__)
-                client_failed = True
-        else:
-            client_failed = True
-    BUDGET_SECONDS = 6.0
+    deadline = Deadline()
+    start = deadline.start
+    client_failed = not _ensure_client()
 
     # ---------- 入力バリデーション (Pydantic) ----------
     raw = request.get_json(silent=True)
     if raw is None:
         return _bad_request("JSON body required")
     try:
-        # bool 文字列の正規化 (pydanticは true/false 文字列を解釈するが、空文字は None に変換)
-        if isinstance(raw, dict) and "indoor" in raw and raw["indoor"] == "":
-            raw["indoor"] = None
-        req_model = SuggestRequest.model_validate(raw)
+        req_model = parse_suggest_request(raw)
     except ValidationError as ve:
         return _bad_request_from_validation(ve)
     # PIIを含む mood/budget をログしないのでフィールド名のみ (DEBUG 用)
     app.logger.debug("validated fields: %s", list(req_model.model_dump(exclude_none=True).keys()))
-    lat = req_model.lat
-    lon = req_model.lon
     data = req_model.model_dump()
 
-    # ---------- 天気キャッシュ (10分) ----------
-    cache = globals().setdefault("_WEATHER_CACHE", {})  # {(lat_r,lon_r): (timestamp, weather_json)}
-    lock = globals().setdefault("_WEATHER_CACHE_LOCK", threading.Lock())
-    key = (round(lat, 2), round(lon, 2))
-    weather = None
-    degraded = False
-    now = time.time()
-    with lock:
-        if key in cache:
-            ts, w = cache[key]
-            if now - ts < 600:  # 10分
-                weather = w
-    if weather is None:
-        # 残り時間チェック
-        if time.time() - start >= BUDGET_SECONDS:
-            return jsonify({"error": "timeout fetching weather"}), 504
-        try:
-            # 簡易リトライ (指数バックオフ 3回)
-            last_err = None
-            for attempt in range(3):
-                try:
-                    weather = fetch_weather(lat, lon)
-                    break
-                except requests.RequestException as e:
-                    last_err = e
-                    time.sleep(0.3 * (attempt + 1))
-            else:
-                degraded = True
-                weather = {"current": {}, "_error": f"weather_failed:{last_err}"}
-        except Exception as e:
-            degraded = True
-            weather = {"current": {}, "_error": f"weather_failed:{e.__class__.__name__}"}
-        if not isinstance(weather, dict) or "current" not in weather:
-            degraded = True
-            weather = {"current": {}, "_error": "weather_invalid"}
-        with lock:
-            cache[key] = (time.time(), weather)
+    # ---------- ステージグラフ ----------
+    graph = _suggest_graph(data, deadline)
+
+    try:
+        weather, degraded = graph.result("weather")
+    except concurrent.futures.TimeoutError:
+        return jsonify({"error": "timeout fetching weather"}), 504
 
     # ---------- ルールタグ生成 ----------
     try:
-        rule_tags = shortlist_by_rules(weather, data) or []
+        rule_tags = graph.result("rules")
+    except concurrent.futures.TimeoutError:
+        return jsonify({"error": "timeout before embedding"}), 504
     except Exception as e:
         return jsonify({"error": f"rule engine error: {e}"}), 500
 
-    # ---------- 近隣POI取得 (位置情報 + 半径利用) ----------
-    near_pois = []
-    if data.get("radius_km") and not os.environ.get("DISABLE_POI"):
-        remaining_for_poi = BUDGET_SECONDS - (time.time() - start)
-        try:
-            near_pois = fetch_nearby_pois(
-                lat, lon,
-                radius_m=int(data["radius_km"] * 1000),
-                rule_tags=rule_tags,
-                remaining_budget=remaining_for_poi,
-            ) or []
-            if near_pois:
-                data["_near_pois"] = near_pois
-        except Exception:
-            near_pois = []
+    # ---------- 応答キャッシュ (同じ状況なら生成しない) ----------
+    cache_key = situation_key(data, weather, rule_tags, degraded)
+    cached = cached_suggest_response(cache_key, weather, round(time.time() - start, 3))
+    if cached is not None:
+        _log_suggest(cached, weather, data)
+        return jsonify(cached)
+    use_poi = _add_retrieval_stages(graph, data, client_failed)
+
+    # ---------- 意味キャッシュ (クエリ埋め込みが近い過去の応答) ----------
+    q_unit = graph.result("query_vec", default=None) if graph.has("query_vec") else None
+    cached = semantic_suggest_response(cache_key, q_unit, weather, round(time.time() - start, 3))
+    if cached is not None:
+        _log_suggest(cached, weather, data)
+        return jsonify(cached)
 
     # ---------- Embedding検索候補 ----------
-    if time.time() - start >= BUDGET_SECONDS:
-        return jsonify({"error": "timeout before embedding"}), 504
-    query = f"気分:{data.get('mood','')} タグ:{','.join(rule_tags)} 予算:{data.get('budget','未指定')}"
-    candidates = []
-    if not client_failed:
-        # embeddings の長さと activities の整合性チェック (不一致なら再生成トライ)
-        try:
-            if EMB is not None and EMB.shape[0] != len(ACTIVITIES):
-                app.logger.warning("embedding shape mismatch -> regenerating")
-                _ensure_embeddings()
-        except Exception:
-            pass
-        candidates = top_k_by_embedding(query, k=8) or []
+    candidates = graph.result("candidates", default=[])
+
+    # ---------- 近隣POI + 施設情報付与 (Overpass 最大 1 回) ----------
+    near_pois, candidates, degraded = _graph_pois(graph, use_poi, candidates, degraded)
+    if near_pois:
+        data["_near_pois"] = near_pois
 
     # ---------- Gemini 生成 ----------
-    remaining = BUDGET_SECONDS - (time.time() - start)
-    # 候補に施設情報付与 (embed後, LLM前)
-    if remaining > 0 and candidates and data.get("radius_km") and not os.environ.get("DISABLE_POI"):
-        try:
-            augment_candidates_with_places(candidates, lat, lon, int(data.get("radius_km",1)*1000), remaining * 0.6)
-        except Exception as e:
-            app.logger.debug("augment failed: %s", e.__class__.__name__)
-            degraded = True
+    remaining = deadline.remaining()
     if remaining <= 0:
         # 生成を諦めフォールバック
-        elapsed = round(time.time() - start, 3)
-        fallback_suggestions = _generate_fallback_suggestions(weather, data, rule_tags, candidates)
-        response_data = {
-            "suggestions": fallback_suggestions,
-            "weather": weather.get("current", {}),
-            "tags": rule_tags,
-            "candidates": candidates,
-            "elapsed_sec": elapsed,
-            "fallback": True,
-            "fallback_reason": "timeout",
-            "degraded": True,
-        }
-        app.logger.info("=== /api/suggest TIMEOUT FALLBACK ===")
-        app.logger.info("Response status: 200")
-        app.logger.info("Elapsed: %ss", elapsed)
-        return jsonify(response_data)
-
-    # 施設名抽出（後で places 拡張時に再利用予定）
-    place_names = []
-    for cdd in candidates:
-        for pl in cdd.get('places', []) if isinstance(cdd, dict) else []:
-            if pl.get('name') and pl['name'] not in place_names:
-                place_names.append(pl['name'])
-    allow_places = ', '.join(place_names[:20]) or '（該当施設データなし）'
-    prompt = f"""
-あなたは当日のレジャーコンシェルジュです。以下の条件で、実行可能性が高く多様性のある3案を日本語で提案してください。各案は:
-1. タイトル（〜なプラン）
-2. ひとことで魅力
-3. 所要時間目安
-4. 予算感（入力の予算があれば整合 / 無ければレンジ）
-5. 天候(雨/暑さ/風) への配慮
-6. 混雑/満席時の代替ミニプラン
-を簡潔 (1項目あたり最大40文字程度) に列挙。Markdownの番号付きリストで。冗長な前置き不要。
+        body = suggest_response(weather, data, rule_tags, candidates, near_pois, None,
+                                round(time.time() - start, 3), degraded, timed_out=True)
+        _log_suggest(body)
+        return jsonify(body)
 
-注意: 以下のリストに含まれる施設名以外の固有名詞は作らないこと。存在しない店名や具体的な店舗の創作禁止。
-利用可能な施設名: {allow_places}
+    prompt = _build_prompt(data, weather, candidates)
+    suggestions_text = None
+    if not client_failed:
+        suggestions_text = _generate_suggestions(prompt, remaining)
 
-[ユーザー条件]
-気分: {data.get('mood')}
-移動半径: {data.get('radius_km','未指定')}km
-屋内希望: {data.get('indoor')}
-予算: {data.get('budget','未指定')}
-[現在の天気要約]
-{json.dumps(weather.get('current', {}), ensure_ascii=False)}
-[候補アクティビティ上位]
-{json.dumps(candidates, ensure_ascii=False)}
-""".strip()
+    body = suggest_response(weather, data, rule_tags, candidates, near_pois, suggestions_text,
+                            round(time.time() - start, 3), degraded)
+    remember_suggest_response(cache_key, body, q_unit)
+    _log_suggest(body, weather, data)
+    return jsonify(body)
 
-    suggestions_text = None
-    if not client_failed and client is not None:
-        def _gen():
-            model = client.GenerativeModel(GEMINI_MODEL)
-            return model.generate_content(prompt)
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(_gen)
-                resp = fut.result(timeout=remaining)
-            suggestions_text = (getattr(resp, "text", None) or "").strip() or None
-        except Exception as e:
-            app.logger.warning("generation failed: %s", e.__class__.__name__)
-
-    if not suggestions_text:
-        # フォールバック: より実用的な提案を生成
-        elapsed = round(time.time() - start, 3)
-        fallback_suggestions = _generate_fallback_suggestions(weather, data, rule_tags, candidates)
-        response_data = {
-            "suggestions": fallback_suggestions,
-            "weather": weather.get("current", {}),
-            "tags": rule_tags,
-            "candidates": candidates,
-            "near_pois": near_pois,
-            "elapsed_sec": elapsed,
-            "fallback": True,
-            "degraded": True,
-        }
-        app.logger.info("=== /api/suggest FALLBACK ===")
-        app.logger.info("Response status: 200")
-        app.logger.info("Elapsed: %ss", elapsed)
-        return jsonify(response_data)
-
-    elapsed = round(time.time() - start, 3)
-    response_data = {
-        "suggestions": suggestions_text,
+
+@app.post("/api/suggest/stream")
+def suggest_stream():
+    """POST /api/suggest/stream (Server-Sent Events)
+    受信: /api/suggest と同じ。各段の結果が出た時点で送る:
+      event: context    {"weather", "tags", "degraded"}    天気 + ルールタグ確定時
+      event: candidates {"candidates", "near_pois"}         埋め込み検索 + POI 付与後
+      event: delta      {"text"}                            Gemini 生成テキストの断片 (到着順)
+      event: done       /api/suggest と同じ応答 JSON        最終結果 (フォールバック時もこれで確定)
+    入力不正 / 天気タイムアウト等はストリーム開始前に /api/suggest と同じ 4xx/5xx JSON を返す。
+    締切超過で生成が途中の場合は、そこまでのテキストを degraded=true で確定する。
+    """
+    deadline = Deadline()
+    start = deadline.start
+    client_failed = not _ensure_client()
+
+    raw = request.get_json(silent=True)
+    if raw is None:
+        return _bad_request("JSON body required")
+    try:
+        req_model = parse_suggest_request(raw)
+    except ValidationError as ve:
+        return _bad_request_from_validation(ve)
+    data = req_model.model_dump()
+
+    graph = _suggest_graph(data, deadline)
+    try:
+        weather, degraded = graph.result("weather")
+    except concurrent.futures.TimeoutError:
+        return jsonify({"error": "timeout fetching weather"}), 504
+    try:
+        rule_tags = graph.result("rules")
+    except concurrent.futures.TimeoutError:
+        return jsonify({"error": "timeout before embedding"}), 504
+    except Exception as e:
+        return jsonify({"error": f"rule engine error: {e}"}), 500
+
+    cache_key = situation_key(data, weather, rule_tags, degraded)
+    cached = cached_suggest_response(cache_key, weather, round(time.time() - start, 3))
+    use_poi = _add_retrieval_stages(graph, data, client_failed) if cached is None else False
+
+    def _events():
+        yield _sse("context", {"weather": weather.get("current", {}), "tags": rule_tags, "degraded": degraded})
+        hit, q_unit = cached, None
+        if hit is None and graph.has("query_vec"):
+            q_unit = graph.result("query_vec", default=None)
+            hit = semantic_suggest_response(cache_key, q_unit, weather, round(time.time() - start, 3))
+        if hit is not None:
+            _log_suggest(hit, weather, data, path="/api/suggest/stream")
+            yield _sse("candidates", {"candidates": hit["candidates"], "near_pois": hit["near_pois"]})
+            yield _sse("done", hit)
+            return
+        candidates = graph.result("candidates", default=[])
+        near_pois, candidates, poi_degraded = _graph_pois(graph, use_poi, candidates, degraded)
+        if near_pois:
+            data["_near_pois"] = near_pois
+        yield _sse("candidates", {"candidates": candidates, "near_pois": near_pois})
+
+        if deadline.expired():
+            body = suggest_response(weather, data, rule_tags, candidates, near_pois, None,
+                                    round(time.time() - start, 3), poi_degraded, timed_out=True)
+            _log_suggest(body, path="/api/suggest/stream")
+            yield _sse("done", body)
+            return
+
+        parts = []
+        complete = False
+        if not client_failed:
+            stream = _stream_suggestions(_build_prompt(data, weather, candidates), deadline)
+            while True:
+                try:
+                    text = next(stream)
+                except StopIteration as stop:
+                    complete = bool(stop.value)
+                    break
+                parts.append(text)
+                yield _sse("delta", {"text": text})
+        body = suggest_response(weather, data, rule_tags, candidates, near_pois, "".join(parts).strip() or None,
+                                round(time.time() - start, 3), poi_degraded or not complete)
+        remember_suggest_response(cache_key, body, q_unit)
+        _log_suggest(body, weather, data, path="/api/suggest/stream")
+        yield _sse("done", body)
+
+    # プロキシ (nginx 等) のバッファリングを止め、断片をそのまま流す
+    return Response(stream_with_context(_events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def suggest_response(weather, data, rule_tags, candidates, near_pois, text, elapsed: float, degraded: bool,
+                     timed_out: bool = False) -> dict:
+    """/api/suggest の応答 JSON (同期 / 非同期の両経路で共有し、契約を 1 箇所で保つ)。
+    - timed_out: 生成前に締切超過 → フォールバック (fallback_reason=timeout, near_pois なし)
+    - text 無し: 生成失敗 / クライアント無し → フォールバック
+    - cache_hit: 常に false (応答キャッシュからの応答は cached_suggest_response が true にする)
+    """
+    body = {
+        "suggestions": text or _generate_fallback_suggestions(weather, data, rule_tags, candidates),
         "weather": weather.get("current", {}),
         "tags": rule_tags,
         "candidates": candidates,
-        "near_pois": near_pois,
-        "elapsed_sec": elapsed,
-        "fallback": False,
-        "degraded": degraded,
     }
-    app.logger.info("=== /api/suggest SUCCESS ===")
+    if not timed_out:
+        body["near_pois"] = near_pois
+    body["elapsed_sec"] = elapsed
+    if timed_out or not text:
+        body["fallback"] = True
+        if timed_out:
+            body["fallback_reason"] = "timeout"
+        body["degraded"] = True
+    else:
+        body["fallback"] = False
+        body["degraded"] = degraded
+    body["cache_hit"] = False
+    return body
+
+
+def _log_suggest(body: dict, weather=None, data=None, path: str = "/api/suggest"):
+    """応答種別のログ + 成功時は構造化ログ 1行 (METRIC)。"""
+    kind = "TIMEOUT FALLBACK" if body.get("fallback_reason") == "timeout" else (
+        "FALLBACK" if body["fallback"] else "SUCCESS")
+    app.logger.info("=== %s %s ===", path, kind)
     app.logger.info("Response status: 200")
-    app.logger.info("Elapsed: %ss", elapsed)
-    # 構造化ログ 1行
+    app.logger.info("Elapsed: %ss", body["elapsed_sec"])
+    if body["fallback"]:
+        return
     try:
         weather_digest = {}
         cw = weather.get("current", {}) if isinstance(weather, dict) else {}
@@ -767,23 +3480,221 @@ def suggest():
                 weather_digest[k] = cw[k]
         log_obj = {
             "ts": time.time(),
-            "path": "/api/suggest",
-            "latency_ms": int(elapsed * 1000),
-            "degraded": response_data.get("degraded"),
-            "tags": rule_tags,
+            "path": path,
+            "latency_ms": int(body["elapsed_sec"] * 1000),
+            "degraded": body.get("degraded"),
+            "cache_hit": body.get("cache_hit"),
+            "cache_similarity": body.get("cache_similarity"),
+            "tags": body["tags"],
             "mood_present": bool(data.get("mood")),
             "radius_km": data.get("radius_km"),
-            "poi_attached": any(c.get("places") for c in candidates),
+            "prompt_tokens": data.get("_prompt_tokens"),
+            "poi_attached": any(c.get("places") for c in body["candidates"]),
             "weather": weather_digest,
+            "breakers": breaker_states(),
+        }
+        app.logger.info("METRIC %s", json.dumps(log_obj, ensure_ascii=False, separators=(",", ":")))
+    except Exception:
+        pass
+
+def _submit_deduped(keys, fn):
+    """同じキーの呼び出しを 1 回にまとめて _STAGE_EXECUTOR へ投入。返却: キー → Future (None キーは除外)。"""
+    return {key: _STAGE_EXECUTOR.submit(fn, key) for key in dict.fromkeys(keys) if key is not None}
+
+
+def _collect(futures: dict, deadline: Deadline, default):
+    """Future を締切まで待って回収。締切超過 / 失敗は default。"""
+    out = {}
+    for key, fut in futures.items():
+        try:
+            out[key] = fut.result(timeout=max(0.0, deadline.remaining()))
+        except Exception:
+            out[key] = default
+    return out
+
+
+@app.post("/api/suggest/batch")
+def suggest_batch():
+    """POST /api/suggest/batch
+    受信: {"items": [{lat, lon, mood, radius_km, indoor, budget}, ...]} (最大 BATCH_MAX_ITEMS 件)
+    - 天気は (round(lat,2), round(lon,2)) セル単位、POI (近隣POI + 施設付与) は同一問い合わせ単位でバッチ内重複排除
+    - 応答キャッシュ / 意味キャッシュにヒットした item は検索・POI・生成を飛ばす
+    - クエリ埋め込みは 1 回のバッチ呼び出し、類似度は EMB_STORE との行列積 1 回
+    - 生成は同一プロンプトをまとめ、締切を共有して並列実行
+    返却: {"results": [/api/suggest と同じ形 + index], "count", "elapsed_sec"}
+    各 item の fallback / degraded は item 毎に判定する。
+    """
+    deadline = Deadline()
+    client_failed = not _ensure_client()
+
+    raw = request.get_json(silent=True)
+    if raw is None:
+        return _bad_request("JSON body required")
+    try:
+        if isinstance(raw, dict) and isinstance(raw.get("items"), list):
+            for it in raw["items"]:
+                if isinstance(it, dict) and "indoor" in it and it["indoor"] == "":
+                    it["indoor"] = None
+        batch = SuggestBatchRequest.model_validate(raw)
+    except ValidationError as ve:
+        return _bad_request_from_validation(ve)
+    items = [it.model_dump() for it in batch.items]
+    use_poi = not os.environ.get("DISABLE_POI")
+
+    # ---------- 天気 (セル単位で 1 回) ----------
+    cells = [(round(d["lat"], 2), round(d["lon"], 2)) for d in items]
+    cell_origin = {}
+    for c, d in zip(cells, items):
+        cell_origin.setdefault(c, d)
+    weathers = _collect(
+        _submit_deduped(cells, lambda c: _weather_stage(cell_origin[c]["lat"], cell_origin[c]["lon"], deadline)),
+        deadline, ({"current": {}, "_error": "weather_timeout"}, True))
+
+    # ---------- ルールタグ ----------
+    rule_tags_list = []
+    for d, c in zip(items, cells):
+        try:
+            rule_tags_list.append(shortlist_by_rules(weathers[c][0], d) or [])
+        except Exception:
+            rule_tags_list.append([])
+
+    # ---------- 応答キャッシュ (ヒットした item は以降の段を飛ばす) ----------
+    cache_keys = [situation_key(d, weathers[c][0], t, weathers[c][1])
+                  for d, c, t in zip(items, cells, rule_tags_list)]
+    cached = {}
+    for i, (c, key) in enumerate(zip(cells, cache_keys)):
+        hit = cached_suggest_response(key, weathers[c][0], 0.0)
+        if hit is not None:
+            cached[i] = hit
+    todo = [i for i in range(len(items)) if i not in cached]
+
+    # ---------- クエリ埋め込み (1 バッチ) → 意味キャッシュ → 検索 (行列積 1 回) ----------
+    candidates_list = [[] for _ in items]
+    q_units, searched = {}, set()
+    if not client_failed and LOCAL_EMBED != "first" and not deadline.expired() and todo:
+        try:
+            q_units = dict(zip(todo, _embed_queries([_build_query(items[i], rule_tags_list[i]) for i in todo])))
+        except Exception as e:
+            app.logger.warning("embed batch query failed: %s %s", e.__class__.__name__, str(e))
+        for i in todo:
+            hit = semantic_suggest_response(cache_keys[i], q_units.get(i), weathers[cells[i]][0], 0.0)
+            if hit is not None:
+                cached[i] = hit
+        todo = [i for i in todo if i not in cached]
+        vec_rows = [i for i in todo if i in q_units]
+        if vec_rows and _ensure_embeddings():
+            split = [_split_rule_tags(rule_tags_list[i]) for i in vec_rows]
+            try:
+                for i, cands in zip(vec_rows, top_k_by_vectors(
+                        np.vstack([q_units[i] for i in vec_rows]), 8,
+                        [f for f, _ in split], [b for _, b in split])):
+                    candidates_list[i] = cands
+                searched.update(vec_rows)
+            except Exception as e:
+                app.logger.warning("batch search failed: %s %s", e.__class__.__name__, str(e))
+    # Gemini のベクトルで検索できなかった item はローカル埋め込みで (ネットワーク不要)
+    for i in todo:
+        if i not in searched:
+            candidates_list[i] = _candidate_stage(None, rule_tags_list[i], _local_query(items[i], rule_tags_list[i]))
+
+    # ---------- 近隣POI + 施設情報付与 (同一問い合わせは POI 取得 1 回) ----------
+    poi_tags = [poi_tags_for(t, cands) for t, cands in zip(rule_tags_list, candidates_list)]
+    poi_keys = [((round(d["lat"], 3), round(d["lon"], 3), int(d["radius_km"] * 1000)) + pt
+                 if use_poi and d.get("radius_km") and i not in cached else None)
+                for i, (d, pt) in enumerate(zip(items, poi_tags))]
+
+    def _fetch_key(key):
+        try:
+            return fetch_pois(key[0], key[1], key[2], key[3], key[4], poi_budget(deadline))
+        except Exception as e:
+            app.logger.debug("poi fetch failed: %s", e.__class__.__name__)
+            return None
+
+    fetched = _collect(_submit_deduped(poi_keys, _fetch_key), deadline, None)
+    pois, poi_failed = {}, set()
+    for i, (d, key, (near_tags, place_tags)) in enumerate(zip(items, poi_keys, poi_tags)):
+        if key is None:
+            continue
+        pois[i], candidates_list[i], failed = _apply_pois(
+            fetched.get(key), near_tags, place_tags, candidates_list[i], key[2])
+        if failed:
+            poi_failed.add(i)
+
+    # ---------- Gemini 生成 (同一プロンプトは 1 回) ----------
+    prompts = []
+    for i, (d, c, cands) in enumerate(zip(items, cells, candidates_list)):
+        if pois.get(i):
+            d["_near_pois"] = pois[i]
+        prompts.append(_build_prompt(d, weathers[c][0], cands) if i not in cached else None)
+    # 生成は GEN_POOL へ直接投入し、このスレッドで締切まで回収する
+    # (_STAGE_EXECUTOR のスレッドを生成待ちで塞ぐと、並行する単発リクエストの天気等のステージが詰まる)
+    texts, gen_timed_out = {}, set()
+    timed_out = deadline.expired()
+    if not client_failed and not timed_out:
+        jobs = {p: _submit_generation(p, deadline.remaining()) for p in dict.fromkeys(prompts) if p is not None}
+        for p, job in jobs.items():
+            texts[p] = _await_generation(job, p, deadline.remaining())
+            if texts[p] is None and job is not None and deadline.expired():
+                gen_timed_out.add(p)
+
+    elapsed = round(deadline.elapsed(), 3)
+    results = []
+    for i, (d, c, rule_tags, cands, prompt) in enumerate(
+            zip(items, cells, rule_tags_list, candidates_list, prompts)):
+        if i in cached:
+            results.append({"index": i, **cached[i], "elapsed_sec": elapsed})
+            continue
+        weather, w_degraded = weathers[c]
+        text = texts.get(prompt)
+        # 単発の /api/suggest と同じ成否なら同じ形 (締切超過は fallback_reason=timeout, near_pois なし)
+        item = {"index": i, **suggest_response(
+            weather, d, rule_tags, cands, pois.get(i, []), text, elapsed, bool(w_degraded or i in poi_failed),
+            timed_out=not text and (timed_out or prompt in gen_timed_out))}
+        remember_suggest_response(cache_keys[i], item, q_units.get(i))
+        results.append(item)
+
+    try:
+        log_obj = {
+            "ts": time.time(),
+            "path": "/api/suggest/batch",
+            "latency_ms": int(elapsed * 1000),
+            "count": len(items),
+            "weather_cells": len(set(cells)),
+            "poi_queries": len(fetched),
+            "generations": len(set(prompts) - {None}) if texts else 0,
+            "prompt_tokens": sum(estimate_tokens(p) for p in set(prompts) - {None}) if texts else 0,
+            "cache_hits": len(cached),
+            "fallback": sum(1 for r in results if r["fallback"]),
+            "breakers": breaker_states(),
         }
         app.logger.info("METRIC %s", json.dumps(log_obj, ensure_ascii=False, separators=(",", ":")))
     except Exception:
         pass
-    return jsonify(response_data)
+    return jsonify({"results": results, "count": len(results), "elapsed_sec": elapsed})
 
 @app.get('/healthz')
 def healthz():
-    return jsonify({"ok": True}), 200
+    return jsonify(health_status()), 200
+
+
+def health_status() -> dict:
+    """/healthz の本文 (キャッシュ / 上流接続の統計)。"""
+    return {
+        "ok": True,
+        "caches": {
+            "query_embedding": QUERY_EMB_CACHE.stats(),
+            "poi_tiles": POI_TILES.stats(),
+            "poi_store": POI_STORE.stats() if POI_STORE is not None else None,
+            "weather": dict(WEATHER_CACHE.stats(), prewarm=WEATHER_PREWARMER.stats()),
+            "suggest": SUGGEST_CACHE.stats(),
+            "semantic": SEMANTIC_CACHE.stats(),
+        },
+        "generation": dict(GEN_POOL.stats(), model=MODEL_HANDLE.stats()),
+        "local_embedder": LOCAL_INDEX.stats(),
+        "embeddings": dict(EMB_STORE.stats(), index=ANN_INDEX.stats()) if EMB_STORE is not None else None,
+        "upstreams": HTTP.stats(),
+        "breakers": {name: b.stats() for name, b in BREAKERS.items()},
+    }
 
 if __name__ == "__main__":
     # ログレベルを設定（デバッグ用）
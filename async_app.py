@@ -0,0 +1,390 @@
+"""/api/suggest の asyncio 版 (純 ASGI アプリ)。
+
+app.py (Flask) と同じ検証・応答契約 (parse_suggest_request / suggest_response) のまま、
+上流呼び出しを httpx.AsyncClient と google.generativeai の *_async で待つ。
+タイムアウトは asyncio.wait_for、リトライ間隔は asyncio.sleep なので待機中にスレッドを占有せず、
+1 プロセスで数百件の遅い上流待ちを同時に抱えられる。
+キャッシュ (天気 / POI タイル / クエリ埋め込み / 応答 / 意味) と検索インデックスは app.py のものを共有する。
+
+起動:
+  pip install uvicorn
+  uvicorn async_app:app --host 0.0.0.0 --port 8000
+"""
+import asyncio, json, os, time
+import httpx
+import numpy as np
+from pydantic import ValidationError
+
+import app as core
+from app import Deadline
+
+# 全上流で共有する同時接続数の上限 (keep-alive 保持数は HTTP_POOL_MAXSIZE)
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 256))
+
+_HTTP = {}  # イベントループ → httpx.AsyncClient
+_WEATHER_INFLIGHT = {}  # (ループ, セル) → asyncio.Task (同じセルの同時取得を 1 本に)
+_GEN_SLOTS = {}  # イベントループ → asyncio.Semaphore (生成の同時数)
+
+
+def _http() -> httpx.AsyncClient:
+    """実行中のイベントループ用の共有 AsyncClient (接続は keep-alive で再利用)。"""
+    loop = asyncio.get_running_loop()
+    client = _HTTP.get(loop)
+    if client is None:
+        client = _HTTP[loop] = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=core.HTTP_POOL_MAXSIZE))
+    return client
+
+
+async def aclose():
+    client = _HTTP.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+# ---------------- 天気 ----------------
+async def fetch_weather(lat, lon):
+    resp = await _http().get(core.weather_url(lat, lon), timeout=6)
+    return resp.json()
+
+
+async def _fetch_weather_with_retry(lat: float, lon: float, deadline: Deadline):
+    """app._fetch_weather_with_retry の非同期版。(weather, ok) を返す。"""
+    breaker = core.BREAKERS["open_meteo"]
+    try:
+        last_err = None
+        for attempt in range(3):
+            if not breaker.allow():
+                return {"current": {}, "_error": "weather_failed:circuit_open"}, False
+            try:
+                weather = await fetch_weather(lat, lon)
+                breaker.success()
+                break
+            except httpx.HTTPError as e:
+                last_err = e
+                breaker.failure()
+                await asyncio.sleep(min(0.3 * (attempt + 1), max(0.0, deadline.remaining())))
+        else:
+            return {"current": {}, "_error": f"weather_failed:{last_err}"}, False
+    except Exception as e:
+        breaker.failure()
+        return {"current": {}, "_error": f"weather_failed:{e.__class__.__name__}"}, False
+    if not isinstance(weather, dict) or "current" not in weather:
+        return {"current": {}, "_error": "weather_invalid"}, False
+    return weather, True
+
+
+async def _fill_weather(key, lat: float, lon: float, deadline: Deadline):
+    weather, ok = await _fetch_weather_with_retry(lat, lon, deadline)
+    if ok:
+        core.WEATHER_CACHE.put(key, weather)
+    else:
+        core.WEATHER_CACHE._count("failures")
+    return weather, not ok
+
+
+async def weather_stage(lat: float, lon: float, deadline: Deadline):
+    """WEATHER_CACHE を共有する天気ステージ。(weather, degraded) を返す。
+    古い値の裏更新は同期版と同じく共有プールで行う (リクエスト経路は待たない)。"""
+    core.WEATHER_HOT_CELLS.touch(lat, lon)
+    if core.WEATHER_PREWARM:
+        core.WEATHER_PREWARMER.start()
+    cache = core.WEATHER_CACHE
+    key = core._weather_cell(lat, lon)
+    weather, state = cache.lookup(key)
+    if state == "fresh":
+        return weather, False
+    if state == "stale":
+        cache.refresh(key, lat, lon)
+        return weather, False
+    if deadline.expired():
+        raise asyncio.TimeoutError("timeout fetching weather")
+    flight = (asyncio.get_running_loop(), key)
+    task = _WEATHER_INFLIGHT.get(flight)
+    if task is None:
+        task = _WEATHER_INFLIGHT[flight] = asyncio.ensure_future(_fill_weather(key, lat, lon, deadline))
+        task.add_done_callback(lambda _t: _WEATHER_INFLIGHT.pop(flight, None))
+    else:
+        cache._count("coalesced")
+    # 待ち手が締切で離れても取得自体は続けて他の待ち手に結果を渡す
+    weather, degraded = await asyncio.wait_for(asyncio.shield(task), timeout=max(0.0, deadline.remaining()))
+    return cache.now_view(weather), degraded
+
+
+# ---------------- POI ----------------
+async def overpass_fetch(query: str, timeout: float, deadline_at: float):
+    """app._overpass_fetch の非同期版。成功時は elements、締切超過 / 失敗 / ブレーカー open は None。"""
+    breaker = core.BREAKERS["overpass"]
+    last_err = None
+    for attempt in range(3):
+        remain = deadline_at - time.time()
+        if remain <= 0 or not breaker.allow():
+            break
+        try:
+            resp = await _http().post(core.OVERPASS_URL, data={"data": query},
+                                      timeout=min(timeout, max(0.5, remain)), headers=core.OVERPASS_HEADERS)
+            if resp.status_code != 200:
+                raise RuntimeError(f"status {resp.status_code}")
+            elements = resp.json().get("elements", [])
+            breaker.success()
+            return elements
+        except Exception as e:
+            last_err = e
+            breaker.failure()
+            await asyncio.sleep(min(0.25 * (attempt + 1), max(0.0, deadline_at - time.time())))
+    core.app.logger.debug("Overpass failed: %s", last_err)
+    return None
+
+
+async def fetch_pois(lat: float, lon: float, radius_m: int, near_tags, place_tags, remaining_budget: float):
+    """app.fetch_pois の非同期版 (POI_STORE → POI_TILES、欠けたタイルのみ Overpass 1 回)。"""
+    tags = list(dict.fromkeys(list(near_tags) + list(place_tags)))
+    if not tags:
+        return [], np.empty(0), True
+    radius_m, features, timeout, deadline_at = core._poi_fetch_plan(radius_m, tags, remaining_budget)
+    from_store = core._poi_store_answer(lat, lon, radius_m, features)
+    if from_store is not None:
+        return from_store
+    tiles = core.POI_TILES
+    have, missing = tiles.lookup(lat, lon, radius_m, features)
+    complete = True
+    if missing:
+        elements = None
+        if deadline_at - time.time() > 0:
+            tiles.fetches += 1
+            elements = await overpass_fetch(tiles.build_query(missing), timeout, deadline_at)
+        if elements is None:
+            complete = False
+        else:
+            tiles.fill(missing, elements, have)
+    out, dists = tiles.answer(lat, lon, radius_m, have)
+    return out, dists, complete
+
+
+async def poi_stage(lat: float, lon: float, radius_km, rule_tags, candidates, deadline: Deadline):
+    """app._poi_stage の非同期版。(near_pois, places 付き candidates, failed) を返す。"""
+    near_tags, place_tags = core.poi_tags_for(rule_tags, candidates)
+    radius_m = int(radius_km * 1000)
+    try:
+        fetched = await fetch_pois(lat, lon, radius_m, near_tags, place_tags, core.poi_budget(deadline))
+    except Exception as e:
+        core.app.logger.debug("poi fetch failed: %s", e.__class__.__name__)
+        fetched = None
+    return core._apply_pois(fetched, near_tags, place_tags, candidates, radius_m)
+
+
+# ---------------- 埋め込み検索 / 生成 ----------------
+async def embed_query(query_text: str):
+    """クエリ埋め込み (単位ベクトル)。QUERY_EMB_CACHE を共有し、ミス時のみ embed_content_async。"""
+    q_unit = core.QUERY_EMB_CACHE.get(query_text)
+    if q_unit is not None:
+        return q_unit
+    breaker = core.BREAKERS["gemini"]
+    if not breaker.allow():
+        raise core.CircuitOpenError("gemini")
+    try:
+        res = await core.client.embed_content_async(model=core.EMBEDDING_MODEL, content=query_text)
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success()
+    q = np.asarray(res['embedding'], dtype=np.float32)
+    q_unit = q / (np.linalg.norm(q) + 1e-9)
+    core.QUERY_EMB_CACHE.put(query_text, q_unit)
+    return q_unit
+
+
+async def query_vec_stage(query: str):
+    """app._query_vec_stage の非同期版。失敗 / クライアント無しは None。
+    検索 (app._candidate_stage) は数 ms の同期処理なのでそのまま呼ぶ。"""
+    if core.client is None:
+        return None
+    try:
+        return await embed_query(query)
+    except Exception as e:
+        core.app.logger.warning("embed query failed: %s %s", e.__class__.__name__, str(e))
+        return None
+
+
+def _gen_slots() -> asyncio.Semaphore:
+    """実行中のイベントループ用の生成同時数制限 (GEN_WORKERS 本)。"""
+    loop = asyncio.get_running_loop()
+    sem = _GEN_SLOTS.get(loop)
+    if sem is None:
+        sem = _GEN_SLOTS[loop] = asyncio.Semaphore(core.GEN_POOL.workers)
+    return sem
+
+
+async def _generate_in_slot(prompt: str, called: list):
+    """生成スロットを取って generate_content_async。返却: (resp, 開始時刻, 所要秒)。
+    Gemini を呼び始めたら called に印を付ける (スロット待ちのまま締切なら空のまま)。"""
+    async with _gen_slots():
+        called.append(True)
+        started = time.time()
+        resp = await core.generation_model().generate_content_async(prompt)
+        return resp, started, time.time() - started
+
+
+async def generate_suggestions(prompt: str, timeout: float):
+    """Gemini で生成 (generate_content_async)。受付拒否 / timeout 秒以内に得られなければ None。
+    受付制御と生成時間の実績は Flask 版と同じ GEN_POOL で数え、同時実行数はセマフォで抑える。"""
+    if core.client is None or timeout <= 0:
+        return None
+    breaker = core.BREAKERS["gemini"]
+    if not breaker.allow():
+        return None
+    if not core.GEN_POOL.try_admit(timeout):
+        core.app.logger.warning("generation rejected: pool busy (pending=%s)", core.GEN_POOL.pending)
+        return None
+    latency, called = None, []
+    try:
+        # asyncio.timeout は 3.11 以降のみなので wait_for で締める (README の対応版は 3.8+)
+        resp, started, latency = await asyncio.wait_for(_generate_in_slot(prompt, called), timeout=timeout)
+        breaker.success()
+        core._log_generation(prompt, resp, started)
+        return (getattr(resp, "text", None) or "").strip() or None
+    except Exception as e:
+        if not called:  # スロット待ちのまま締切: Gemini は呼んでいないのでブレーカーに数えない
+            core.app.logger.warning("generation timed out waiting for a slot")
+            return None
+        breaker.failure()
+        core.app.logger.warning("generation failed: %s", e.__class__.__name__)
+        return None
+    finally:
+        core.GEN_POOL.done(latency)
+
+
+async def _bounded(coro, deadline: Deadline, default):
+    """締切まで待って結果、超過なら default。"""
+    try:
+        return await asyncio.wait_for(coro, timeout=max(0.0, deadline.remaining()))
+    except asyncio.TimeoutError:
+        return default
+
+
+# ---------------- ハンドラ ----------------
+async def suggest(raw):
+    """POST /api/suggest (非同期版)。返却: (status, body)。段の順序・締切・応答は Flask 版と同じ。"""
+    core.app.logger.info("=== /api/suggest REQUEST START ===")
+    deadline = Deadline()
+    start = deadline.start
+    client_failed = not core._ensure_client()
+
+    # ---------- 入力バリデーション (Pydantic) ----------
+    if raw is None:
+        return 400, {"error": "invalid_request", "details": ["JSON body required"]}
+    try:
+        req_model = core.parse_suggest_request(raw)
+    except ValidationError as ve:
+        return 400, {"error": "invalid_request", "details": core._validation_issues(ve)}
+    lat = req_model.lat
+    lon = req_model.lon
+    data = req_model.model_dump()
+    use_poi = bool(data.get("radius_km")) and not os.environ.get("DISABLE_POI")
+
+    # ---------- 天気 → ルールタグ ----------
+    try:
+        weather, degraded = await asyncio.wait_for(weather_stage(lat, lon, deadline),
+                                                   timeout=max(0.0, deadline.remaining()))
+    except asyncio.TimeoutError:
+        return 504, {"error": "timeout fetching weather"}
+    if deadline.expired():
+        return 504, {"error": "timeout before embedding"}
+    try:
+        rule_tags = core.shortlist_by_rules(weather, data) or []
+    except Exception as e:
+        return 500, {"error": f"rule engine error: {e}"}
+    cache_key = core.situation_key(data, weather, rule_tags, degraded)
+    cached = core.cached_suggest_response(cache_key, weather, round(time.time() - start, 3))
+    if cached is not None:
+        core._log_suggest(cached, weather, data)
+        return 200, cached
+
+    # ---------- クエリ埋め込み → 意味キャッシュ → Embedding検索候補 → 近隣POI + 施設情報付与 ----------
+    q_unit = None
+    if not client_failed and core.LOCAL_EMBED != "first":
+        q_unit = await _bounded(query_vec_stage(core._build_query(data, rule_tags)), deadline, None)
+        cached = core.semantic_suggest_response(cache_key, q_unit, weather, round(time.time() - start, 3))
+        if cached is not None:
+            core._log_suggest(cached, weather, data)
+            return 200, cached
+    candidates = core._candidate_stage(q_unit, rule_tags, core._local_query(data, rule_tags))
+    near_pois = []
+    if use_poi:
+        poi_res = await _bounded(poi_stage(lat, lon, data["radius_km"], rule_tags, candidates, deadline),
+                                 deadline, None)
+        if poi_res is None:
+            degraded = True
+        else:
+            near_pois, candidates, poi_failed = poi_res
+            degraded = degraded or poi_failed
+    if near_pois:
+        data["_near_pois"] = near_pois
+
+    # ---------- Gemini 生成 ----------
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        body = core.suggest_response(weather, data, rule_tags, candidates, near_pois, None,
+                                     round(time.time() - start, 3), degraded, timed_out=True)
+        core._log_suggest(body)
+        return 200, body
+    text = None
+    if not client_failed:
+        text = await generate_suggestions(core._build_prompt(data, weather, candidates), remaining)
+    body = core.suggest_response(weather, data, rule_tags, candidates, near_pois, text,
+                                 round(time.time() - start, 3), degraded)
+    core.remember_suggest_response(cache_key, body, q_unit)
+    core._log_suggest(body, weather, data)
+    return 200, body
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        msg = await receive()
+        chunks.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _send_json(send, status: int, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI エントリポイント: POST /api/suggest, GET /healthz。"""
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    path, method = scope["path"], scope["method"]
+    try:
+        if path == "/api/suggest" and method == "POST":
+            raw_body = await _read_body(receive)
+            try:
+                raw = json.loads(raw_body) if raw_body else None
+            except ValueError:
+                raw = None
+            status, payload = await suggest(raw)
+        elif path == "/healthz" and method == "GET":
+            status, payload = 200, core.health_status()
+        else:
+            status, payload = 404, {"error": "not_found"}
+    except Exception as e:
+        core.app.logger.exception("UNHANDLED EXCEPTION: %s", type(e).__name__)
+        status, payload = 500, {"error": "internal_error", "debug": str(e)}
+    await _send_json(send, status, payload)
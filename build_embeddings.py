@@ -0,0 +1,65 @@
+"""カタログ埋め込みのオフライン増分ビルド。
+
+activities_seed.json の内容ハッシュを embeddings.manifest.json と突き合わせ、
+追加/変更されたアクティビティだけを embed_content のバッチ呼び出しで埋め込む。
+
+使い方:
+  GEMINI_API_KEY=... python build_embeddings.py             # 追加/変更分のみ
+  GEMINI_API_KEY=... python build_embeddings.py --full      # 全件再計算
+  GEMINI_API_KEY=... python build_embeddings.py --batch-size 50
+  python build_embeddings.py --store-kind i8                # 差分が無ければ API キー不要 (ストアのみ再生成)
+  python build_embeddings.py --dims 512                     # 先頭 512 次元に切り詰めたストア (--projection pca も可)
+  python build_embeddings.py --ivf --nlist 1024             # 大規模カタログ向け IVF インデックスも作る
+"""
+import argparse, sys, time
+from app import (ACTIVITIES, EMB_BATCH_SIZE, EMB_PATH, EMB_MANIFEST_PATH, EMB_STORE_PATH, EMB_STORE_KIND,
+                 EMB_DIMS, EMB_PROJECTION, ANN_INDEX_PATH, EmbeddingStore, IVFIndex, build_catalog_embeddings,
+                 _catalog_digest, _ensure_client, _fit_projection)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Incremental catalog embedding build")
+    p.add_argument("--full", action="store_true", help="ignore manifest and re-embed everything")
+    p.add_argument("--batch-size", type=int, default=EMB_BATCH_SIZE)
+    p.add_argument("--out", default=EMB_PATH)
+    p.add_argument("--manifest", default=EMB_MANIFEST_PATH)
+    p.add_argument("--store", default=EMB_STORE_PATH, help="quantized memmap store path ('' to skip)")
+    p.add_argument("--store-kind", default=EMB_STORE_KIND, choices=["f32", "f16", "i8"])
+    p.add_argument("--dims", type=int, default=EMB_DIMS, help="reduce the store to this many dims (0 = full)")
+    p.add_argument("--projection", default=EMB_PROJECTION, choices=["truncate", "pca"])
+    p.add_argument("--ivf", action="store_true", help="also build the IVF approximate index")
+    p.add_argument("--nlist", type=int, default=0, help="IVF cells (0 = 4*sqrt(N))")
+    p.add_argument("--index", default=ANN_INDEX_PATH)
+    args = p.parse_args(argv)
+
+    # 埋め込みが必要な差分があるときだけクライアントを使う
+    _ensure_client()
+    t0 = time.perf_counter()
+    try:
+        emb, stats = build_catalog_embeddings(ACTIVITIES, npy_path=args.out, manifest_path=args.manifest,
+                                              full=args.full, batch_size=args.batch_size,
+                                              store_path=args.store, store_kind=args.store_kind,
+                                              store_dims=args.dims, store_projection=args.projection)
+    except RuntimeError as e:
+        print(f"build failed: {e}", file=sys.stderr)
+        return 1
+    print(f"built {args.out}: shape={emb.shape} total={stats['total']} reused={stats['reused']} "
+          f"embedded={stats['embedded']} batches={stats['batches']} ({time.perf_counter() - t0:.2f}s)")
+    if args.store:
+        st = EmbeddingStore.open(args.store)
+        proj = f" projection={st.projection.kind} {st.src_dim}->{st.shape[1]}" if st.projection is not None else ""
+        print(f"store {args.store}: kind={args.store_kind} dim={st.shape[1]}{proj} {st.nbytes / 1e6:.2f}MB")
+    if args.ivf:
+        t1 = time.perf_counter()
+        store = (EmbeddingStore.open(args.store) if args.store
+                 else EmbeddingStore.from_float32(emb, catalog_digest=_catalog_digest(ACTIVITIES),
+                                                  projection=_fit_projection(EmbeddingStore.normalize(emb),
+                                                                             args.dims, args.projection)))
+        index = IVFIndex.build(store, nlist=args.nlist)
+        index.save(args.index)
+        print(f"index {args.index}: nlist={index.nlist} ({time.perf_counter() - t1:.2f}s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""埋め込み検索の recall 評価ハーネス。
+
+exact float32 (embeddings.npy を正規化) のランキングを正解として、
+近似経路 (量子化ストア・次元削減・IVF) の top-k recall とスコア誤差を測る。
+クエリは API を呼ばずに、カタログ行へノイズを加えた合成ベクトルを使う。
+
+使い方:
+  python eval_recall.py quant                      # f16 / i8 をメモリ上で量子化して比較
+  python eval_recall.py quant --store embeddings.ppemb --k 8
+  python eval_recall.py ann --synthetic 100000 --nprobe 1 4 8 16   # IVF の nprobe スイープ
+  python eval_recall.py dims --dims 256 512 768    # 切り詰め / PCA の次元スイープ (EMB_DIMS の選定)
+  python eval_recall.py dims --store embeddings.ppemb
+"""
+import argparse, sys, time
+import numpy as np
+from app import EMB_PATH, EMB_STORE_KIND, EmbeddingProjection, EmbeddingStore, IVFIndex
+
+
+def load_exact(npy_path: str):
+    """正解側: float32 単位ベクトル行列。"""
+    return EmbeddingStore.normalize(np.load(npy_path).astype(np.float32))
+
+
+def synthetic_queries(unit, n: int, noise: float, seed: int = 0):
+    """カタログ行 + ガウスノイズの単位ベクトル (n, dim)。"""
+    rng = np.random.default_rng(seed)
+    base = unit[rng.integers(0, unit.shape[0], size=n)]
+    q = base + noise * rng.standard_normal(base.shape).astype(np.float32) / np.sqrt(unit.shape[1])
+    return EmbeddingStore.normalize(q)
+
+
+def synthetic_catalog(n: int, dim: int, clusters: int, seed: int = 0):
+    """クラスタ構造を持つ合成カタログ (単位ベクトル)。実カタログより大きい規模の評価用。"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, clusters, size=n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return EmbeddingStore.normalize(x)
+
+
+def topk(sims, k: int):
+    """類似度ベクトルから上位 k のインデックス (順不同)。"""
+    k = min(k, sims.shape[0])
+    return np.argpartition(sims, -k)[-k:] if k < sims.shape[0] else np.arange(k)
+
+
+def recall_at_k(pred, truth) -> float:
+    return len(set(pred.tolist()) & set(truth.tolist())) / max(1, len(truth))
+
+
+def evaluate(exact, search, queries, k: int):
+    """search(q) -> 類似度 (全行) を exact と比較。返却: recall, 平均絶対誤差, ms/クエリ"""
+    recalls, errs, times = [], [], []
+    for q in queries:
+        truth_sims = exact @ q
+        t0 = time.perf_counter()
+        sims = search(q)
+        times.append((time.perf_counter() - t0) * 1000)
+        recalls.append(recall_at_k(topk(sims, k), topk(truth_sims, k)))
+        errs.append(float(np.abs(sims - truth_sims).mean()))
+    return float(np.mean(recalls)), float(np.mean(errs)), float(np.median(times))
+
+
+def cmd_quant(args):
+    exact = load_exact(args.npy)
+    queries = synthetic_queries(exact, args.queries, args.noise, args.seed)
+    stores = []
+    if args.store:
+        stores.append((args.store, EmbeddingStore.open(args.store)))
+    else:
+        for kind in args.kinds:
+            data, scales = EmbeddingStore.quantize(exact, kind)
+            stores.append((kind, EmbeddingStore(data, scales, kind)))
+    print(f"N={exact.shape[0]} D={exact.shape[1]} queries={len(queries)} k={args.k} noise={args.noise}")
+    print(f"{'store':<20} {'recall@k':>9} {'mean|Δ|':>10} {'MB':>8} {'ms/q':>8}")
+    worst = 1.0
+    for name, store in stores:
+        r, err, ms = evaluate(exact, store.scores, queries, args.k)
+        worst = min(worst, r)
+        print(f"{name:<20} {r:>9.4f} {err:>10.2e} {store.nbytes / 1e6:>8.2f} {ms:>8.3f}")
+    return 0 if worst >= args.min_recall else 2
+
+
+def cmd_ann(args):
+    exact = (synthetic_catalog(args.synthetic, args.dim, args.clusters, args.seed)
+             if args.synthetic else load_exact(args.npy))
+    queries = synthetic_queries(exact, args.queries, args.noise, args.seed + 1)
+    store = EmbeddingStore(exact, kind="f32")
+    t0 = time.perf_counter()
+    index = IVFIndex.build(store, nlist=args.nlist, seed=args.seed)
+    print(f"N={exact.shape[0]} D={exact.shape[1]} nlist={index.nlist} build={time.perf_counter() - t0:.2f}s "
+          f"queries={len(queries)} k={args.k}")
+    _, _, exact_ms = evaluate(exact, store.scores, queries[:20], args.k)
+    print(f"{'nprobe':<8} {'recall@k':>9} {'ms/q':>8}   (exact {exact_ms:.3f} ms/q)")
+    worst = 1.0
+    for nprobe in args.nprobe:
+        recalls, times = [], []
+        for q in queries:
+            t1 = time.perf_counter()
+            idx, _ = index.search(q, args.k, nprobe=nprobe)
+            times.append((time.perf_counter() - t1) * 1000)
+            recalls.append(recall_at_k(idx, topk(exact @ q, args.k)))
+        worst = min(worst, float(np.mean(recalls)))
+        print(f"{nprobe:<8} {np.mean(recalls):>9.4f} {np.median(times):>8.3f}")
+    return 0 if worst >= args.min_recall else 2
+
+
+def cmd_dims(args):
+    exact = (synthetic_catalog(args.synthetic, args.dim, args.clusters, args.seed)
+             if args.synthetic else load_exact(args.npy))
+    queries = synthetic_queries(exact, args.queries, args.noise, args.seed + 1)
+    stores = [("full", EmbeddingStore(*EmbeddingStore.quantize(exact, args.kind), args.kind))]
+    if args.store:
+        stores.append((args.store, EmbeddingStore.open(args.store)))
+    else:
+        for kind in args.projections:
+            for dim in args.dims:
+                proj = EmbeddingProjection.fit(exact, dim, kind, seed=args.seed)
+                if proj is None or any(n == f"{kind}-{proj.dim}" for n, _ in stores):
+                    continue  # pca は主成分数がカタログ行数で頭打ちになり同じ次元が続く
+                data, scales = EmbeddingStore.quantize(proj.apply(exact), args.kind)
+                stores.append((f"{kind}-{proj.dim}", EmbeddingStore(data, scales, args.kind, projection=proj)))
+    print(f"N={exact.shape[0]} D={exact.shape[1]} queries={len(queries)} k={args.k} noise={args.noise} kind={args.kind}")
+    print(f"{'store':<20} {'dim':>5} {'recall@k':>9} {'top1':>6} {'MB':>8} {'ms/q':>8}")
+    worst = 1.0
+    for name, store in stores:
+        recalls, top1, times = [], [], []
+        for q in queries:
+            truth = exact @ q
+            t0 = time.perf_counter()
+            sims = store.scores(store.project(q))
+            times.append((time.perf_counter() - t0) * 1000)
+            recalls.append(recall_at_k(topk(sims, args.k), topk(truth, args.k)))
+            top1.append(int(np.argmax(sims)) == int(np.argmax(truth)))
+        r = float(np.mean(recalls))
+        worst = min(worst, r)
+        mb = (store.nbytes + (store.projection.nbytes if store.projection is not None else 0)) / 1e6
+        print(f"{name:<20} {store.shape[1]:>5} {r:>9.4f} {np.mean(top1):>6.3f} {mb:>8.2f} {np.median(times):>8.3f}")
+    return 0 if worst >= args.min_recall else 2
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Top-k recall against the exact float32 ranking")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    q = sub.add_parser("quant", help="quantized store (f16 / i8) vs exact float32")
+    q.add_argument("--store", help="evaluate an on-disk store instead of in-memory quantization")
+    q.add_argument("--kinds", nargs="+", default=["f16", "i8"], choices=["f32", "f16", "i8"])
+    a = sub.add_parser("ann", help="IVF approximate index vs exact search (nprobe sweep)")
+    a.add_argument("--synthetic", type=int, default=0, help="use a synthetic clustered catalog of this size")
+    a.add_argument("--dim", type=int, default=256)
+    a.add_argument("--clusters", type=int, default=200)
+    a.add_argument("--nlist", type=int, default=0)
+    a.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    d = sub.add_parser("dims", help="dimensionality-reduced store (truncate / pca) vs full-dim exact ranking")
+    d.add_argument("--store", help="evaluate an on-disk (possibly reduced) store instead of in-memory projections")
+    d.add_argument("--dims", type=int, nargs="+", default=[256, 512, 768])
+    d.add_argument("--projections", nargs="+", default=["truncate", "pca"], choices=["truncate", "pca"])
+    d.add_argument("--kind", default=EMB_STORE_KIND, choices=["f32", "f16", "i8"], help="store dtype for every row")
+    d.add_argument("--synthetic", type=int, default=0,
+                   help="synthetic catalog of this size (isotropic, so truncation is pessimistic vs real embeddings)")
+    d.add_argument("--dim", type=int, default=3072)
+    d.add_argument("--clusters", type=int, default=200)
+    for sp in (q, a, d):
+        sp.add_argument("--npy", default=EMB_PATH)
+        sp.add_argument("--k", type=int, default=8)
+        sp.add_argument("--queries", type=int, default=200)
+        sp.add_argument("--noise", type=float, default=1.0)
+        sp.add_argument("--seed", type=int, default=0)
+        sp.add_argument("--min-recall", type=float, default=0.0, help="exit 2 if any recall is below this")
+    args = p.parse_args(argv)
+    return {"quant": cmd_quant, "ann": cmd_ann, "dims": cmd_dims}[args.cmd](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
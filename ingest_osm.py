@@ -0,0 +1,101 @@
+"""OSM 抽出からオフライン POI ストアを作る。
+
+TAG_TO_OSM_FEATURES の特徴に一致し名前を持つ node / way (中心点) だけを取り出し、
+app.PoiStore (列指向 + 格子インデックス) として POI_STORE_PATH に書き出す。
+範囲と特徴を網羅する問い合わせは Overpass を呼ばずにこのストアで答える。
+
+使い方:
+  python ingest_osm.py kanto-latest.osm.pbf                 # .osm.pbf (要 pip install osmium)
+  python ingest_osm.py dump.json                            # Overpass JSON ダンプ (out center 推奨)
+  python ingest_osm.py --overpass-bbox 35.5,139.5,35.9,139.95   # Overpass から範囲を取得して更新
+"""
+import argparse, json, sys, time
+from app import (TAG_TO_OSM_FEATURES, POI_STORE_PATH, POI_STORE_CELL_DEG, OVERPASS_URL, OVERPASS_HEADERS, HTTP, PoiStore)
+
+
+def _features():
+    return list(dict.fromkeys(kv for kvs in TAG_TO_OSM_FEATURES.values() for kv in kvs))
+
+
+def load_overpass_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("elements", [])
+
+
+def load_pbf(path: str):
+    """.osm.pbf から node と way (ノード座標の平均を中心点とする) を Overpass 形式で返す。"""
+    try:
+        import osmium
+    except ImportError:
+        raise SystemExit("reading .osm.pbf requires the 'osmium' package (pip install osmium)")
+    wanted = set(_features())
+    out = []
+
+    class Handler(osmium.SimpleHandler):
+        def _keep(self, o):
+            return any((t.k, t.v) in wanted for t in o.tags) and ("name" in o.tags or "name:ja" in o.tags)
+
+        def node(self, n):
+            if self._keep(n):
+                out.append({"type": "node", "id": n.id, "lat": n.location.lat, "lon": n.location.lon,
+                            "tags": {t.k: t.v for t in n.tags}})
+
+        def way(self, w):
+            if not self._keep(w):
+                return
+            pts = [(nd.lat, nd.lon) for nd in w.nodes if nd.location.valid()]
+            if pts:
+                out.append({"type": "way", "id": w.id, "tags": {t.k: t.v for t in w.tags},
+                            "center": {"lat": sum(p[0] for p in pts) / len(pts),
+                                       "lon": sum(p[1] for p in pts) / len(pts)}})
+
+    Handler().apply_file(path, locations=True)
+    return out
+
+
+def fetch_overpass(bbox, timeout: int = 180):
+    """Overpass から bbox (south, west, north, east) 内の対象特徴を 1 回で取得。"""
+    s, w, n, e = bbox
+    parts = "".join(f'nwr["{k}"="{v}"]({s},{w},{n},{e});' for k, v in _features())
+    query = f"[out:json][timeout:{timeout}];({parts});out center qt;"
+    resp = HTTP.post(OVERPASS_URL, data={"data": query}, timeout=timeout + 10, headers=OVERPASS_HEADERS)
+    resp.raise_for_status()
+    return resp.json().get("elements", [])
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Ingest an OSM extract into the offline POI store")
+    p.add_argument("source", nargs="?", help=".osm.pbf or Overpass JSON dump")
+    p.add_argument("--overpass-bbox", help="fetch south,west,north,east from Overpass instead of a file")
+    p.add_argument("--bbox", help="extract bounds south,west,north,east (default: extent of the ingested POIs)")
+    p.add_argument("--out", default=POI_STORE_PATH)
+    p.add_argument("--cell-deg", type=float, default=POI_STORE_CELL_DEG)
+    args = p.parse_args(argv)
+    if bool(args.source) == bool(args.overpass_bbox):
+        p.error("give exactly one of SOURCE or --overpass-bbox")
+
+    t0 = time.perf_counter()
+    bbox = None
+    if args.overpass_bbox or args.bbox:
+        bbox = tuple(float(x) for x in (args.overpass_bbox or args.bbox).split(","))
+        if len(bbox) != 4:
+            p.error("bbox needs south,west,north,east")
+    if args.overpass_bbox:
+        try:
+            elements = fetch_overpass(bbox)
+        except Exception as e:
+            print(f"overpass fetch failed: {e}", file=sys.stderr)
+            return 1
+    elif args.source.endswith(".pbf"):
+        elements = load_pbf(args.source)
+    else:
+        elements = load_overpass_json(args.source)
+    store = PoiStore.from_elements(elements, _features(), cell_deg=args.cell_deg, bbox=bbox)
+    store.save(args.out)
+    print(f"store {args.out}: rows={len(store)} from {len(elements)} elements, "
+          f"cells={len(store.cell_keys)} bbox={store.bbox} ({time.perf_counter() - t0:.2f}s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -147,46 +147,118 @@
     return null;
   }
 
-  function submitSuggest(){
-    var payload=collectPayload();
-    var err=validatePayload(payload);
-    if(err){ showToast(err,true); return; }
-    renderSkeleton(3);
-    show(globalLoading); submitBtn.disabled=true; geoBtn.disabled=true;
+  function renderResult(json){
+    var text = json.suggestions || '';
+    var fallbackHint = null;
+    
+    if(json.fallback || json.degraded){ 
+      var reason = json.fallback_reason;
+      fallbackHint = 'AI生成ができないため、基本的な提案をお送りしました';
+      if(reason === 'timeout') fallbackHint = '処理時間の制限により、基本的な提案をお送りしました';
+      if(json.weather_error) fallbackHint += ' (天気データ取得エラー)';
+    }
+    
+    displaySuggestions(text, fallbackHint);
+    
+    // Display candidates with places if available
+    if(json.candidates && json.candidates.length > 0) {
+      displayCandidatesWithPlaces(json.candidates);
+    }
+    
+    if(json.fallback || json.degraded){ 
+      var reason = json.fallback_reason;
+      var msg = 'AI生成ができないため、基本的な提案をお送りしました';
+      if(reason === 'timeout') msg = '処理時間の制限により、基本的な提案をお送りしました';
+      if(json.weather_error) msg += ' (天気データ取得エラー: ' + json.weather_error + ')';
+      showToast(msg, false); 
+    }
+  }
 
-    fetch('/api/suggest', {
+  // 生成途中のテキスト: 次の番号が現れて閉じたブロックだけカード化し、残りはスケルトンのまま
+  function renderPartial(text, total){
+    var blocks = text.split(/(?=\d+\.)/).filter(function(b){ return b.trim(); });
+    var complete = blocks.slice(0, -1);
+    if(!complete.length) return;
+    displaySuggestions(complete.join(''), null);
+    for(var i=complete.length;i<total;i++){
+      var d=document.createElement('div');
+      d.className='card skeleton';
+      cardsEl.appendChild(d);
+    }
+  }
+
+  function fetchSuggest(payload){
+    return fetch('/api/suggest', {
       method:'POST',
       headers:{ 'Content-Type':'application/json' },
       body: JSON.stringify(payload)
     }).then(function(res){
       if(!res.ok) throw new Error('HTTP '+res.status);
       return res.json();
-    }).then(function(json){
-      var text = json.suggestions || '';
-      var fallbackHint = null;
-      
-      if(json.fallback || json.degraded){ 
-        var reason = json.fallback_reason;
-        fallbackHint = 'AI生成ができないため、基本的な提案をお送りしました';
-        if(reason === 'timeout') fallbackHint = '処理時間の制限により、基本的な提案をお送りしました';
-        if(json.weather_error) fallbackHint += ' (天気データ取得エラー)';
-      }
-      
-      displaySuggestions(text, fallbackHint);
-      
-      // Display candidates with places if available
-      if(json.candidates && json.candidates.length > 0) {
-        displayCandidatesWithPlaces(json.candidates);
+    });
+  }
+
+  // /api/suggest/stream (Server-Sent Events) を読み、delta ごとに完成したカードを描画。
+  // 最終結果 (done イベント) で resolve。ストリーム非対応なら null で resolve (呼び出し側で通常 API へ)。
+  function streamSuggest(payload){
+    return fetch('/api/suggest/stream', {
+      method:'POST',
+      headers:{ 'Content-Type':'application/json', 'Accept':'text/event-stream' },
+      body: JSON.stringify(payload)
+    }).then(function(res){
+      if(!res.ok) throw new Error('HTTP '+res.status);
+      if(!res.body || !res.body.getReader || !window.TextDecoder) return null;
+      var reader = res.body.getReader();
+      var decoder = new TextDecoder();
+      var buf = '';
+      var text = '';
+      var result = null;
+
+      function handle(block){
+        var name = 'message', data = '';
+        block.split('\n').forEach(function(line){
+          if(line.indexOf('event:') === 0) name = line.slice(6).trim();
+          else if(line.indexOf('data:') === 0) data += line.slice(5).trim();
+        });
+        if(!data) return;
+        var msg = JSON.parse(data);
+        if(name === 'delta'){ text += msg.text; renderPartial(text, 3); }
+        else if(name === 'done'){ result = msg; }
       }
-      
-      if(json.fallback || json.degraded){ 
-        var reason = json.fallback_reason;
-        var msg = 'AI生成ができないため、基本的な提案をお送りしました';
-        if(reason === 'timeout') msg = '処理時間の制限により、基本的な提案をお送りしました';
-        if(json.weather_error) msg += ' (天気データ取得エラー: ' + json.weather_error + ')';
-        showToast(msg, false); 
+
+      function pump(){
+        return reader.read().then(function(r){
+          if(!r.done) buf += decoder.decode(r.value, { stream:true });
+          var idx;
+          while((idx = buf.indexOf('\n\n')) >= 0){
+            handle(buf.slice(0, idx));
+            buf = buf.slice(idx + 2);
+          }
+          if(r.done){
+            if(!result) throw new Error('stream ended');
+            return result;
+          }
+          return pump();
+        });
       }
-    }).catch(function(e){
+      return pump();
+    });
+  }
+
+  function submitSuggest(){
+    var payload=collectPayload();
+    var err=validatePayload(payload);
+    if(err){ showToast(err,true); return; }
+    renderSkeleton(3);
+    show(globalLoading); submitBtn.disabled=true; geoBtn.disabled=true;
+
+    streamSuggest(payload).then(function(json){
+      return json || fetchSuggest(payload);
+    }, function(e){
+      // 入力エラーはそのまま、ストリーム経路の障害は通常 API で取り直す
+      if(/^HTTP 4/.test(e.message)) throw e;
+      return fetchSuggest(payload);
+    }).then(renderResult).catch(function(e){
       clearCards();
       showToast('取得失敗: '+ e.message, true);
     }).finally(function(){
@@ -0,0 +1,44 @@
+"""google.generativeai の生成まわり (GenerativeModel / caching.CachedContent) のローカルスタブ。
+ネットワーク無しで、どのシステム指示 / キャッシュで何が送られたかを記録する。"""
+from types import SimpleNamespace
+
+
+class StubGemini:
+    def __init__(self, reply: str = "1. テストプラン", fail_cache: bool = False):
+        self.caches = []  # 作成された CachedContent
+        self.calls = []   # (system_instruction, cached_content 名, prompt)
+        stub = self
+
+        class CachedContent:
+            @classmethod
+            def create(cls, model, *, display_name=None, system_instruction=None, ttl=None, **kw):
+                if fail_cache:
+                    raise RuntimeError("Cached content is too small")
+                cache = SimpleNamespace(name=f"cachedContents/{len(stub.caches)}", model=model,
+                                        system_instruction=system_instruction, ttl=ttl)
+                stub.caches.append(cache)
+                return cache
+
+        class GenerativeModel:
+            def __init__(self, model_name, system_instruction=None, **kw):
+                self.model_name = model_name
+                self.system_instruction = system_instruction
+                self.cached_content = None
+
+            @classmethod
+            def from_cached_content(cls, cached_content, **kw):
+                model = cls(cached_content.model)
+                model.cached_content = cached_content
+                return model
+
+            def generate_content(self, prompt, stream=False):
+                cached = self.cached_content
+                stub.calls.append((self.system_instruction, cached.name if cached else None, prompt))
+                usage = SimpleNamespace(prompt_token_count=len(prompt), candidates_token_count=len(reply),
+                                        cached_content_token_count=len(cached.system_instruction) if cached else 0)
+                if stream:
+                    return iter([SimpleNamespace(text=reply, usage_metadata=usage)])
+                return SimpleNamespace(text=reply, usage_metadata=usage)
+
+        self.caching = SimpleNamespace(CachedContent=CachedContent)
+        self.GenerativeModel = GenerativeModel
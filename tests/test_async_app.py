@@ -0,0 +1,99 @@
+import os, json, sys, time, asyncio
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import httpx
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+import app as app_module  # noqa: E402
+import async_app  # noqa: E402
+
+RAINY = {"current": {"precipitation": 1.0, "apparent_temperature": 20}, "hourly": {"precipitation_probability": [80]}}
+
+
+def _post_many(payloads):
+    async def run():
+        transport = httpx.ASGITransport(app=async_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            return await asyncio.gather(*(c.post("/api/suggest", json=p) for p in payloads))
+    return asyncio.run(run())
+
+
+def test_async_suggest_matches_flask_contract(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(app_module, "client", None)
+    museum = {"type": "node", "id": 1, "lat": 10.0, "lon": 20.0, "tags": {"tourism": "museum", "name": "テスト博物館"}}
+
+    async def fake_weather(lat, lon):
+        return RAINY
+
+    async def fake_pois(*a, **k):
+        return [museum], np.array([0.1]), True
+
+    monkeypatch.setattr(async_app, "fetch_weather", fake_weather)
+    monkeypatch.setattr(async_app, "fetch_pois", fake_pois)
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: RAINY)
+    monkeypatch.setattr(app_module, "fetch_pois", lambda *a, **k: ([museum], np.array([0.1]), True))
+    app_module.WEATHER_CACHE.clear()
+    req = {"lat": 10.0, "lon": 20.0, "radius_km": 1, "mood": "まったり", "budget": ""}
+    (resp,) = _post_many([req])
+    assert resp.status_code == 200
+    body = resp.json()
+    flask_body = app_module.app.test_client().post("/api/suggest", json=req).get_json()
+    assert set(body) == set(flask_body)
+    for k in ("suggestions", "weather", "tags", "candidates", "near_pois", "fallback", "degraded"):
+        assert body[k] == flask_body[k]
+    assert body["near_pois"] == ["テスト博物館"]
+
+
+def test_async_validation_errors_match_flask():
+    bad = {"lat": 91, "lon": 0}
+    (resp,) = _post_many([bad])
+    assert resp.status_code == 400
+    assert resp.json() == app_module.app.test_client().post("/api/suggest", json=bad).get_json()
+
+
+def test_async_holds_many_slow_requests_concurrently(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(app_module, "client", None)
+
+    async def slow_weather(lat, lon):
+        await asyncio.sleep(0.3)
+        return RAINY
+
+    monkeypatch.setattr(async_app, "fetch_weather", slow_weather)
+    app_module.WEATHER_CACHE.clear()
+    # 異なるセル 200 件: スレッドを占有しないので全体でほぼ 1 回分の待ち時間で終わる
+    payloads = [{"lat": -40.0 + i * 0.05, "lon": 100.0} for i in range(200)]
+    t0 = time.perf_counter()
+    resps = _post_many(payloads)
+    assert all(r.status_code == 200 for r in resps)
+    assert time.perf_counter() - t0 < 3.0
+    assert app_module.WEATHER_CACHE.stats()["misses"] >= 200
+
+
+def test_async_generation_success_and_timeout(monkeypatch):
+    class FakeModel:
+        def __init__(self, delay):
+            self.delay = delay
+
+        async def generate_content_async(self, prompt):
+            await asyncio.sleep(self.delay)
+            return type("R", (), {"text": " 1. プラン "})()
+
+    model = {"m": FakeModel(0.0)}
+    monkeypatch.setattr(app_module, "client", object())
+    monkeypatch.setattr(app_module, "generation_model", lambda: model["m"])
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    monkeypatch.setattr(app_module, "GEN_POOL", app_module.GenerationPool(workers=2, max_queue=2))
+    assert asyncio.run(async_app.generate_suggestions("p", 1.0)) == "1. プラン"
+    model["m"] = FakeModel(0.5)
+    t0 = time.perf_counter()
+    assert asyncio.run(async_app.generate_suggestions("p", 0.05)) is None
+    assert time.perf_counter() - t0 < 0.4
+    assert app_module.GEN_POOL.stats()["pending"] == 0
@@ -0,0 +1,49 @@
+import os, json, sys, time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+from app import LRUTTLCache, QueryEmbeddingCache  # noqa: E402
+
+
+def test_lru_ttl_eviction_and_expiry():
+    c = LRUTTLCache(maxsize=2, ttl=0.1)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1  # a を最近使用に
+    c.put("c", 3)           # b が追い出される
+    assert c.get("b") is None
+    assert c.get("c") == 3
+    time.sleep(0.12)
+    assert c.get("a") is None
+    s = c.stats()
+    assert s["evictions"] == 1 and s["expirations"] == 1
+    assert s["hits"] == 2 and s["misses"] == 2
+
+
+def test_query_embedding_cache_persists_across_instances(tmp_path):
+    path = str(tmp_path / "q.sqlite3")
+    vec = np.arange(4, dtype=np.float32) / 10
+    c1 = QueryEmbeddingCache(path, maxsize=8, ttl=60)
+    c1.put("気分:まったり  タグ:cafe 予算:未指定", vec)
+    # 別プロセス相当: 新しいインスタンスはディスクから読める (空白差は正規化で吸収)
+    c2 = QueryEmbeddingCache(path, maxsize=8, ttl=60)
+    got = c2.get("気分:まったり タグ:cafe 予算:未指定")
+    assert got is not None and np.allclose(got, vec)
+    assert c2.get("気分:冒険 タグ: 予算:未指定") is None
+    s = c2.stats()
+    assert s["disk_hits"] == 1 and s["misses"] == 1
+
+
+def test_query_embedding_cache_memory_only():
+    c = QueryEmbeddingCache("", maxsize=1, ttl=60)
+    c.put("a", np.ones(3, dtype=np.float32))
+    assert c.get("a") is not None
+    assert c.stats()["persistent"] is False
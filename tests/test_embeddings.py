@@ -0,0 +1,131 @@
+import os, json, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+from app import build_catalog_embeddings, _load_manifest, _catalog_matches, EmbeddingProjection, EmbeddingStore  # noqa: E402
+
+
+class FakeEmbedder:
+    """テキスト長から決定的なベクトルを返し、呼び出しを記録する。"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t)), 1.0, 0.0] for t in texts]
+
+
+def _acts(n):
+    return [{"name": f"act{i}", "tags": ["cafe"]} for i in range(n)]
+
+
+def test_incremental_build_only_embeds_changed(tmp_path):
+    npy, man = str(tmp_path / "e.npy"), str(tmp_path / "e.json")
+    acts = _acts(5)
+    fake = FakeEmbedder()
+    emb, stats = build_catalog_embeddings(acts, fake, npy, man, batch_size=2)
+    assert emb.shape == (5, 3)
+    assert stats == {"total": 5, "reused": 0, "embedded": 5, "batches": 3}
+    assert [len(c) for c in fake.calls] == [2, 2, 1]
+
+    # 1件変更 + 1件追加 → 2件だけ埋め込み
+    acts[2] = {"name": "changed-activity", "tags": ["museum"]}
+    acts.append({"name": "new", "tags": ["spa"]})
+    fake2 = FakeEmbedder()
+    emb2, stats2 = build_catalog_embeddings(acts, fake2, npy, man, batch_size=100)
+    assert stats2["embedded"] == 2 and stats2["reused"] == 4 and stats2["batches"] == 1
+    assert np.allclose(emb2[0], emb[0])
+    assert _catalog_matches(np.load(npy), _load_manifest(man), acts)
+
+
+def test_legacy_npy_without_manifest_is_reused(tmp_path):
+    npy, man = str(tmp_path / "e.npy"), str(tmp_path / "e.json")
+    np.save(npy, np.ones((3, 3), dtype=np.float32))
+    fake = FakeEmbedder()
+    _, stats = build_catalog_embeddings(_acts(3), fake, npy, man)
+    assert stats["reused"] == 3 and not fake.calls
+    assert _load_manifest(man)["version"] == 1
+
+
+def test_full_rebuild_ignores_manifest(tmp_path):
+    npy, man = str(tmp_path / "e.npy"), str(tmp_path / "e.json")
+    build_catalog_embeddings(_acts(2), FakeEmbedder(), npy, man)
+    _, stats = build_catalog_embeddings(_acts(2), FakeEmbedder(), npy, man, full=True)
+    assert stats["embedded"] == 2
+
+
+@pytest.mark.parametrize("kind,tol", [("f32", 1e-6), ("f16", 1e-3), ("i8", 2e-2)])
+def test_store_roundtrip_memmap(tmp_path, kind, tol):
+    rng = np.random.default_rng(0)
+    emb = rng.standard_normal((50, 64)).astype(np.float32)
+    path = str(tmp_path / f"s.{kind}")
+    EmbeddingStore.write(path, emb, kind)
+    store = EmbeddingStore.open(path)
+    assert store.kind == kind and store.shape == (50, 64)
+    assert isinstance(store.data, np.memmap)
+    unit = emb / np.linalg.norm(emb, axis=1, keepdims=True)
+    q = unit[3]
+    assert np.abs(store.scores(q) - unit @ q).max() < tol
+    assert int(np.argmax(store.scores(q))) == 3
+
+
+def test_store_rejects_unknown_version(tmp_path):
+    path = str(tmp_path / "s.bin")
+    EmbeddingStore.write(path, np.ones((2, 4), dtype=np.float32), "f16")
+    with open(path, "r+b") as f:
+        f.seek(8)
+        f.write((99).to_bytes(4, "little"))
+    with pytest.raises(ValueError):
+        EmbeddingStore.open(path)
+
+
+
+@pytest.mark.parametrize("proj_kind", ["truncate", "pca"])
+def test_reduced_store_roundtrip(tmp_path, proj_kind):
+    rng = np.random.default_rng(1)
+    unit = EmbeddingStore.normalize(rng.standard_normal((40, 64)).astype(np.float32))
+    proj = EmbeddingProjection.fit(unit, 16, proj_kind)
+    path = str(tmp_path / "r.ppemb")
+    EmbeddingStore.write(path, unit, "f32", normalized=True, projection=proj)
+    store = EmbeddingStore.open(path)
+    assert store.shape == (40, 16) and store.src_dim == 64
+    assert store.projection.kind == proj_kind
+    q = unit[5]
+    assert np.allclose(store.project(q), proj.apply(q), atol=1e-6)
+    assert int(np.argmax(store.scores(store.project(q)))) == 5
+    assert EmbeddingProjection.fit(unit, 64, proj_kind) is None  # 元の次元以上は削減しない
+
+
+def test_build_writes_reduced_store(tmp_path):
+    npy, man, st = str(tmp_path / "e.npy"), str(tmp_path / "e.json"), str(tmp_path / "e.ppemb")
+    build_catalog_embeddings(_acts(3), FakeEmbedder(), npy, man, store_path=st, store_kind="f16", store_dims=2)
+    store = EmbeddingStore.open(st)
+    assert store.shape[1] == 2 and store.projection is not None
+    build_catalog_embeddings(_acts(3), FakeEmbedder(), npy, man, store_path=st, store_dims=0)
+    assert EmbeddingStore.open(st).projection is None
+
+def test_build_writes_store_with_catalog_digest(tmp_path):
+    npy, man, st = str(tmp_path / "e.npy"), str(tmp_path / "e.json"), str(tmp_path / "e.ppemb")
+    acts = _acts(4)
+    build_catalog_embeddings(acts, FakeEmbedder(), npy, man, store_path=st, store_kind="i8")
+    store = EmbeddingStore.open(st)
+    assert _catalog_matches(store, None, acts)
+    assert not _catalog_matches(store, None, acts[:3] + [{"name": "other", "tags": []}])
+
+
+def test_committed_manifest_matches_catalog_hashes():
+    # カタログ埋め込みのテキスト / ハッシュ関数が別定義で上書きされると、差分なしでも全件再埋め込みになる
+    import app as app_module
+    manifest = _load_manifest(app_module.EMB_MANIFEST_PATH)
+    if manifest is None:
+        pytest.skip("no committed manifest")
+    assert manifest["hashes"] == [app_module._activity_hash(a) for a in app_module.ACTIVITIES]
@@ -0,0 +1,66 @@
+import os, json, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(__file__))
+import numpy as np
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+import app as app_module  # noqa: E402
+from gemini_stub import StubGemini  # noqa: E402
+
+
+def _setup(monkeypatch, stub, min_tokens=0, ttl=3600):
+    monkeypatch.setattr(app_module, "client", stub)
+    monkeypatch.setattr(app_module, "MODEL_HANDLE", app_module.ModelHandle())
+    monkeypatch.setattr(app_module, "GEN_POOL", app_module.GenerationPool(2, 4))
+    monkeypatch.setattr(app_module, "GEMINI_CACHE_MIN_TOKENS", min_tokens)
+    monkeypatch.setattr(app_module, "GEMINI_CONTEXT_CACHE_TTL", ttl)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+
+
+def test_system_instruction_served_from_context_cache(monkeypatch):
+    stub = StubGemini()
+    _setup(monkeypatch, stub)
+    data = {"lat": 35.0, "lon": 139.0, "mood": "まったり", "radius_km": 2, "indoor": None, "budget": None}
+    prompt = app_module._build_prompt(data, {"current": {"apparent_temperature": 20}}, [{"name": "カフェ", "tags": ["cafe"]}])
+    assert "コンシェルジュ" not in prompt  # 固定の指示は毎回送らない
+    assert app_module._generate_suggestions(prompt, 2.0) == "1. テストプラン"
+    assert app_module._generate_suggestions(prompt + "!", 2.0) == "1. テストプラン"
+    assert len(stub.caches) == 1  # キャッシュは使い回す
+    assert stub.caches[0].system_instruction == app_module.SYSTEM_INSTRUCTION
+    assert stub.caches[0].model == f"models/{app_module.GEMINI_MODEL}"
+    assert [c[1] for c in stub.calls] == ["cachedContents/0"] * 2
+    assert app_module.MODEL_HANDLE.stats()["mode"] == "cached_content"
+
+
+def test_context_cache_refreshed_before_expiry(monkeypatch):
+    stub = StubGemini()
+    _setup(monkeypatch, stub, ttl=app_module.ModelHandle.REFRESH_MARGIN)  # 期限 - 余裕 = 即作り直し
+    app_module.generation_model()
+    app_module.generation_model()
+    assert len(stub.caches) == 2
+
+
+def test_context_cache_falls_back_to_system_instruction(monkeypatch):
+    stub = StubGemini(fail_cache=True)
+    _setup(monkeypatch, stub)
+    assert app_module._generate_suggestions("[ユーザー条件]", 2.0) == "1. テストプラン"
+    assert stub.calls[0][:2] == (app_module.SYSTEM_INSTRUCTION, None)
+    st = app_module.MODEL_HANDLE.stats()
+    assert st["mode"] == "system_instruction" and st["cache_errors"] == 1
+    # 失敗後は TTL まで作成を再試行しない
+    app_module.generation_model()
+    assert st["cache_errors"] == app_module.MODEL_HANDLE.stats()["cache_errors"]
+
+
+def test_small_instruction_skips_cache_api(monkeypatch):
+    stub = StubGemini()
+    _setup(monkeypatch, stub, min_tokens=10 ** 6)
+    app_module.generation_model()
+    assert stub.caches == []
+    assert app_module.MODEL_HANDLE.stats()["mode"] == "system_instruction"
@@ -0,0 +1,85 @@
+import os, json, sys, threading
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+from app import UpstreamHTTP  # noqa: E402
+
+
+class _KeepAlive(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _ok(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._ok()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._ok()
+
+    def log_message(self, *a):
+        pass
+
+
+def test_upstream_http_reuses_connections_per_host():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAlive)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    try:
+        base = f"http://127.0.0.1:{srv.server_address[1]}"
+        http = UpstreamHTTP(pool_maxsize=4)
+        for i in range(5):
+            assert http.get(f"{base}/v1/forecast?i={i}", timeout=5).json() == {"ok": True}
+        http.post(f"{base}/api/interpreter", data={"data": "x"}, timeout=5)
+        s = http.stats()[base]
+        assert s["requests"] == 6 and s["connections"] == 1
+        assert s["reuse_rate"] > 0.8
+    finally:
+        srv.shutdown()
+
+
+def test_circuit_breaker_opens_short_circuits_and_recovers():
+    from app import CircuitBreaker
+    healthy = {"ok": False}
+
+    def probe():
+        if not healthy["ok"]:
+            raise RuntimeError("still down")
+
+    b = CircuitBreaker("x", probe=None, failures=3)  # バックグラウンド試行は起動させず probe_once で確認
+    for _ in range(2):
+        b.failure()
+    assert b.state == "closed" and b.allow()
+    b.failure()
+    assert b.state == "open" and not b.allow() and b.stats()["short_circuited"] == 1
+    b.probe = probe
+    assert b.probe_once() is False and b.state == "open"
+    healthy["ok"] = True
+    assert b.probe_once() is True and b.state == "closed" and b.allow()
+    assert b.stats()["opened"] == 1 and b.consecutive_failures == 0
+
+
+def test_open_overpass_breaker_skips_call_immediately(monkeypatch):
+    import time
+    import app as app_module
+    b = app_module.CircuitBreaker("overpass", failures=1)
+    b.failure()
+    monkeypatch.setitem(app_module.BREAKERS, "overpass", b)
+    monkeypatch.setattr(app_module.HTTP, "post", lambda *a, **k: (_ for _ in ()).throw(AssertionError("called")))
+    t0 = time.perf_counter()
+    assert app_module._overpass_fetch("[out:json];", 2.0, time.time() + 5) is None
+    assert time.perf_counter() - t0 < 0.01
+    assert "overpass" in app_module.health_status()["breakers"]
@@ -0,0 +1,476 @@
+import os, json, sys, threading, time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+import app as app_module  # noqa: E402
+from app import Deadline, StageGraph  # noqa: E402
+
+
+def test_stage_graph_runs_independent_stages_concurrently():
+    g = StageGraph(Deadline(5.0))
+    g.add("a", lambda: (time.sleep(0.2), "A")[1])
+    g.add("b", lambda: (time.sleep(0.2), "B")[1])
+    g.add("ab", lambda a, b: a + b, deps=("a", "b"))
+    t0 = time.perf_counter()
+    assert g.result("ab") == "AB"
+    # 直列なら 0.4s 以上
+    assert time.perf_counter() - t0 < 0.35
+
+
+def test_stage_graph_deadline_and_failure_defaults():
+    g = StageGraph(Deadline(0.05))
+    g.add("slow", lambda: time.sleep(0.5))
+    g.add("boom", lambda: 1 / 0)
+    g.add("child", lambda x: x, deps=("boom",))
+    assert g.result("slow", default="late") == "late"
+    assert g.result("child", default=None) is None
+    with pytest.raises(ZeroDivisionError):
+        g.result("boom")
+
+
+def test_suggest_fallback_without_client(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(app_module, "client", None)
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 1.0, "apparent_temperature": 20},
+        "hourly": {"precipitation_probability": [80]},
+    })
+    museum = {"type": "node", "id": 1, "lat": 10.0, "lon": 20.0, "tags": {"tourism": "museum", "name": "テスト博物館"}}
+    monkeypatch.setattr(app_module, "fetch_pois", lambda *a, **k: ([museum], np.array([0.1]), True))
+    app_module.WEATHER_CACHE.clear()
+    resp = app_module.app.test_client().post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "radius_km": 1, "mood": "まったり", "budget": ""})
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body["fallback"] is True
+    assert "indoor" in body["tags"]
+    assert body["near_pois"] == ["テスト博物館"]
+
+
+def test_suggest_batch_dedupes_upstreams(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(app_module, "client", None)
+    calls = {"weather": 0, "poi": 0}
+
+    def fake_weather(lat, lon):
+        calls["weather"] += 1
+        return {"current": {"precipitation": 0, "apparent_temperature": 31}}
+
+    def fake_pois(*a, **k):
+        calls["poi"] += 1
+        el = {"type": "node", "id": 1, "lat": 11.001, "lon": 21.001, "tags": {"tourism": "aquarium", "name": "テスト水族館"}}
+        return [el], np.array([0.2]), True
+
+    monkeypatch.setattr(app_module, "fetch_weather", fake_weather)
+    monkeypatch.setattr(app_module, "fetch_pois", fake_pois)
+    app_module.WEATHER_CACHE.clear()
+    same = {"lat": 11.001, "lon": 21.001, "radius_km": 2, "mood": "冒険"}
+    items = [same, dict(same), {"lat": 11.002, "lon": 21.002, "radius_km": 2, "mood": "冒険"},
+             {"lat": 12.5, "lon": 22.5}]
+    resp = app_module.app.test_client().post("/api/suggest/batch", json={"items": items})
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body["count"] == 4
+    assert [r["index"] for r in body["results"]] == [0, 1, 2, 3]
+    assert all(r["fallback"] for r in body["results"])
+    assert "aquarium" in body["results"][0]["tags"]
+    assert body["results"][0]["near_pois"] == ["テスト水族館"]
+    assert body["results"][3]["near_pois"] == []
+    assert calls == {"weather": 2, "poi": 2}
+
+
+def test_suggest_batch_generation_timeout_matches_single_shape(monkeypatch):
+    # 生成が締切に間に合わない item は単発の締切超過と同じ形 (fallback_reason=timeout, near_pois なし)
+    museum = {"type": "node", "id": 1, "lat": 10.0, "lon": 20.0, "tags": {"tourism": "museum", "name": "テスト博物館"}}
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 1.0, "apparent_temperature": 20}, "hourly": {"precipitation_probability": [80]}})
+    monkeypatch.setattr(app_module, "fetch_pois", lambda *a, **k: ([museum], np.array([0.1]), True))
+    monkeypatch.setattr(app_module, "_query_vec_stage", lambda q: None)
+    monkeypatch.setattr(app_module, "_embed_queries", lambda texts: np.zeros((len(texts), 4), dtype=np.float32))
+    monkeypatch.setattr(app_module, "BUDGET_SECONDS", 0.5)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    monkeypatch.setattr(app_module, "GEN_POOL", app_module.GenerationPool(workers=2, max_queue=2))
+
+    class SlowModel:
+        def generate_content(self, prompt):
+            time.sleep(1.0)
+            return type("R", (), {"text": "1. 遅い"})()
+
+    monkeypatch.setattr(app_module, "client", object())
+    monkeypatch.setattr(app_module, "generation_model", lambda: SlowModel())
+    # 生成待ちで共有ステージプールのスレッドを塞がない (投入されるのは天気セル / POI キーだけ)
+    staged = []
+    submit_deduped = app_module._submit_deduped
+    monkeypatch.setattr(app_module, "_submit_deduped", lambda keys, fn: submit_deduped(staged.extend(keys) or keys, fn))
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    item = {"lat": 10.0, "lon": 20.0, "radius_km": 1, "mood": "まったり"}
+    body = app_module.app.test_client().post("/api/suggest/batch", json={"items": [item]}).get_json()
+    assert staged and not any(isinstance(k, str) for k in staged)
+    (res,) = body["results"]
+    assert res["fallback"] is True and res["degraded"] is True
+    assert res["fallback_reason"] == "timeout"
+    assert "near_pois" not in res
+    single = app_module.suggest_response({"current": {}}, item, [], [], ["x"], None, 0.0, False, timed_out=True)
+    assert set(res) == set(single) | {"index"}
+
+
+def test_suggest_batch_validation():
+    c = app_module.app.test_client()
+    assert c.post("/api/suggest/batch", json={"items": []}).status_code == 400
+    assert c.post("/api/suggest/batch", json={"items": [{"lat": 91, "lon": 0}]}).status_code == 400
+
+
+def _sse_events(chunks):
+    events = []
+    for block in b"".join(chunks).decode("utf-8").split("\n\n"):
+        if block.strip():
+            name, data = block.split("\n", 1)
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_suggest_stream_fallback_without_client(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(app_module, "client", None)
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 1.0, "apparent_temperature": 20},
+        "hourly": {"precipitation_probability": [80]},
+    })
+    app_module.WEATHER_CACHE.clear()
+    c = app_module.app.test_client()
+    assert c.post("/api/suggest/stream", json={"lat": 999}).status_code == 400
+    resp = c.post("/api/suggest/stream", json={"lat": 10.0, "lon": 20.0, "mood": "まったり"})
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+    events = _sse_events(resp.response)
+    assert [e for e, _ in events] == ["context", "candidates", "done"]
+    assert "indoor" in events[0][1]["tags"]
+    assert events[-1][1]["fallback"] is True
+    assert events[-1][1]["tags"] == events[0][1]["tags"]
+
+
+def test_suggest_stream_emits_context_before_generation(monkeypatch):
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 0.0, "apparent_temperature": 20}, "hourly": {}})
+    monkeypatch.setattr(app_module, "_query_vec_stage", lambda q: None)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    parts = ["1. 公園で散歩\n近くの公園へ\n", "2. カフェ\nゆっくり\n", "3. 美術館\n展示を見る"]
+
+    class Chunk:
+        def __init__(self, text):
+            self.text = text
+
+    class FakeModel:
+        def generate_content(self, prompt, stream=False):
+            assert stream
+            for p in parts:
+                time.sleep(0.2)
+                yield Chunk(p)
+
+    class FakeClient:
+        def GenerativeModel(self, name, **kw):
+            return FakeModel()
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    resp = app_module.app.test_client().post("/api/suggest/stream", json={"lat": 10.0, "lon": 20.0})
+    t0 = time.perf_counter()
+    stream = iter(resp.response)
+    first = next(stream)
+    # 生成 (0.6s) を待たずに天気・タグが届く
+    assert time.perf_counter() - t0 < 0.15
+    assert first.startswith(b"event: context")
+    events = _sse_events([first, *stream])
+    assert [e for e, _ in events] == ["context", "candidates", "delta", "delta", "delta", "done"]
+    done = events[-1][1]
+    assert done["fallback"] is False and done["degraded"] is False
+    assert done["suggestions"] == "".join(parts).strip()
+
+
+def test_suggest_response_cache_by_situation(monkeypatch):
+    temp = {"v": 19}
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 0.0, "apparent_temperature": temp["v"]}, "hourly": {}})
+    monkeypatch.setattr(app_module, "_query_vec_stage", lambda q: None)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    calls = []
+
+    class FakeModel:
+        def generate_content(self, prompt):
+            calls.append(prompt)
+            return type("R", (), {"text": f"1. プラン{len(calls)}"})()
+
+    class FakeClient:
+        def GenerativeModel(self, name, **kw):
+            return FakeModel()
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    c = app_module.app.test_client()
+    first = c.post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "mood": "まったり", "budget": "～3000円"}).get_json()
+    assert first["cache_hit"] is False and first["suggestions"] == "1. プラン1"
+
+    # 同じセル・同じ温度帯 (18〜21℃)・表記揺れだけ違う入力 → 生成せずキャッシュから
+    temp["v"] = 20
+    app_module.WEATHER_CACHE.clear()
+    again = c.post("/api/suggest", json={"lat": 10.001, "lon": 20.002, "mood": " まったり ", "budget": "~3000円"}).get_json()
+    assert again["cache_hit"] is True
+    assert again["suggestions"] == "1. プラン1"
+    assert again["weather"]["apparent_temperature"] == 20
+    assert len(calls) == 1
+
+    # 暑さ帯が変われば (タグも変わる) 作り直す
+    temp["v"] = 32
+    app_module.WEATHER_CACHE.clear()
+    hot = c.post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "mood": "まったり", "budget": "～3000円"}).get_json()
+    assert hot["cache_hit"] is False and len(calls) == 2
+    assert app_module.SUGGEST_CACHE.stats()["hits"] == 1
+
+
+def test_suggest_cache_skipped_when_weather_degraded(monkeypatch):
+    # 天気取得失敗 (空の current) を 0℃ 帯の寒い応答として返してはいけない
+    weather = {"fail": False}
+
+    def fake_fetch(lat, lon):
+        if weather["fail"]:
+            raise RuntimeError("open-meteo down")
+        return {"current": {"precipitation": 0.0, "apparent_temperature": 0.5}, "hourly": {}}
+
+    monkeypatch.setattr(app_module, "fetch_weather", fake_fetch)
+    monkeypatch.setattr(app_module, "_query_vec_stage", lambda q: None)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    monkeypatch.setitem(app_module.BREAKERS, "open_meteo", app_module.CircuitBreaker("open_meteo"))
+    calls = []
+
+    class FakeModel:
+        def generate_content(self, prompt):
+            calls.append(prompt)
+            return type("R", (), {"text": f"1. プラン{len(calls)}"})()
+
+    class FakeClient:
+        def GenerativeModel(self, name, **kw):
+            return FakeModel()
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    c = app_module.app.test_client()
+    req = {"lat": 10.0, "lon": 20.0, "mood": "まったり"}
+    assert c.post("/api/suggest", json=req).get_json()["cache_hit"] is False
+
+    weather["fail"] = True
+    app_module.WEATHER_CACHE.clear()
+    body = c.post("/api/suggest", json=req).get_json()
+    assert body["cache_hit"] is False and body["degraded"] is True
+    assert len(calls) == 2
+    assert len(app_module.SUGGEST_CACHE) == 1  # 縮退応答は保存しない
+
+
+def test_semantic_cache_threshold_bucket_and_eviction():
+    sc = app_module.SemanticCache(threshold=0.9, per_bucket=2, max_buckets=8, ttl=60)
+    a = np.array([1.0, 0.0], dtype=np.float32)
+    near = np.array([0.95, 0.312], dtype=np.float32)  # cos ≈ 0.95
+    far = np.array([0.0, 1.0], dtype=np.float32)
+    assert sc.lookup("b1", a) == (None, None)
+    sc.put("b1", a, "A")
+    assert sc.lookup("b1", near)[0] == "A"
+    assert sc.lookup("b1", far)[0] is None
+    assert sc.lookup("b2", a)[0] is None  # 別バケットは見ない
+    sc.put("b1", far, "F")
+    sc.put("b1", near, "N")  # per_bucket=2 → 最古の A を捨てる
+    value, sim = sc.lookup("b1", a)
+    assert value == "N" and 0.9 < sim < 1.0
+    st = sc.stats()
+    assert st["hits"] == 2 and st["misses"] == 3 and st["entries"] == 2
+    assert sum(st["best_similarity"]["counts"]) == 3
+
+
+def test_suggest_semantic_cache_paraphrased_mood(monkeypatch):
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 0.0, "apparent_temperature": 20}, "hourly": {}})
+    vecs = {"まったり": [1.0, 0.0, 0.0], "のんびり": [0.99, 0.141, 0.0], "冒険": [0.0, 0.0, 1.0]}
+
+    def fake_vec(query):
+        mood = query.split(" ")[0][len("気分:"):]
+        v = np.array(vecs[mood], dtype=np.float32)
+        return v / np.linalg.norm(v)
+
+    monkeypatch.setattr(app_module, "_query_vec_stage", fake_vec)
+    monkeypatch.setattr(app_module, "_candidate_stage", lambda q_unit, tags, local_query=None: [])
+    monkeypatch.setattr(app_module, "SEMANTIC_CACHE", app_module.SemanticCache(0.95, 8, 8, 60))
+    monkeypatch.setattr(app_module, "SEMANTIC_CACHE_THRESHOLD", 0.95)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    calls = []
+
+    class FakeModel:
+        def generate_content(self, prompt):
+            calls.append(prompt)
+            return type("R", (), {"text": f"1. プラン{len(calls)}"})()
+
+    class FakeClient:
+        def GenerativeModel(self, name, **kw):
+            return FakeModel()
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    c = app_module.app.test_client()
+    assert c.post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "mood": "まったり"}).get_json()["cache_hit"] is False
+    # 言い換え: ルールタグも完全一致キーも違うが、同じセル・天気帯で埋め込みが近い
+    hit = c.post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "mood": "のんびり"}).get_json()
+    assert hit["cache_hit"] is True and hit["suggestions"] == "1. プラン1"
+    assert hit["cache_similarity"] >= 0.95
+    assert len(calls) == 1
+    # 離れた気分は生成し直す
+    miss = c.post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "mood": "冒険"}).get_json()
+    assert miss["cache_hit"] is False and len(calls) == 2
+    # 言い換えの完全一致キーも登録済み (次回は埋め込みを待たない)
+    assert app_module.SUGGEST_CACHE.stats()["size"] == 3
+
+
+def test_semantic_cache_bucket_includes_radius_and_indoor(monkeypatch):
+    # 半径無しの応答 (near_pois / places 無し) を半径指定のリクエストに返さない (逆も同様)
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 0.0, "apparent_temperature": 20}, "hourly": {}})
+    monkeypatch.setattr(app_module, "_query_vec_stage", lambda q: np.array([1.0, 0.0], dtype=np.float32))
+    monkeypatch.setattr(app_module, "_candidate_stage", lambda q_unit, tags, local_query=None: [])
+    monkeypatch.setattr(app_module, "SEMANTIC_CACHE", app_module.SemanticCache(0.95, 8, 8, 60))
+    monkeypatch.setattr(app_module, "SEMANTIC_CACHE_THRESHOLD", 0.95)
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    monkeypatch.setenv("DISABLE_POI", "1")
+    calls = []
+
+    class FakeModel:
+        def generate_content(self, prompt):
+            calls.append(prompt)
+            return type("R", (), {"text": f"1. プラン{len(calls)}"})()
+
+    class FakeClient:
+        def GenerativeModel(self, name, **kw):
+            return FakeModel()
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    c = app_module.app.test_client()
+    base = {"lat": 10.0, "lon": 20.0, "mood": "まったり"}
+    for extra in ({}, {"radius_km": 3}, {"indoor": True}):
+        assert c.post("/api/suggest", json=dict(base, **extra)).get_json()["cache_hit"] is False
+    assert len(calls) == 3
+    hit = c.post("/api/suggest", json=dict(base, mood="のんびり", radius_km=3)).get_json()
+    assert hit["cache_hit"] is True and hit["suggestions"] == "1. プラン2"
+
+
+def _prompt_fixture():
+    cands = [{"name": f"候補{j}", "tags": ["cafe", "indoor"], "places": [
+        {"name": f"店{j}-{k}", "lat": 35.0, "lon": 139.0, "distance_km": 0.2, "tags": {"amenity": "cafe"},
+         "osm_url": f"https://www.openstreetmap.org/node/{j}{k}"} for k in range(3)]} for j in range(8)]
+    weather = {"current": {"time": "2026-10-17T10:00", "interval": 900, "apparent_temperature": 19.5,
+                           "precipitation": 0.0}}
+    data = {"lat": 35.0, "lon": 139.0, "mood": "まったり", "radius_km": 2, "indoor": None, "budget": None}
+    return data, weather, cands
+
+
+def test_build_prompt_sends_only_used_fields():
+    data, weather, cands = _prompt_fixture()
+    prompt = app_module._build_prompt(data, weather, cands)
+    assert "osm_url" not in prompt and "openstreetmap" not in prompt and "amenity" not in prompt
+    assert "interval" not in prompt and "体感 19.5℃" in prompt
+    assert prompt.count("店3-1") == 1  # 許可リストと候補で重複させない
+    assert "屋内希望: 指定なし" in prompt and "None" not in prompt
+    assert data["_prompt_tokens"] == app_module.estimate_tokens(prompt) <= app_module.PROMPT_TOKEN_BUDGET
+
+
+def test_build_prompt_trims_to_budget():
+    data, weather, cands = _prompt_fixture()
+    full = app_module._build_prompt(dict(data), weather, cands)
+    head = app_module.estimate_tokens(full.split("[候補]")[0])
+    prompt = app_module._build_prompt(data, weather, cands, budget=head + 60)
+    lines = prompt.split("[候補]\n")[1].splitlines()
+    # 予算内で入るだけ + 最低 3 候補 (溢れた分は施設なし)
+    assert 3 <= len(lines) < 8
+    assert lines[0].startswith("- 候補0")
+    assert "近く:" not in lines[-1]
+    assert app_module.estimate_tokens("日本語") == 3 and app_module.estimate_tokens("abcd") == 1
+
+
+def test_generation_pool_admission_control():
+    pool = app_module.GenerationPool(workers=1, max_queue=1)
+    gate = threading.Event()
+    first = pool.submit(lambda: gate.wait(2) and "a", timeout=5)
+    queued = pool.submit(lambda: "b", timeout=5)
+    assert first is not None and queued is not None
+    # ワーカー使用中 + 列が満杯 → 待たせずに拒否
+    assert pool.submit(lambda: "c", timeout=5) is None
+    gate.set()
+    assert first.result(1) == "a" and queued.result(1) == "b"
+    assert pool.stats()["pending"] == 0 and pool.stats()["rejected"] == 1
+
+    # 生成時間の実績 (≈0.2s) から締切に間に合わない要求は列に積まない
+    pool = app_module.GenerationPool(workers=1, max_queue=4)
+    slow = pool.submit(lambda: time.sleep(0.2), timeout=5)
+    slow.result(1)
+    busy = pool.submit(lambda: time.sleep(0.2), timeout=5)
+    assert pool.submit(lambda: None, timeout=0.1) is None
+    busy.result(1)
+    # 空きワーカーがあれば締切が短くても受ける
+    assert pool.submit(lambda: "ok", timeout=0.01).result(1) == "ok"
+
+
+def test_generate_suggestions_reuses_model_and_rejects_when_busy(monkeypatch):
+    made = []
+
+    class FakeModel:
+        def generate_content(self, prompt):
+            return type("R", (), {"text": "1. ok"})()
+
+    class FakeClient:
+        def GenerativeModel(self, name, **kw):
+            made.append(name)
+            return FakeModel()
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", app_module.CircuitBreaker("gemini"))
+    monkeypatch.setattr(app_module, "GEN_POOL", app_module.GenerationPool(workers=1, max_queue=0))
+    assert app_module._generate_suggestions("p", 1.0) == "1. ok"
+    assert app_module._generate_suggestions("q", 1.0) == "1. ok"
+    assert len(made) == 1
+
+    gate = threading.Event()
+    app_module.GEN_POOL.submit(lambda: gate.wait(2), timeout=5)
+    t0 = time.perf_counter()
+    assert app_module._generate_suggestions("r", 3.0) is None  # 満杯: タイムアウトを待たずに即フォールバック
+    assert time.perf_counter() - t0 < 0.1
+    gate.set()
+
+
+def test_generation_queue_timeout_does_not_trip_breaker(monkeypatch):
+    # 列で待ったまま締切になった要求は Gemini を呼んでいないので失敗に数えない
+    class FakeModel:
+        def generate_content(self, prompt):
+            time.sleep(0.3)
+            return type("R", (), {"text": "1. ok"})()
+
+    monkeypatch.setattr(app_module, "client", object())
+    monkeypatch.setattr(app_module, "generation_model", lambda: FakeModel())
+    breaker = app_module.CircuitBreaker("gemini")
+    monkeypatch.setitem(app_module.BREAKERS, "gemini", breaker)
+    monkeypatch.setattr(app_module, "GEN_POOL", app_module.GenerationPool(workers=1, max_queue=1))
+    gate = threading.Event()
+    app_module.GEN_POOL.submit(lambda: gate.wait(2), timeout=5)
+    assert app_module._generate_suggestions("queued", 0.05) is None
+    assert breaker.consecutive_failures == 0
+    gate.set()
+    # 実際に呼んで締切を過ぎたものは失敗
+    assert app_module._generate_suggestions("slow", 0.05) is None
+    assert breaker.consecutive_failures == 1
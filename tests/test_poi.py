@@ -0,0 +1,167 @@
+import os, json, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+import app as app_module  # noqa: E402
+from app import PoiTileCache, geohash_encode, geohash_bbox, _tiles_covering, _haversine_km  # noqa: E402
+
+TOKYO = (35.6812, 139.7671)
+
+
+def _cafe(i, lat, lon, name=None):
+    return {"type": "node", "id": i, "lat": lat, "lon": lon, "tags": {"amenity": "cafe", "name": name or f"cafe{i}"}}
+
+
+def test_geohash_known_value_and_bbox():
+    assert geohash_encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    s, w, n, e = geohash_bbox("xn76ur")
+    assert s <= TOKYO[0] <= n and w <= TOKYO[1] <= e
+
+
+def test_tiles_cover_circle():
+    tiles = _tiles_covering(*TOKYO, 1000, 6)
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        ang, r = rng.uniform(0, 2 * np.pi), rng.uniform(0, 1000)
+        lat = TOKYO[0] + r * np.sin(ang) / 111320.0
+        lon = TOKYO[1] + r * np.cos(ang) / (111320.0 * np.cos(np.radians(TOKYO[0])))
+        assert geohash_encode(lat, lon, 6) in tiles
+
+
+def test_haversine_vectorized_matches_scalar():
+    d = _haversine_km(35.0, 139.0, [35.0, 35.01], [139.0, 139.0])
+    assert d[0] == 0 and abs(d[1] - 1.112) < 0.01
+
+
+def test_tile_cache_shares_nearby_queries(monkeypatch):
+    calls = []
+    pois = [_cafe(1, 35.6815, 139.7675), _cafe(2, 35.6830, 139.7690), _cafe(3, 35.7000, 139.8000)]
+
+    def fake_fetch(query, timeout, deadline_at):
+        calls.append(query)
+        return pois
+
+    monkeypatch.setattr(app_module, "_overpass_fetch", fake_fetch)
+    cache = PoiTileCache(maxsize=1000, ttl=60)
+    els, dists, complete = cache.query(*TOKYO, 500, [("amenity", "cafe")])
+    assert complete and {e["id"] for e in els} == {1, 2}
+    assert np.all(dists <= 0.5)
+    # 150m 離れた利用者: 同じタイル群で答えられ、Overpass を呼ばない
+    els2, _, _ = cache.query(TOKYO[0] + 0.00135, TOKYO[1], 300, [("amenity", "cafe")])
+    assert len(calls) == 1
+    assert {e["id"] for e in els2} <= {1, 2}
+
+
+def test_tile_cache_partial_on_failure(monkeypatch):
+    monkeypatch.setattr(app_module, "_overpass_fetch", lambda *a: None)
+    els, dists, complete = PoiTileCache().query(*TOKYO, 500, [("amenity", "cafe")])
+    assert els == [] and not complete
+
+
+def test_tile_cache_keeps_zero_coordinates(monkeypatch):
+    # 赤道 / 本初子午線上の node (0.0) を欠損扱いしない。0.0 の lat を center で上書きしない
+    pois = [_cafe(1, 0.0, 0.001), _cafe(2, 0.001, 0.0),
+            dict(_cafe(3, 0.0, 0.0005), center={"lat": 5.0, "lon": 5.0})]
+    monkeypatch.setattr(app_module, "_overpass_fetch", lambda *a: pois)
+    els, dists, complete = PoiTileCache(maxsize=1000, ttl=60).query(0.0, 0.0, 500, [("amenity", "cafe")])
+    assert complete and {e["id"] for e in els} == {1, 2, 3}
+    assert np.all(dists <= 0.5)
+    assert app_module._element_latlon(pois[2]) == (0.0, 0.0005)
+
+
+def test_nearest_poi_names_nearest_first():
+    far, near = _cafe(1, 35.6840, 139.7671, "遠い"), _cafe(2, 35.6813, 139.7671, "近い")
+    dists = _haversine_km(*TOKYO, [far["lat"], near["lat"]], [far["lon"], near["lon"]])
+    assert app_module.nearest_poi_names([far, near], dists, ["cafe"], 1000) == ["近い", "遠い"]
+    assert app_module.nearest_poi_names([far, near], dists, ["museum"], 1000) == []
+
+
+def test_poi_stage_single_fetch_for_near_pois_and_places(monkeypatch):
+    queries = []
+    museum = {"type": "node", "id": 9, "lat": 35.6820, "lon": 139.7671,
+              "tags": {"tourism": "museum", "name": "テスト美術館"}}
+
+    def fake_fetch(query, timeout, deadline_at):
+        queries.append(query)
+        return [_cafe(1, 35.6815, 139.7675, "テストカフェ"), museum]
+
+    monkeypatch.setattr(app_module, "_overpass_fetch", fake_fetch)
+    monkeypatch.setattr(app_module, "POI_TILES", PoiTileCache())
+    cands = [{"name": "美術館めぐり", "tags": ["museum"]}]
+    near, out, failed = app_module._poi_stage(*TOKYO, 1, ["cafe"], cands, app_module.Deadline(5.0))
+    assert len(queries) == 1
+    assert '"amenity"="cafe"' in queries[0] and '"tourism"="museum"' in queries[0]
+    assert near == ["テストカフェ"] and not failed
+    assert [p["name"] for p in out[0]["places"]] == ["テスト美術館"]
+    assert "places" not in cands[0]
+
+
+def _random_pois(n, seed=0):
+    rng = np.random.default_rng(seed)
+    kinds = [("amenity", "cafe"), ("tourism", "museum"), ("shop", "books")]
+    out = []
+    for i in range(n):
+        k, v = kinds[i % 3]
+        out.append({"type": "node" if i % 2 else "way", "id": i,
+                    "lat": float(TOKYO[0] + rng.uniform(-0.05, 0.05)), "lon": float(TOKYO[1] + rng.uniform(-0.05, 0.05)),
+                    "tags": {k: v, "name": f"施設{i}"}})
+    return out
+
+
+def test_poi_store_roundtrip_matches_brute_force(tmp_path):
+    els = _random_pois(600)
+    store = app_module.PoiStore.from_elements(els + [{"type": "node", "id": 999, "lat": 35.0, "lon": 139.0,
+                                                      "tags": {"amenity": "cafe"}}])  # 名前無しは捨てる
+    assert len(store) == 600
+    store = app_module.PoiStore.load(store.save(str(tmp_path / "pois.npz")))
+    got, dists, complete = store.query(*TOKYO, 1500, [("amenity", "cafe"), ("tourism", "museum")])
+    d_all = _haversine_km(*TOKYO, [e["lat"] for e in els], [e["lon"] for e in els])
+    want = {e["id"] for e, d in zip(els, d_all) if d <= 1.5 and ("shop" not in e["tags"])}
+    assert complete and {e["id"] for e in got} == want
+    assert np.all(dists <= 1.5)
+    assert all(e["tags"]["name"] == f"施設{e['id']}" for e in got)
+
+
+def test_fetch_pois_prefers_covering_store(monkeypatch):
+    store = app_module.PoiStore.from_elements(_random_pois(300), bbox=(35.5, 139.5, 35.9, 139.95))
+    monkeypatch.setattr(app_module, "POI_STORE", store)
+    monkeypatch.setattr(app_module, "_overpass_fetch", lambda *a: pytest.fail("Overpass should not be called"))
+    els, dists, complete = app_module.fetch_pois(*TOKYO, 1000, ("cafe",), ("museum",), 5.0)
+    assert complete and len(els) == len(dists) > 0
+    assert store.covers(*TOKYO, 1000, [("amenity", "cafe")])
+    assert not store.covers(34.0, 135.0, 1000, [("amenity", "cafe")])
+
+
+def test_poi_stage_leaves_generation_budget(monkeypatch):
+    # Overpass 障害でリトライしても締切の残り全部は使わせない (生成の持ち分を残す)
+    budgets = []
+
+    def fake_fetch(lat, lon, radius_m, near_tags, place_tags, remaining_budget):
+        budgets.append(remaining_budget)
+        return [], np.empty(0), False
+
+    monkeypatch.setattr(app_module, "fetch_pois", fake_fetch)
+    monkeypatch.setattr(app_module, "POI_BUDGET_SHARE", 0.6)
+    deadline = app_module.Deadline(5.0)
+    _, _, failed = app_module._poi_stage(*TOKYO, 1, ["cafe"], [], deadline)
+    assert failed
+    assert 2.5 < budgets[0] <= 3.0
+
+
+def test_attach_places_nearest_first_distinct_names():
+    # 応答順は遠い順。同名チェーンが最寄りに並んでも名前の異なる 3 件を近い順に選ぶ
+    els = [_cafe(i, TOKYO[0] + 0.001 * (10 - i), TOKYO[1], "チェーン" if i >= 7 else f"店{i}") for i in range(10)]
+    dists = _haversine_km(*TOKYO, [e["lat"] for e in els], [e["lon"] for e in els])
+    cands = app_module.attach_places([{"name": "カフェ", "tags": ["cafe"]}], els, dists, ("cafe",), 3000)
+    places = cands[0]["places"]
+    assert [p["name"] for p in places] == ["チェーン", "店6", "店5"]
+    assert [p["distance_km"] for p in places] == sorted(p["distance_km"] for p in places)
+    assert cands[0]["id"] == "カフェ"
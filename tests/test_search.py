@@ -0,0 +1,225 @@
+import os, json, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+import app as app_module  # noqa: E402
+from app import EmbeddingProjection, EmbeddingStore, ExactIndex, IVFIndex  # noqa: E402
+
+
+def _clustered(n=3000, dim=32, clusters=30, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, clusters, size=n)] + 0.3 * rng.standard_normal((n, dim)).astype(np.float32)
+    return EmbeddingStore.normalize(x)
+
+
+def test_exact_index_sorted_topk():
+    x = _clustered(200)
+    idx, sims = ExactIndex(EmbeddingStore(x)).search(x[7], 5)
+    assert idx[0] == 7
+    assert np.all(np.diff(sims) <= 0)
+
+
+def test_ivf_recall_and_nprobe_knob():
+    x = _clustered()
+    store = EmbeddingStore(x)
+    index = IVFIndex.build(store, nlist=40, seed=1)
+    rng = np.random.default_rng(2)
+    queries = EmbeddingStore.normalize(x[rng.integers(0, len(x), 50)] + 0.1 * rng.standard_normal((50, x.shape[1])).astype(np.float32))
+
+    def recall(nprobe):
+        hits = 0
+        for q in queries:
+            truth = set(ExactIndex(store).search(q, 10)[0].tolist())
+            hits += len(truth & set(index.search(q, 10, nprobe=nprobe)[0].tolist()))
+        return hits / (10 * len(queries))
+
+    assert recall(40) == 1.0  # 全セル走査 = 厳密
+    assert recall(8) >= 0.9
+
+
+def test_ivf_save_load_roundtrip(tmp_path):
+    x = _clustered(500)
+    store = EmbeddingStore(x, catalog_digest=b"\1" * 32)
+    index = IVFIndex.build(store, nlist=10)
+    path = str(tmp_path / "ivf.npz")
+    index.save(path)
+    loaded = IVFIndex.load(path, store)
+    assert np.array_equal(loaded.ids, index.ids)
+    with pytest.raises(ValueError):
+        IVFIndex.load(path, EmbeddingStore(x[:400]))
+    with pytest.raises(ValueError):
+        IVFIndex.load(path, EmbeddingStore(x, catalog_digest=b"\2" * 32))
+
+
+
+def test_pca_projection_keeps_small_catalog_ranking():
+    # 行数 <= dim なら主成分がカタログの張る空間を覆い、射影後も順位は変わらない
+    x = _clustered(20, dim=64)
+    proj = EmbeddingProjection.fit(x, 32, "pca")
+    store = EmbeddingStore(proj.apply(x), projection=proj)
+    rng = np.random.default_rng(3)
+    for q in EmbeddingStore.normalize(rng.standard_normal((10, 64)).astype(np.float32)):
+        assert np.array_equal(np.argsort(-store.scores(store.project(q)))[:5], np.argsort(-(x @ q))[:5])
+
+
+def test_ivf_load_rejects_dim_mismatch(tmp_path):
+    x = _clustered(500)
+    index = IVFIndex.build(EmbeddingStore(x), nlist=10)
+    path = str(tmp_path / "ivf.npz")
+    index.save(path)
+    proj = EmbeddingProjection.fit(x, 16, "truncate")
+    with pytest.raises(ValueError):
+        IVFIndex.load(path, EmbeddingStore(proj.apply(x), projection=proj))
+
+def test_small_catalog_falls_back_to_exact(monkeypatch):
+    monkeypatch.setattr(app_module, "ANN_MIN_ROWS", 1000)
+    assert app_module._make_index(EmbeddingStore(_clustered(100))).kind == "exact"
+
+
+def test_tag_index_and_rows_union():
+    acts = [{"name": "a", "tags": ["indoor", "cafe"]}, {"name": "b", "tags": ["outdoor"]},
+            {"name": "c", "tags": ["indoor", "museum"]}]
+    ti = app_module._build_tag_index(acts)
+    assert ti["indoor"].tolist() == [0, 2]
+    assert app_module._rows_for_tags(["cafe", "museum"], ti).tolist() == [0, 2]
+    assert app_module._rows_for_tags(["nope"], ti) is None
+    bonus = app_module._tag_bonus(["cafe", "indoor"], 3, weight=0.1, tag_index=ti)
+    assert np.allclose(bonus, [0.2, 0.0, 0.1])
+
+
+def test_filtered_and_boosted_search():
+    x = _clustered(300)
+    index = ExactIndex(EmbeddingStore(x))
+    rows = np.arange(100, 200)
+    idx, _ = index.search(x[5], 10, rows=rows)
+    assert set(idx.tolist()) <= set(rows.tolist())
+    bonus = np.zeros(300, dtype=np.float32)
+    bonus[250] = 10.0
+    idx, _ = index.search(x[5], 3, bonus=bonus)
+    assert idx[0] == 250
+
+
+def test_top_k_by_embedding_hard_filter(monkeypatch):
+    # 屋外行に寄ったクエリでも indoor フィルタ時は屋内行だけが返る
+    acts = [{"name": "in", "tags": ["indoor"]}, {"name": "out", "tags": ["outdoor"]}]
+    x = EmbeddingStore.normalize(np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32))
+    store = EmbeddingStore(x)
+
+    class FakeClient:
+        def embed_content(self, model, content):
+            return {"embedding": [0.1, 1.0]}
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    monkeypatch.setattr(app_module, "ACTIVITIES", acts)
+    monkeypatch.setattr(app_module, "TAG_INDEX", app_module._build_tag_index(acts))
+    monkeypatch.setattr(app_module, "EMB_STORE", store)
+    monkeypatch.setattr(app_module, "ANN_INDEX", ExactIndex(store))
+    monkeypatch.setattr(app_module, "EMB_STALE", False)
+    monkeypatch.setattr(app_module, "QUERY_EMB_CACHE", app_module.QueryEmbeddingCache("", 8, 60))
+    assert [a["name"] for a in app_module.top_k_by_embedding("q", k=2)] == ["out", "in"]
+    assert [a["name"] for a in app_module.top_k_by_embedding("q", k=2, tag_filter=["indoor"])] == ["in"]
+
+
+
+def test_top_k_projects_full_dim_query(monkeypatch):
+    # ストアが次元削減済みでも、キャッシュ / 埋め込み API の元次元クエリがそのまま使える
+    acts = [{"name": f"a{i}", "tags": []} for i in range(3)]
+    x = EmbeddingStore.normalize(np.eye(3, 6, dtype=np.float32) + 0.01)
+    proj = EmbeddingProjection.fit(x, 3, "truncate")
+    store = EmbeddingStore(proj.apply(x), projection=proj)
+    monkeypatch.setattr(app_module, "ACTIVITIES", acts)
+    monkeypatch.setattr(app_module, "ANN_INDEX", ExactIndex(store))
+    assert [a["name"] for a in app_module.top_k_by_vector(x[2], 1)] == ["a2"]
+    assert [[a["name"] for a in r] for r in app_module.top_k_by_vectors(x[[1, 0]], 1)] == [["a1"], ["a0"]]
+
+def test_top_k_batch_single_embed_call(monkeypatch):
+    acts = [{"name": "in", "tags": ["indoor"]}, {"name": "out", "tags": ["outdoor"]}]
+    store = EmbeddingStore(EmbeddingStore.normalize(np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)))
+    calls = []
+
+    class FakeClient:
+        def embed_content(self, model, content):
+            calls.append(content)
+            return {"embedding": [[1.0, 0.1] if "a" in t else [0.1, 1.0] for t in content]}
+
+    monkeypatch.setattr(app_module, "client", FakeClient())
+    monkeypatch.setattr(app_module, "ACTIVITIES", acts)
+    monkeypatch.setattr(app_module, "TAG_INDEX", app_module._build_tag_index(acts))
+    monkeypatch.setattr(app_module, "EMB_STORE", store)
+    monkeypatch.setattr(app_module, "ANN_INDEX", ExactIndex(store))
+    monkeypatch.setattr(app_module, "EMB_STALE", False)
+    monkeypatch.setattr(app_module, "QUERY_EMB_CACHE", app_module.QueryEmbeddingCache("", 8, 60))
+    res = app_module.top_k_by_embedding_batch(["a", "b", "a", "b"], k=1, tag_filters=[None, None, None, ["indoor"]])
+    assert [[c["name"] for c in r] for r in res] == [["in"], ["out"], ["in"], ["in"]]
+    assert calls == [["a", "b"]]  # 重複排除した 1 回のバッチ呼び出し
+
+
+_LOCAL_ACTS = [
+    {"name": "地元カフェ巡り", "tags": ["cafe", "indoor", "relaxing"]},
+    {"name": "本屋・書店", "tags": ["bookstore", "indoor", "relaxing"]},
+    {"name": "ボルダリング", "tags": ["bouldering", "indoor", "active"]},
+    {"name": "公園でピクニック", "tags": ["park", "outdoor"]},
+]
+
+
+def _local_setup(monkeypatch):
+    monkeypatch.setattr(app_module, "ACTIVITIES", _LOCAL_ACTS)
+    monkeypatch.setattr(app_module, "TAG_INDEX", app_module._build_tag_index(_LOCAL_ACTS))
+    monkeypatch.setattr(app_module, "LOCAL_INDEX", app_module.LocalIndex(app_module.LocalEmbedder(256)))
+
+
+def test_local_embedder_stable_unit_vectors():
+    e = app_module.LocalEmbedder(256)
+    v = e.embed("まったり cafe")
+    assert np.allclose(v, app_module.LocalEmbedder(256).embed("まったり　CAFE"))  # NFKC + lower
+    assert abs(np.linalg.norm(v) - 1.0) < 1e-5
+    assert float(v @ e.embed("地元カフェ巡り cafe")) > float(v @ e.embed("ボルダリング bouldering"))
+
+
+def test_candidate_stage_uses_local_embedder_without_vector(monkeypatch):
+    _local_setup(monkeypatch)
+    names = [a["name"] for a in app_module._candidate_stage(None, ["cafe", "bookstore"], "まったり cafe bookstore")]
+    assert set(names[:2]) == {"地元カフェ巡り", "本屋・書店"}
+    # indoor はハードフィルタ: 屋外行は出さない
+    indoor = app_module._candidate_stage(None, ["indoor", "bouldering"], "冒険 indoor bouldering")
+    assert indoor[0]["name"] == "ボルダリング" and all("indoor" in a["tags"] for a in indoor)
+    monkeypatch.setattr(app_module, "LOCAL_EMBED", "off")
+    assert app_module._candidate_stage(None, ["cafe"], "cafe") == []
+
+
+def test_candidate_stage_falls_back_when_vector_search_fails(monkeypatch):
+    # ストア / インデックスの読み出し失敗でもステージは落ちずローカル検索の候補を返す
+    _local_setup(monkeypatch)
+    monkeypatch.setattr(app_module, "LOCAL_EMBED", "fallback")
+    monkeypatch.setattr(app_module, "_ensure_embeddings", lambda: True)
+
+    def broken(*a, **k):
+        raise OSError("store read failed")
+
+    monkeypatch.setattr(app_module, "top_k_by_vector", broken)
+    q = np.ones(4, dtype=np.float32) / 2
+    names = [a["name"] for a in app_module._candidate_stage(q, ["cafe"], "まったり cafe")]
+    assert names and names[0] == "地元カフェ巡り"
+
+
+def test_suggest_without_client_has_local_candidates(monkeypatch):
+    _local_setup(monkeypatch)
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(app_module, "client", None)
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {
+        "current": {"precipitation": 0.0, "apparent_temperature": 20}, "hourly": {}})
+    app_module.WEATHER_CACHE.clear()
+    app_module.SUGGEST_CACHE.clear()
+    body = app_module.app.test_client().post("/api/suggest", json={"lat": 10.0, "lon": 20.0, "mood": "まったり"}).get_json()
+    assert body["fallback"] is True
+    assert body["candidates"][0]["name"] in ("地元カフェ巡り", "本屋・書店")
+    assert "地元カフェ巡り" in body["suggestions"] or "本屋・書店" in body["suggestions"]
@@ -0,0 +1,164 @@
+import os, json, sys, time, threading
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+# app.py インポート前に最低限のファイルを用意 (tests/test_rules.py と同様)
+if not os.path.exists("activities_seed.json"):
+    with open("activities_seed.json", "w", encoding="utf-8") as f:
+        json.dump([{"name": "Dummy", "tags": ["x"]}], f, ensure_ascii=False)
+if not os.path.exists("embeddings.npy"):
+    np.save("embeddings.npy", np.zeros((1, 4), dtype=np.float32))
+
+import app as app_module  # noqa: E402
+from app import Deadline, WeatherCache  # noqa: E402
+
+
+def test_weather_cache_single_flight(monkeypatch):
+    calls = []
+
+    def slow_weather(lat, lon):
+        calls.append((lat, lon))
+        time.sleep(0.2)
+        return {"current": {"apparent_temperature": 20}}
+
+    monkeypatch.setattr(app_module, "fetch_weather", slow_weather)
+    cache = WeatherCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(35.0, 139.0, Deadline(5.0))))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(results) == 8 and all(not degraded for _, degraded in results)
+    s = cache.stats()
+    assert s["misses"] == 8 and s["coalesced"] == 7
+    assert cache.get(35.001, 139.001, Deadline(5.0))[1] is False and cache.stats()["hits"] == 1
+
+
+def test_weather_cache_serves_stale_while_refreshing(monkeypatch):
+    temps = iter([10, 25])
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {"current": {"apparent_temperature": next(temps)}})
+    cache = WeatherCache(ttl=0.05, stale=60)
+    assert cache.get(35.0, 139.0, Deadline(5.0))[0]["current"]["apparent_temperature"] == 10
+    time.sleep(0.1)
+    # TTL 切れ: 古い値を即返し、裏で更新
+    assert cache.get(35.0, 139.0, Deadline(5.0))[0]["current"]["apparent_temperature"] == 10
+    for _ in range(50):
+        if cache.stats()["inflight"] == 0:
+            break
+        time.sleep(0.01)
+    entry = cache.cache.get((35.0, 139.0))
+    assert entry[1]["current"]["apparent_temperature"] == 25
+    assert cache.stats()["stale_hits"] == 1 and cache.stats()["refreshes"] == 1
+
+
+def test_weather_cache_does_not_cache_failures(monkeypatch):
+    def boom(lat, lon):
+        raise app_module.requests.ConnectionError("down")
+
+    monkeypatch.setattr(app_module, "fetch_weather", boom)
+    monkeypatch.setitem(app_module.BREAKERS, "open_meteo", app_module.CircuitBreaker("open_meteo"))
+    cache = WeatherCache()
+    weather, degraded = cache.get(35.0, 139.0, Deadline(0.5))
+    assert degraded and weather["current"] == {}
+    assert len(cache.cache) == 0 and cache.stats()["failures"] == 1
+
+
+def test_weather_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: {"current": {}})
+    cache = WeatherCache(maxsize=2)
+    for i in range(4):
+        cache.get(10.0 + i, 20.0, Deadline(5.0))
+    assert cache.stats()["size"] == 2 and cache.stats()["evictions"] == 2
+
+
+def _forecast(start_epoch, hours=6, offset=9 * 3600):
+    from datetime import datetime, timezone
+    times = [datetime.fromtimestamp(start_epoch + h * 3600 + offset, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M")
+             for h in range(hours)]
+    return {
+        "utc_offset_seconds": offset,
+        "current": {"apparent_temperature": 99, "precipitation": 0},
+        "hourly": {"time": times, "apparent_temperature": [10 + h for h in range(hours)],
+                   "precipitation": [0.0] * hours, "precipitation_probability": [10 * h for h in range(hours)]},
+    }
+
+
+def test_weather_at_derives_current_from_hourly():
+    t0 = 1_700_000_000 // 3600 * 3600
+    w = _forecast(t0)
+    at = app_module.weather_at(w, now=t0 + 2 * 3600 + 120)
+    assert at["current"]["apparent_temperature"] == 12
+    assert at["hourly"]["precipitation_probability"][0] == 20
+    assert w["current"]["apparent_temperature"] == 99  # 元のキャッシュ値は変更しない
+    assert app_module.weather_at(w, now=t0 - 1) is None
+    assert app_module.weather_at(w, now=t0 + 6 * 3600) is None
+    assert app_module.weather_at({"current": {}}) is None
+
+
+def test_weather_cache_uses_hourly_within_horizon(monkeypatch):
+    now = time.time()
+    calls = []
+
+    def fake(lat, lon):
+        calls.append(1)
+        return _forecast(now // 3600 * 3600 - 3600)
+
+    monkeypatch.setattr(app_module, "fetch_weather", fake)
+    cache = WeatherCache(ttl=0.01, horizon=3600)
+    cache.get(35.0, 139.0, Deadline(5.0))
+    time.sleep(0.02)
+    weather, degraded = cache.get(35.0, 139.0, Deadline(5.0))
+    assert len(calls) == 1 and not degraded
+    assert weather["current"]["apparent_temperature"] == 11  # 現在の時間帯 (開始 +1h) の予報値
+    assert cache.stats()["hourly_hits"] == 1
+
+
+def test_weather_cache_fresh_and_fetched_use_current_hour(monkeypatch):
+    # 取得直後・TTL 内のヒットも hourly[0] が「今」の時間帯 (キャッシュ年齢で降水確率が変わらない)
+    now = time.time()
+    monkeypatch.setattr(app_module, "fetch_weather", lambda lat, lon: _forecast(now // 3600 * 3600 - 2 * 3600))
+    cache = WeatherCache(ttl=600, horizon=3600)
+    fetched, _ = cache.get(35.0, 139.0, Deadline(5.0))
+    fresh, _ = cache.get(35.0, 139.0, Deadline(5.0))
+    for weather in (fetched, fresh):
+        assert weather["hourly"]["precipitation_probability"][0] == 20
+        assert weather["current"]["apparent_temperature"] == 12
+    assert cache.stats()["hits"] == 1
+
+
+def test_hot_cell_tracker_decays_and_bounds():
+    tr = app_module.HotCellTracker(maxsize=4, half_life=10)
+    for _ in range(5):
+        tr.touch(35.0, 139.0, now=0)
+    for _ in range(3):
+        tr.touch(34.0, 135.0, now=100)  # 35/139 は 10 半減期を経て ≈ 0
+    assert tr.top(1, now=100) == [(34.0, 135.0)]
+    for i in range(10):
+        tr.touch(10.0 + i, 20.0, now=100)
+    assert len(tr) <= 4
+
+
+def test_prewarmer_refreshes_due_hot_cells_in_one_request(monkeypatch):
+    requested = []
+
+    def fake_many(coords):
+        requested.append(list(coords))
+        return [{"current": {"apparent_temperature": 20}} for _ in coords]
+
+    monkeypatch.setattr(app_module, "fetch_weather_many", fake_many)
+    cache = WeatherCache(ttl=600, horizon=0)
+    tr = app_module.HotCellTracker()
+    for lat in (35.0, 35.1, 35.2):
+        tr.touch(lat, 139.0)
+    cache.put((35.2, 139.0), {"current": {}})  # 取得直後なので対象外
+    pw = app_module.WeatherPrewarmer(cache, tr, lead=60, batch=10)
+    assert pw.run_once() == 2
+    assert len(requested) == 1 and sorted(requested[0]) == [(35.0, 139.0), (35.1, 139.0)]
+    assert pw.due() == []
+    # 期限が lead 秒以内に迫ったセルは再び対象
+    assert len(pw.due(now=time.time() + 590)) == 3
+    assert not pw.stats()["enabled"]